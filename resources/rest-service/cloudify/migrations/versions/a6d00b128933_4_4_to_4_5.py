@@ -5,8 +5,12 @@ Revises: c7652b2a97a4
 Create Date: 2018-08-05 09:05:15.625382
 
 """
+
 from alembic import op
 import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from cloudify import constants as cloudify_constants
+from cloudify import utils as cloudify_utils
 from manager_rest.storage.models_base import UTCDateTime
 
 
@@ -16,20 +20,301 @@ down_revision = 'c7652b2a97a4'
 branch_labels = None
 depends_on = None
 
+# Define tables with just the columns needed
+# to generate the UPDATE sql expressions below
+blueprints = sa.table(
+    'blueprints',
+    sa.column('_storage_id', sa.Integer),
+    sa.column('plan', sa.PickleType),
+    sa.column('workflow_plugins_to_install', sa.PickleType),
+    sa.column('deployment_plugins_to_install', sa.PickleType),
+    sa.column('state', sa.Text),
+)
+
+nodes = sa.table(
+    'nodes',
+    sa.column('_storage_id', sa.Integer),
+    sa.column('id', sa.Text),
+    sa.column('properties', sa.PickleType),
+    sa.column('type_hierarchy', sa.PickleType),
+    sa.column('_deployment_fk', sa.Integer),
+)
+
+node_instances = sa.table(
+    'node_instances',
+    sa.column('_storage_id', sa.Integer),
+    sa.column('id', sa.Text),
+    sa.column('host_id', sa.Text),
+    sa.column('runtime_properties', sa.PickleType),
+    sa.column('state', sa.Text),
+    sa.column('visibility', sa.Text),
+    sa.column('_node_fk', sa.Integer),
+    sa.column('_tenant_id', sa.Integer),
+    sa.column('_creator_id', sa.Integer),
+)
+
+deployments = sa.table(
+    'deployments',
+    sa.column('_storage_id', sa.Integer),
+    sa.column('id', sa.Text),
+)
+
+blueprint_upload_state = sa.Enum(
+    'parsing',
+    'uploaded',
+    'invalid',
+    name='blueprint_upload_state',
+)
+
+
+def summarize_blueprint_plans():
+    """Fill the blueprints' plugins summary from their plans.
+
+    The plans are loaded one at a time, so that the whole blueprints table
+    doesn't have to fit in memory.
+    """
+    bind = op.get_bind()
+    storage_ids = [row[0] for row in
+                   bind.execute(sa.select([blueprints.c._storage_id]))]
+    for storage_id in storage_ids:
+        plan = bind.execute(
+            sa.select([blueprints.c.plan])
+            .where(blueprints.c._storage_id == storage_id)
+        ).scalar()
+        bind.execute(
+            blueprints.update()
+            .where(blueprints.c._storage_id == storage_id)
+            .values(
+                workflow_plugins_to_install=plan.get(
+                    'workflow_plugins_to_install', []),
+                deployment_plugins_to_install=plan.get(
+                    'deployment_plugins_to_install', []))
+        )
+
+
+def _agent_system(agent):
+    if agent.get('windows'):
+        return 'windows'
+    system = agent.get('distro') or ''
+    if agent.get('distro_codename'):
+        system = '{0} {1}'.format(system, agent.get('distro_codename'))
+    return system
+
+
+def create_agents():
+    """Fill the agents table from the runtime properties of the started
+    compute node instances, the same way the REST service does when the
+    instances are updated
+    """
+    bind = op.get_bind()
+    agent_nodes = set()
+    for storage_id, properties, type_hierarchy in bind.execute(
+            sa.select([nodes.c._storage_id,
+                       nodes.c.properties,
+                       nodes.c.type_hierarchy])):
+        if cloudify_constants.COMPUTE_NODE_TYPE not in type_hierarchy:
+            continue
+        if cloudify_utils.internal.get_install_method(properties) == \
+                cloudify_constants.AGENT_INSTALL_METHOD_NONE:
+            continue
+        agent_nodes.add(storage_id)
+    if not agent_nodes:
+        return
+
+    agents_table = sa.table(
+        'agents',
+        *[sa.column(name) for name in (
+            'id', 'private_resource', 'visibility', 'ip', 'host_id',
+            'install_method', 'system', 'version', 'node_id',
+            'deployment_id', '_node_instance_fk', '_tenant_id',
+            '_creator_id')]
+    )
+    query = sa.select([
+        node_instances.c._storage_id,
+        node_instances.c.id,
+        node_instances.c.host_id,
+        node_instances.c.runtime_properties,
+        node_instances.c.visibility,
+        node_instances.c._node_fk,
+        node_instances.c._tenant_id,
+        node_instances.c._creator_id,
+        nodes.c.id,
+        deployments.c.id,
+    ]).select_from(
+        node_instances
+        .join(nodes, nodes.c._storage_id == node_instances.c._node_fk)
+        .join(deployments,
+              deployments.c._storage_id == nodes.c._deployment_fk)
+    ).where(node_instances.c.state == 'started')
+    agents = []
+    for (storage_id, instance_id, host_id, runtime_properties, visibility,
+         node_fk, tenant_id, creator_id, node_id, deployment_id) in \
+            bind.execute(query):
+        if node_fk not in agent_nodes:
+            continue
+        agent = (runtime_properties or {}).get('cloudify_agent')
+        if not agent:
+            continue
+        agents.append({
+            'id': instance_id,
+            'private_resource': visibility == 'private',
+            'visibility': visibility,
+            'ip': agent.get('ip'),
+            'host_id': host_id,
+            'install_method': agent.get('install_method'),
+            'system': _agent_system(agent),
+            'version': agent.get('version'),
+            'node_id': node_id,
+            'deployment_id': deployment_id,
+            '_node_instance_fk': storage_id,
+            '_tenant_id': tenant_id,
+            '_creator_id': creator_id,
+        })
+    if agents:
+        op.bulk_insert(agents_table, agents)
+
 
 def upgrade():
     op.add_column('executions', sa.Column('started_at',
                                           UTCDateTime(),
                                           nullable=True))
+    op.add_column('blueprints', sa.Column('workflow_plugins_to_install',
+                                          sa.PickleType(),
+                                          nullable=True))
+    op.add_column('blueprints', sa.Column('deployment_plugins_to_install',
+                                          sa.PickleType(),
+                                          nullable=True))
+    summarize_blueprint_plans()
+
+    # Blueprints can be stored before they're parsed (asynchronous upload)
+    blueprint_upload_state.create(op.get_bind())
+    op.add_column('blueprints', sa.Column('state',
+                                          blueprint_upload_state,
+                                          nullable=True))
+    op.add_column('blueprints', sa.Column('error', sa.Text(), nullable=True))
+    op.execute(blueprints.update().values(state='uploaded'))
+    op.alter_column('blueprints', 'plan', nullable=True)
+    op.add_column('blueprints', sa.Column('plan_digest',
+                                          sa.Text(),
+                                          nullable=True))
+    op.create_index(op.f('blueprints_plan_digest_idx'),
+                    'blueprints',
+                    ['plan_digest'],
+                    unique=False)
+    op.add_column('plugins', sa.Column('yaml_file_name',
+                                       sa.Text(),
+                                       nullable=True))
+
+    # Incremental snapshots record the snapshot they're based on
+    op.add_column('snapshots', sa.Column('base_snapshot_id',
+                                         sa.Text(),
+                                         nullable=True))
+    op.create_index(op.f('snapshots_base_snapshot_id_idx'),
+                    'snapshots',
+                    ['base_snapshot_id'],
+                    unique=False)
+
+    # Agents are kept in their own table, so that they can be listed
+    # without going over all the node instances
+    op.create_table(
+        'agents',
+        sa.Column('_storage_id', sa.Integer(), nullable=False),
+        sa.Column('id', sa.Text(), nullable=True),
+        sa.Column('private_resource', sa.Boolean(), nullable=True),
+        sa.Column('visibility',
+                  postgresql.ENUM('private', 'tenant', 'global',
+                                  name='visibility_states',
+                                  create_type=False),
+                  nullable=True),
+        sa.Column('ip', sa.Text(), nullable=True),
+        sa.Column('host_id', sa.Text(), nullable=True),
+        sa.Column('install_method', sa.Text(), nullable=True),
+        sa.Column('system', sa.Text(), nullable=True),
+        sa.Column('version', sa.Text(), nullable=True),
+        sa.Column('node_id', sa.Text(), nullable=True),
+        sa.Column('deployment_id', sa.Text(), nullable=True),
+        sa.Column('_node_instance_fk', sa.Integer(), nullable=False),
+        sa.Column('_tenant_id', sa.Integer(), nullable=False),
+        sa.Column('_creator_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['_creator_id'],
+            [u'users.id'],
+            name=op.f('agents__creator_id_fkey'),
+            ondelete='CASCADE',
+        ),
+        sa.ForeignKeyConstraint(
+            ['_node_instance_fk'],
+            [u'node_instances._storage_id'],
+            name=op.f('agents__node_instance_fk_fkey'),
+            ondelete='CASCADE',
+        ),
+        sa.ForeignKeyConstraint(
+            ['_tenant_id'],
+            [u'tenants.id'],
+            name=op.f('agents__tenant_id_fkey'),
+            ondelete='CASCADE',
+        ),
+        sa.PrimaryKeyConstraint('_storage_id', name=op.f('agents_pkey'))
+    )
+    for column in ('id', 'install_method', 'node_id', 'deployment_id',
+                   '_node_instance_fk', '_tenant_id'):
+        op.create_index(op.f('agents_{0}_idx'.format(column)),
+                        'agents',
+                        [column],
+                        unique=False)
+    create_agents()
 
     op.execute('COMMIT')
 
     # Add new execution status
     op.execute("alter type execution_status add value 'queued'")
 
+    # Partial indexes used by the execution scheduler
+    op.create_index(
+        'executions_queued_created_at_idx',
+        'executions',
+        ['created_at'],
+        unique=False,
+        postgresql_where=sa.text("status = 'queued'"))
+    op.create_index(
+        'executions_active_deployment_fk_idx',
+        'executions',
+        ['_deployment_fk'],
+        unique=False,
+        postgresql_where=sa.text(
+            "status IN ('pending', 'started', 'cancelling', "
+            "'force_cancelling', 'kill_cancelling')"))
+
 
 def downgrade():
+    op.drop_index('executions_active_deployment_fk_idx',
+                  table_name='executions')
+    op.drop_index('executions_queued_created_at_idx',
+                  table_name='executions')
     op.drop_column('executions', 'started_at')
+    op.drop_column('blueprints', 'workflow_plugins_to_install')
+    op.drop_column('blueprints', 'deployment_plugins_to_install')
+
+    for column in ('id', 'install_method', 'node_id', 'deployment_id',
+                   '_node_instance_fk', '_tenant_id'):
+        op.drop_index(op.f('agents_{0}_idx'.format(column)),
+                      table_name='agents')
+    op.drop_table('agents')
+
+    op.drop_column('plugins', 'yaml_file_name')
+    op.drop_index(op.f('snapshots_base_snapshot_id_idx'),
+                  table_name='snapshots')
+    op.drop_column('snapshots', 'base_snapshot_id')
+    op.drop_index(op.f('blueprints_plan_digest_idx'),
+                  table_name='blueprints')
+    op.drop_column('blueprints', 'plan_digest')
+
+    # Blueprints that weren't parsed can't be kept without a plan
+    op.execute(blueprints.delete().where(blueprints.c.plan.is_(None)))
+    op.alter_column('blueprints', 'plan', nullable=False)
+    op.drop_column('blueprints', 'state')
+    op.drop_column('blueprints', 'error')
+    blueprint_upload_state.drop(op.get_bind())
 
     # remove the 'queued' value of the execution status enum.
     # Since we are downgrading, and in older versions the `queue` option does
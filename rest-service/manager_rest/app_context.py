@@ -14,8 +14,12 @@
 #  * limitations under the License.
 
 import os
-import glob
-from flask import current_app
+import json
+import hashlib
+from collections import namedtuple, OrderedDict
+from flask import current_app, has_request_context, request
+from flask_security import current_user
+from sqlalchemy import case, func
 from urlparse import parse_qs
 from distutils.version import LooseVersion
 
@@ -26,13 +30,24 @@ from dsl_parser.import_resolver.default_import_resolver import (
 )
 
 from manager_rest import config
-from manager_rest.storage import get_storage_manager
+from manager_rest.storage import db, get_storage_manager
 from manager_rest.constants import (
     PROVIDER_CONTEXT_ID,
     FILE_SERVER_PLUGINS_FOLDER
 )
 from manager_rest.manager_exceptions import InvalidPluginError
 from manager_rest.storage.models import ProviderContext, Plugin
+from manager_rest.storage.models_states import VisibilityState
+
+PLUGIN_CATALOG_FIELDS = ['id',
+                         'package_name',
+                         'package_version',
+                         'distribution',
+                         'yaml_file_name']
+PluginCatalogEntry = namedtuple('PluginCatalogEntry', PLUGIN_CATALOG_FIELDS)
+# How many (tenant, user) plugin catalogs are cached, least recently used
+# ones are dropped first
+MAX_CACHED_PLUGIN_CATALOGS = 100
 
 
 def get_parser_context(sm=None):
@@ -45,8 +60,32 @@ def get_parser_context(sm=None):
     return current_app.parser_context
 
 
+def get_parser_context_fingerprint(sm=None):
+    """A digest of the settings the current parser context was created
+    from, or None if the parser context was replaced directly
+    """
+    parser_context = get_parser_context(sm)
+    fingerprinted_context, fingerprint = getattr(
+        current_app, 'parser_context_fingerprint', (None, None))
+    if fingerprinted_context is not parser_context:
+        return None
+    return fingerprint
+
+
 def update_parser_context(context):
     current_app.parser_context = _extract_parser_context(context)
+    current_app.parser_context_fingerprint = (
+        current_app.parser_context, _parser_context_fingerprint(context))
+
+
+def _parser_context_fingerprint(context):
+    cloudify_section = (context or {}).get(constants.CLOUDIFY, {})
+    settings = {
+        'resolver': cloudify_section.get(constants.IMPORT_RESOLVER_KEY),
+        'validate_version': cloudify_section.get(
+            constants.VALIDATE_DEFINITIONS_VERSION, True)
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True)).hexdigest()
 
 
 def _extract_parser_context(context):
@@ -64,6 +103,104 @@ def _extract_parser_context(context):
     }
 
 
+class PluginCatalog(object):
+    """An index of the plugins available to the current user, by package
+    name, with each package's plugins sorted from the newest version
+    """
+
+    def __init__(self, plugins):
+        self.plugins = sorted(plugins)
+        self._by_name = {}
+        for plugin in self.plugins:
+            self._by_name.setdefault(plugin.package_name, []).append(plugin)
+        for versions in self._by_name.values():
+            versions.sort(key=lambda p: LooseVersion(p.package_version),
+                          reverse=True)
+
+    def find(self, name, filters):
+        """Return the newest plugin of package `name` matching `filters`,
+        or None
+
+        :param filters: A dict of plugin fields to lists of allowed values
+        """
+        for plugin in self._by_name.get(name, []):
+            if all(getattr(plugin, field) in values
+                   for field, values in filters.items()):
+                return plugin
+        return None
+
+    @staticmethod
+    def yaml_url(plugin):
+        if not plugin.yaml_file_name:
+            raise InvalidPluginError(
+                'Plugin {0}: no yaml file was uploaded with the plugin'
+                .format(plugin.package_name))
+        return 'file://{0}'.format(os.path.join(
+            config.instance.file_server_root,
+            FILE_SERVER_PLUGINS_FOLDER,
+            plugin.id,
+            plugin.yaml_file_name))
+
+
+def get_plugin_catalog(sm=None):
+    """Return the plugin catalog of the current user in the current tenant
+
+    In requests, catalogs are cached in the app (for the most recently used
+    users and tenants), and checked against a cheap summary of the plugins
+    table at most once per request, so that plugins uploaded, deleted or
+    made visible by other processes aren't missed. Outside of requests
+    there's no user to cache the catalog for, so it's built every time.
+    """
+    sm = sm or get_storage_manager()
+    if not has_request_context():
+        return _build_plugin_catalog(sm)
+    if hasattr(request, 'plugin_catalog'):
+        return request.plugin_catalog
+    tenant = sm.current_tenant
+    key = (tenant.id if tenant else None, getattr(current_user, 'id', None))
+    if not hasattr(current_app, 'plugin_catalogs'):
+        current_app.plugin_catalogs = OrderedDict()
+    catalogs = current_app.plugin_catalogs
+    stamp = _plugins_stamp()
+    cached_stamp, catalog = catalogs.pop(key, (None, None))
+    if catalog is None or cached_stamp != stamp:
+        catalog = _build_plugin_catalog(sm)
+    catalogs[key] = (stamp, catalog)
+    while len(catalogs) > MAX_CACHED_PLUGIN_CATALOGS:
+        catalogs.popitem(last=False)
+    request.plugin_catalog = catalog
+    return catalog
+
+
+def _build_plugin_catalog(sm):
+    plugins = sm.list(Plugin,
+                      include=PLUGIN_CATALOG_FIELDS,
+                      get_all_results=True)
+    return PluginCatalog(
+        PluginCatalogEntry(*[getattr(plugin, field)
+                             for field in PLUGIN_CATALOG_FIELDS])
+        for plugin in plugins)
+
+
+def invalidate_plugin_catalogs():
+    """Drop the cached plugin catalogs, after plugins were changed"""
+    current_app.plugin_catalogs = OrderedDict()
+    if has_request_context() and hasattr(request, 'plugin_catalog'):
+        del request.plugin_catalog
+
+
+def _plugins_stamp():
+    """Summarize the plugins table, so that any upload, deletion or change
+    of visibility changes the summary (visibility can only be widened)
+    """
+    return db.session.query(
+        func.count(Plugin._storage_id),
+        func.max(Plugin._storage_id),
+        func.count(case([(Plugin.visibility == VisibilityState.PRIVATE, 1)])),
+        func.count(case([(Plugin.visibility == VisibilityState.GLOBAL, 1)]))
+    ).one()
+
+
 class ResolverWithPlugins(DefaultImportResolver):
     """A resolver which translates plugin-style urls to file:// urls.
 
@@ -110,30 +247,10 @@ class ResolverWithPlugins(DefaultImportResolver):
     def _resolve_plugin_yaml_url(self, import_url):
         plugin_spec = import_url.replace(self.PREFIX, '', 1).strip()
         name, plugin_filters = self._make_plugin_filters(plugin_spec)
-        plugin = self._find_plugin(name, plugin_filters)
-        return self._make_plugin_yaml_url(plugin)
-
-    def _find_plugin(self, name, filters):
-        filters['package_name'] = name
-        sm = get_storage_manager()
-        plugins = sm.list(Plugin, filters=filters)
-        if not plugins:
-            version_message = ' (query: {0})'.format(filters) \
-                if filters else ''
-            raise InvalidPluginError(
-                'Plugin {0}{1} not found'.format(name, version_message))
-        return max(plugins,
-                   key=lambda plugin: LooseVersion(plugin.package_version))
-
-    def _make_plugin_yaml_url(self, plugin):
-        plugin_path = os.path.join(
-            config.instance.file_server_root,
-            FILE_SERVER_PLUGINS_FOLDER,
-            plugin.id)
-        yaml_files = glob.glob(os.path.join(plugin_path, '*.yaml'))
-        if len(yaml_files) != 1:
-            raise InvalidPluginError(
-                'Plugin {0}: expected one yaml file, but found {1}'
-                .format(plugin.package_name, len(yaml_files)))
-        filename = os.path.join(plugin_path, yaml_files[0])
-        return 'file://{0}'.format(filename)
+        catalog = get_plugin_catalog()
+        plugin = catalog.find(name, plugin_filters)
+        if plugin is None:
+            plugin_filters['package_name'] = name
+            raise InvalidPluginError('Plugin {0} (query: {1}) not found'
+                                     .format(name, plugin_filters))
+        return catalog.yaml_url(plugin)
@@ -49,6 +49,8 @@ class Config(object):
         self.insecure_endpoints_disabled = True
         self.max_results = 1000
         self.min_available_memory_mb = None
+        # 0 means uploaded archives aren't limited in size
+        self.max_upload_size_mb = 0
 
         self.security_hash_salt = None
         self.security_secret_key = None
@@ -441,19 +441,16 @@ class DeploymentUpdateNodeHandler(UpdateHandler):
             ENTITY_TYPES.PLUGIN: PluginHandler()
         }
 
-    def handle(self, dep_update):
+    def handle(self, dep_update, current_nodes):
         """handles updating new and extended nodes onto the storage.
 
         :param dep_update: deployment update object
+        :param current_nodes: the deployment's nodes, as dicts, before the
+        update. They're copied, and not modified
         :return: a list of all of the nodes
         (including the non add_node.modification nodes)
         """
-        current_nodes = self.sm.list(
-            models.Node,
-            filters={'deployment_id': dep_update.deployment_id}
-        )
-        nodes_dict = {node.id: deepcopy(node.to_dict())
-                      for node in current_nodes}
+        nodes_dict = {node['id']: deepcopy(node) for node in current_nodes}
         modified_entities = deployment_update_utils.ModifiedEntitiesDict()
 
         self._fill_modified_entities(
@@ -473,23 +470,24 @@ class DeploymentUpdateNodeHandler(UpdateHandler):
             NODE_MOD_TYPES.REMOVED_AND_RELATED]
         removed_node_instances = removed_and_related.get(
             NODE_MOD_TYPES.AFFECTED, [])
-        removed_node_ids = deployment_update_utils.extract_ids(
-            removed_node_instances, 'node_id')
+        removed_node_ids = set(deployment_update_utils.extract_ids(
+            removed_node_instances, 'node_id'))
 
         # Since not all changes are caught on the node instances (actually only
         # the removing/adding of relationships and nodes) we need to apply all
         # of the changes, thus screening all of the nodes except the ones
         # deleted is a valid solution.
-        modified_nodes = [n for n in dep_update.deployment_update_nodes
-                          if n['id'] not in removed_node_ids]
-        for modified_node in modified_nodes:
+        modified_nodes = {n['id']: n
+                          for n in dep_update.deployment_update_nodes
+                          if n['id'] not in removed_node_ids}
+        for node in self._list_nodes(dep_update.deployment_id,
+                                     modified_nodes.keys()):
+            modified_node = modified_nodes[node.id]
             # Any relationship deleted or inserted to a new index could create
             # 'None' relationships, in this final phase we remove those (if by
             # some reason any left).
             modified_node['relationships'] = \
                 [r for r in modified_node['relationships'] if r]
-            node = get_node(modified_node['deployment_id'],
-                            modified_node['id'])
             node.number_of_instances = modified_node['number_of_instances']
             node.planned_number_of_instances = modified_node[
                 'planned_number_of_instances']
@@ -499,11 +497,19 @@ class DeploymentUpdateNodeHandler(UpdateHandler):
             node.properties = modified_node['properties']
             self.sm.update(node)
 
-        for removed_node_instance in removed_node_instances:
-            node = get_node(dep_update.deployment_id,
-                            removed_node_instance['node_id'])
+        for node in self._list_nodes(dep_update.deployment_id,
+                                     removed_node_ids):
             self.sm.delete(node)
 
+    def _list_nodes(self, deployment_id, node_ids):
+        if not node_ids:
+            return []
+        return self.sm.list(
+            models.Node,
+            filters={'deployment_id': deployment_id, 'id': list(node_ids)},
+            get_all_results=True
+        )
+
 
 class DeploymentUpdateNodeInstanceHandler(UpdateHandler):
     def __init__(self):
@@ -658,10 +664,14 @@ class DeploymentUpdateNodeInstanceHandler(UpdateHandler):
         self._reduce_node_instances(reduced_node_instances,
                                     extended_node_instances)
 
-        for removed_node_instance in removed_node_instances:
-            node_instance = self.sm.get(models.NodeInstance,
-                                        removed_node_instance['id'])
-            self.sm.delete(node_instance)
+        removed_instance_ids = deployment_update_utils.extract_ids(
+            removed_node_instances)
+        if removed_instance_ids:
+            for node_instance in self.sm.list(
+                    models.NodeInstance,
+                    filters={'id': removed_instance_ids},
+                    get_all_results=True):
+                self.sm.delete(node_instance)
 
     def _reduce_node_instances(self,
                                reduced_node_instances,
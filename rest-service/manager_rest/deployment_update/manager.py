@@ -187,36 +187,42 @@ class DeploymentUpdateManager(object):
         dep_update.state = STATES.UPDATING
         self.sm.update(dep_update)
 
-        # Handle any deployment related changes. i.e. workflows and deployments
-        modified_deployment_entities, raw_updated_deployment = \
-            self._deployment_handler.handle(dep_update)
-
-        # Retrieve previous_nodes
-        previous_nodes = [node.to_dict() for node in self.sm.list(
-            models.Node, filters={'deployment_id': dep_update.deployment_id})]
-
-        # Update the nodes on the storage
-        modified_entity_ids, depup_nodes = self._node_handler.handle(
-            dep_update)
-
-        # Extract changes from raw nodes
-        node_instance_changes = self._extract_changes(dep_update,
-                                                      depup_nodes,
-                                                      previous_nodes)
-
-        # Create (and update for adding step type) node instances
-        # according to the changes in raw_nodes
-        depup_node_instances = self._node_instance_handler.handle(
-            dep_update, node_instance_changes)
-
-        # Saving the needed changes back to the storage manager for future use
-        # (removing entities).
-        dep_update.deployment_update_deployment = raw_updated_deployment
-        dep_update.deployment_update_nodes = depup_nodes
-        dep_update.deployment_update_node_instances = depup_node_instances
-        dep_update.modified_entity_ids = modified_entity_ids.to_dict(
-            include_rel_order=True)
-        self.sm.update(dep_update)
+        # The changes of all the steps are applied in a single transaction,
+        # so either all of them are stored, or none of them
+        with self.sm.transaction():
+            # Handle any deployment related changes. i.e. workflows and
+            # deployments
+            modified_deployment_entities, raw_updated_deployment = \
+                self._deployment_handler.handle(dep_update)
+
+            # Retrieve previous_nodes
+            previous_nodes = [node.to_dict() for node in self.sm.list(
+                models.Node,
+                filters={'deployment_id': dep_update.deployment_id},
+                get_all_results=True)]
+
+            # Update the nodes on the storage
+            modified_entity_ids, depup_nodes = self._node_handler.handle(
+                dep_update, previous_nodes)
+
+            # Extract changes from raw nodes
+            node_instance_changes = self._extract_changes(dep_update,
+                                                          depup_nodes,
+                                                          previous_nodes)
+
+            # Create (and update for adding step type) node instances
+            # according to the changes in raw_nodes
+            depup_node_instances = self._node_instance_handler.handle(
+                dep_update, node_instance_changes)
+
+            # Saving the needed changes back to the storage manager for
+            # future use (removing entities).
+            dep_update.deployment_update_deployment = raw_updated_deployment
+            dep_update.deployment_update_nodes = depup_nodes
+            dep_update.deployment_update_node_instances = depup_node_instances
+            dep_update.modified_entity_ids = modified_entity_ids.to_dict(
+                include_rel_order=True)
+            self.sm.update(dep_update)
 
         # Execute the default 'update' workflow or a custom workflow using
         # added and related instances. Any workflow executed should call
@@ -306,7 +312,8 @@ class DeploymentUpdateManager(object):
         # By this point the node_instances aren't updated yet
         previous_node_instances = [instance.to_dict() for instance in
                                    self.sm.list(models.NodeInstance,
-                                                filters=deployment_id_filter)]
+                                                filters=deployment_id_filter,
+                                                get_all_results=True)]
 
         # extract all the None relationships from the deployment update nodes
         # in order to use in the extract changes
@@ -328,10 +335,10 @@ class DeploymentUpdateManager(object):
 
     @staticmethod
     def _patch_changes_with_relationship_index(raw_node_instances, raw_nodes):
+        raw_nodes_by_id = {n['id']: n for n in raw_nodes}
         for raw_node_instance in (i for i in raw_node_instances
                                   if 'modification' in i):
-            raw_node = next(n for n in raw_nodes
-                            if n['id'] == raw_node_instance['node_id'])
+            raw_node = raw_nodes_by_id[raw_node_instance['node_id']]
             for relationship in raw_node_instance['relationships']:
                 target_node_id = relationship['target_name']
                 rel_index = next(i for i, d
@@ -500,15 +507,16 @@ class DeploymentUpdateManager(object):
         dep_update.state = STATES.FINALIZING
         self.sm.update(dep_update)
 
-        # The order of these matter
-        for finalize in [self._deployment_handler.finalize,
-                         self._node_instance_handler.finalize,
-                         self._node_handler.finalize]:
-            finalize(dep_update)
+        with self.sm.transaction():
+            # The order of these matter
+            for finalize in [self._deployment_handler.finalize,
+                             self._node_instance_handler.finalize,
+                             self._node_handler.finalize]:
+                finalize(dep_update)
 
-        # mark deployment update as successful
-        dep_update.state = STATES.SUCCESSFUL
-        self.sm.update(dep_update)
+            # mark deployment update as successful
+            dep_update.state = STATES.SUCCESSFUL
+            self.sm.update(dep_update)
         return dep_update
 
     def _execute_workflow(self,
@@ -20,6 +20,7 @@ import networkx as nx
 import manager_rest.resource_manager
 
 from manager_rest.storage import get_storage_manager, models
+from manager_rest.deployment_update.utils import index_relationships
 
 
 RELEVANT_DEPLOYMENT_FIELDS = ['blueprint_id', 'id', 'inputs', 'nodes',
@@ -28,6 +29,11 @@ RELEVANT_DEPLOYMENT_FIELDS = ['blueprint_id', 'id', 'inputs', 'nodes',
                               'deployment_plugins_to_install',
                               'workflow_plugins_to_install']
 
+# The node fields that are compared when extracting steps
+RELEVANT_NODE_FIELDS = ['id', 'type', 'type_hierarchy', 'host_id',
+                        'properties', 'operations', 'relationships',
+                        'plugins', 'plugins_to_install']
+
 DEFAULT_TOPOLOGY_LEVEL = 0
 NODE = 'node'
 NODES = 'nodes'
@@ -147,10 +153,13 @@ class DeploymentPlan(dict):
         workflow_plugins_to_install = \
             blueprint_plan['workflow_plugins_to_install']
 
-        # get the nodes from the storage
+        # get the nodes from the storage, only with the fields that are
+        # compared, so that the models don't need to be fully loaded
         nodes = sm.list(models.Node,
-                        filters={'deployment_id': [deployment_id]})
-        nodes = {node.id: node.to_dict() for node in nodes}
+                        include=list(RELEVANT_NODE_FIELDS),
+                        filters={'deployment_id': [deployment_id]},
+                        get_all_results=True)
+        nodes = {node.id: node._asdict() for node in nodes}
         return cls(deployment.to_dict(),
                    nodes,
                    deployment_plugins_to_install,
@@ -313,47 +322,46 @@ class StepExtractor(object):
         return supported_steps, unsupported_steps
 
     @staticmethod
-    def _extract_added_nodes_names(supported_steps):
-        add_node_steps = [step for step in supported_steps
-                          if step.action == 'add' and step.entity_type == NODE]
-        added_nodes_names = [step.entity_name for step in add_node_steps]
-        return added_nodes_names
-
-    def _create_added_nodes_graph(self, supported_steps):
+    def _extract_add_node_steps(supported_steps):
+        """Map the names of the added nodes to their 'add node' steps"""
+        add_node_steps = {}
+        for step in supported_steps:
+            if step.action == 'add' and step.entity_type == NODE:
+                add_node_steps.setdefault(step.entity_name, []).append(step)
+        return add_node_steps
+
+    def _create_added_nodes_graph(self, added_nodes_names):
         """ create a graph representing the added nodes and relationships
         involving them in the deployment update blueprint
 
         :rtype: nx.Digraph
         """
-        added_nodes_names = self._extract_added_nodes_names(supported_steps)
         added_nodes_graph = nx.DiGraph()
         added_nodes_graph.add_nodes_from(added_nodes_names)
         nodes = self.new_deployment_plan[NODES]
-        for node_name, node in nodes.iteritems():
-            if node_name in added_nodes_names:
-                for relationship in node[RELATIONSHIPS]:
-                    if relationship[TARGET_ID] in added_nodes_names:
-                        added_nodes_graph.add_edge(node_name,
-                                                   relationship[TARGET_ID])
+        for node_name in added_nodes_names:
+            for relationship in nodes[node_name][RELATIONSHIPS]:
+                if relationship[TARGET_ID] in added_nodes_names:
+                    added_nodes_graph.add_edge(node_name,
+                                               relationship[TARGET_ID])
         return added_nodes_graph
 
-    def _update_topology_order_of_add_node_steps(self,
-                                                 supported_steps,
+    @staticmethod
+    def _update_topology_order_of_add_node_steps(add_node_steps,
                                                  topologically_sorted_added_nodes):
         for i, node_name in enumerate(topologically_sorted_added_nodes):
-            # Get the corresponding 'add node' step for this node name,
-            # and assign it its topology_order order
-            for step in supported_steps:
-                if step.action == 'add' and step.entity_type == NODE \
-                        and step.entity_name == node_name:
-                    step.topology_order = i
+            # Assign the corresponding 'add node' step for this node name
+            # its topology_order order
+            for step in add_node_steps[node_name]:
+                step.topology_order = i
 
     def _sort_supported_steps(self, supported_steps):
-        added_nodes_graph = self._create_added_nodes_graph(supported_steps)
+        add_node_steps = self._extract_add_node_steps(supported_steps)
+        added_nodes_graph = self._create_added_nodes_graph(add_node_steps)
         topologically_sorted_added_nodes = nx.topological_sort(
             added_nodes_graph)
         self._update_topology_order_of_add_node_steps(
-            supported_steps, topologically_sorted_added_nodes)
+            add_node_steps, topologically_sorted_added_nodes)
         supported_steps.sort()
 
     def _extract_steps_from_description(self,
@@ -410,26 +418,24 @@ class StepExtractor(object):
         return None
 
     @staticmethod
-    def _get_matching_relationship(relationship, relationships):
-        r_type = relationship[TYPE]
-        target_id = relationship[TARGET_ID]
-        for rel_index, other_relationship in enumerate(relationships):
-            other_r_type = other_relationship[TYPE]
-            other_target_id = other_relationship[TARGET_ID]
-            if r_type == other_r_type and other_target_id == target_id:
-                return other_relationship, rel_index
-        return None, None
+    def _get_matching_relationship(relationship, relationships_index):
+        """Find the relationship of the same type and target in an index
+        built by `index_relationships`
+        """
+        return relationships_index.get(
+            (relationship[TYPE], relationship[TARGET_ID]), (None, None))
 
     def _extract_steps_from_relationships(self,
                                           relationships,
                                           old_relationships):
+        old_relationships_index = index_relationships(old_relationships)
         with self.entity_id_builder.extend_id(RELATIONSHIPS):
             for relationship_index, relationship in enumerate(relationships):
                 with self.entity_id_builder.extend_id(
                         '[{0}]'.format(relationship_index)):
                     matching_relationship, old_rel_index = \
-                        self._get_matching_relationship(relationship,
-                                                        old_relationships)
+                        self._get_matching_relationship(
+                            relationship, old_relationships_index)
                     if matching_relationship:
                         # relationship has been reordered to a different index
                         if old_rel_index != relationship_index:
@@ -1,7 +1,10 @@
 
 import copy
 
+from flask import request, has_request_context
+
 from constants import ENTITY_TYPES, PATH_SEPARATOR
+from manager_rest.storage import get_storage_manager, models
 
 
 def pluralize(input):
@@ -113,9 +116,70 @@ def get_entity_keys(entity_id):
     return entity_id.split(PATH_SEPARATOR)
 
 
+class NodesIndex(object):
+    """Nodes of a plan (or of a stored deployment), indexed by their id
+
+    The nodes are either raw plan nodes (dicts) or storage models.
+    When several nodes share an id, the first one is kept, like a scan of
+    the nodes list would find.
+    """
+    def __init__(self, nodes):
+        self._nodes = {}
+        for node in nodes:
+            node_id = node['id'] if isinstance(node, dict) else node.id
+            self._nodes.setdefault(node_id, node)
+
+    @classmethod
+    def from_plan(cls, plan):
+        return cls(plan.get('nodes', []))
+
+    @classmethod
+    def from_storage(cls, deployment_id):
+        """Load all the nodes of a deployment with a single query"""
+        nodes = get_storage_manager().list(
+            models.Node,
+            filters={'deployment_id': deployment_id},
+            get_all_results=True)
+        return cls(nodes)
+
+    def get(self, node_id, default=None):
+        return self._nodes.get(node_id, default)
+
+    def __contains__(self, node_id):
+        return node_id in self._nodes
+
+
+def get_plan_index(plan):
+    """Return the NodesIndex of a raw deployment plan
+
+    The index of the last plan looked up is kept on the current request,
+    so that the entity contexts, validators and handlers of a deployment
+    update all share a single index instead of scanning the plan.
+    Deployment update steps never add nodes to the plan itself, so the
+    index stays valid for as long as the plan object is in use.
+    """
+    if not has_request_context():
+        return NodesIndex.from_plan(plan)
+    cached = getattr(request, '_deployment_plan_index', None)
+    if cached is None or cached[0] is not plan:
+        cached = (plan, NodesIndex.from_plan(plan))
+        request._deployment_plan_index = cached
+    return cached[1]
+
+
 def get_raw_node(blueprint, node_id):
-    nodes = [n for n in blueprint.get('nodes', []) if n['id'] == node_id]
-    return nodes[0] if nodes else {}
+    return get_plan_index(blueprint).get(node_id, {})
+
+
+def index_relationships(relationships):
+    """Map the (type, target_id) of each relationship to the relationship
+    and its index in the list. The first matching relationship is kept.
+    """
+    relationships_index = {}
+    for index, relationship in enumerate(relationships):
+        key = (relationship['type'], relationship['target_id'])
+        relationships_index.setdefault(key, (relationship, index))
+    return relationships_index
 
 
 def check_is_int(s):
@@ -14,7 +14,7 @@
 #  * limitations under the License.
 
 from manager_rest.deployment_update import utils
-from manager_rest.storage import get_storage_manager, models, get_node
+from manager_rest.storage import get_storage_manager, models
 from manager_rest.manager_exceptions import UnknownModificationStageError
 from manager_rest.deployment_update.constants import ENTITY_TYPES, ACTION_TYPES
 
@@ -36,9 +36,9 @@ class EntityValidatorBase(object):
             ACTION_TYPES.REMOVE: self._validate_remove
         }
 
-    def validate(self, dep_update, step):
+    def validate(self, dep_update, step, storage_nodes):
         try:
-            self._validate_entity(dep_update, step)
+            self._validate_entity(dep_update, step, storage_nodes)
         except UnknownModificationStageError as e:
             entity_identifier_msg = \
                 "Entity type {0} with entity id {1}".format(step.entity_type,
@@ -46,7 +46,7 @@ class EntityValidatorBase(object):
             err_msg = "{0}: {1}".format(entity_identifier_msg, e.message)
             raise UnknownModificationStageError(err_msg)
 
-    def _validate_entity(self, dep_update, step):
+    def _validate_entity(self, dep_update, step, storage_nodes):
         raise NotImplementedError
 
     def _in_old(self, *args, **kwargs):
@@ -74,13 +74,14 @@ class EntityValidatorBase(object):
                 "The entity either exists in the deployment update blueprint "
                 "or doesn't exists in the original deployment blueprint")
 
-    def _get_storage_node(self, deployment_id, node_id):
-        node = get_node(deployment_id, node_id)
+    @staticmethod
+    def _get_storage_node(storage_nodes, node_id):
+        node = storage_nodes.get(node_id)
         return node.to_dict() if node else {}
 
 
 class NodeValidator(EntityValidatorBase):
-    def _validate_entity(self, dep_update, step):
+    def _validate_entity(self, dep_update, step, storage_nodes):
         entity_keys = utils.get_entity_keys(step.entity_id)
         if len(entity_keys) != NODE_ENTITY_LEN:
             return
@@ -89,20 +90,19 @@ class NodeValidator(EntityValidatorBase):
         return validate(step.entity_id,
                         step.entity_type,
                         dep_update=dep_update,
+                        storage_nodes=storage_nodes,
                         node_id=node_id)
 
-    def _in_old(self, dep_update, node_id):
-        storage_node = self._get_storage_node(dep_update.deployment_id,
-                                              node_id)
-        return bool(storage_node)
+    def _in_old(self, dep_update, storage_nodes, node_id):
+        return node_id in storage_nodes
 
-    def _in_new(self, dep_update, node_id):
+    def _in_new(self, dep_update, storage_nodes, node_id):
         raw_node = utils.get_raw_node(dep_update.deployment_plan, node_id)
         return bool(raw_node)
 
 
 class RelationshipValidator(EntityValidatorBase):
-    def _validate_entity(self, dep_update, step):
+    def _validate_entity(self, dep_update, step, storage_nodes):
         entity_keys = utils.get_entity_keys(step.entity_id)
         if len(entity_keys) < RELATIONSHIP_ENTITY_LEN:
             return
@@ -122,6 +122,7 @@ class RelationshipValidator(EntityValidatorBase):
         return validate(step.entity_id,
                         step.entity_type,
                         dep_update=dep_update,
+                        storage_nodes=storage_nodes,
                         source_node_id=source_node_id,
                         relationships=relationships,
                         source_relationship_index=source_relationship_index,
@@ -129,6 +130,7 @@ class RelationshipValidator(EntityValidatorBase):
 
     def _in_new(self,
                 dep_update,
+                storage_nodes,
                 source_node_id,
                 relationships,
                 source_relationship_index,
@@ -146,24 +148,24 @@ class RelationshipValidator(EntityValidatorBase):
 
     def _in_old(self,
                 dep_update,
+                storage_nodes,
                 source_node_id,
                 relationships,
                 source_relationship_index,
                 target_relationship_index):
-        source_node = self._get_storage_node(dep_update.deployment_id,
-                                             source_node_id)
+        source_node = self._get_storage_node(storage_nodes, source_node_id)
         if not (source_node and
                 len(source_node[relationships]) > target_relationship_index):
             return
         target_node_id = \
             source_node[relationships][target_relationship_index]['target_id']
-        storage_target_node = self._get_storage_node(dep_update.deployment_id,
+        storage_target_node = self._get_storage_node(storage_nodes,
                                                      target_node_id)
         return storage_target_node
 
 
 class PropertyValidator(EntityValidatorBase):
-    def _validate_entity(self, dep_update, step):
+    def _validate_entity(self, dep_update, step, storage_nodes):
         property_keys = utils.get_entity_keys(step.entity_id)
         if len(property_keys) < PROPERTY_ENTITY_LEN:
             return
@@ -173,22 +175,22 @@ class PropertyValidator(EntityValidatorBase):
         return validate(step.entity_id,
                         step.entity_type,
                         dep_update=dep_update,
+                        storage_nodes=storage_nodes,
                         node_id=node_id,
                         property_id=property_id)
 
     @staticmethod
-    def _in_new(dep_update, node_id, property_id):
+    def _in_new(dep_update, storage_nodes, node_id, property_id):
         raw_node = utils.get_raw_node(dep_update.deployment_plan, node_id)
         return utils.traverse_object(raw_node, property_id) is not None
 
-    def _in_old(self, dep_update, node_id, property_id):
-        storage_node = self._get_storage_node(dep_update.deployment_id,
-                                              node_id)
+    def _in_old(self, dep_update, storage_nodes, node_id, property_id):
+        storage_node = self._get_storage_node(storage_nodes, node_id)
         return utils.traverse_object(storage_node, property_id) is not None
 
 
 class OperationValidator(EntityValidatorBase):
-    def _validate_entity(self, dep_update, step):
+    def _validate_entity(self, dep_update, step, storage_nodes):
         operation_keys = utils.get_entity_keys(step.entity_id)
         if len(operation_keys) < OPERATION_ENTITY_LEN:
             return
@@ -198,21 +200,21 @@ class OperationValidator(EntityValidatorBase):
         return validate(step.entity_id,
                         step.entity_type,
                         dep_update=dep_update,
+                        storage_nodes=storage_nodes,
                         node_id=node_id,
                         operation_id=operation_id)
 
-    def _in_new(self, dep_update, node_id, operation_id):
+    def _in_new(self, dep_update, storage_nodes, node_id, operation_id):
         raw_node = utils.get_raw_node(dep_update.deployment_plan, node_id)
         return utils.traverse_object(raw_node, operation_id) is not None
 
-    def _in_old(self, dep_update, node_id, operation_id):
-        storage_node = self._get_storage_node(dep_update.deployment_id,
-                                              node_id)
+    def _in_old(self, dep_update, storage_nodes, node_id, operation_id):
+        storage_node = self._get_storage_node(storage_nodes, node_id)
         return utils.traverse_object(storage_node, operation_id) is not None
 
 
 class WorkflowValidator(EntityValidatorBase):
-    def _validate_entity(self, dep_update, step):
+    def _validate_entity(self, dep_update, step, storage_nodes):
         workflow_keys = utils.get_entity_keys(step.entity_id)
         if len(workflow_keys) < WORKFLOW_ENTITY_LEN:
             return
@@ -238,7 +240,7 @@ class WorkflowValidator(EntityValidatorBase):
 
 
 class OutputValidator(EntityValidatorBase):
-    def _validate_entity(self, dep_update, step):
+    def _validate_entity(self, dep_update, step, storage_nodes):
         output_keys = utils.get_entity_keys(step.entity_id)
         if len(output_keys) < OUTPUT_ENTITY_LEN:
             return
@@ -263,7 +265,7 @@ class OutputValidator(EntityValidatorBase):
 
 
 class DescriptionValidator(EntityValidatorBase):
-    def _validate_entity(self, dep_update, step):
+    def _validate_entity(self, dep_update, step, storage_nodes):
         description_key = step.entity_id
         validate = self._validation_mapper[step.action]
         return validate(step.entity_id,
@@ -293,14 +295,28 @@ class StepValidator(object):
             ENTITY_TYPES.DESCRIPTION: DescriptionValidator()
         }
 
-    def validate(self, dep_update, step):
+    def validate(self, dep_update, step, storage_nodes=None):
         """
         validate an entity id of provided type exists in provided blueprint.
         raises error if id doesn't exist
         :param dep_update: the deployment update object.
         :param step: the deployment update step object
+        :param storage_nodes: a NodesIndex of the deployment's stored nodes.
+        loaded from storage if not passed
         :return: None
         """
         if step.entity_type in ENTITY_TYPES:
+            if storage_nodes is None:
+                storage_nodes = utils.NodesIndex.from_storage(
+                    dep_update.deployment_id)
             self._validation_mapper[step.entity_type].validate(dep_update,
-                                                               step)
+                                                               step,
+                                                               storage_nodes)
+
+    def validate_steps(self, dep_update, steps):
+        """Validate all the steps of a deployment update, loading the
+        deployment's stored nodes only once
+        """
+        storage_nodes = utils.NodesIndex.from_storage(dep_update.deployment_id)
+        for step in steps:
+            self.validate(dep_update, step, storage_nodes)
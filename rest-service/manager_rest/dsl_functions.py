@@ -13,7 +13,7 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from dsl_parser import functions
 from dsl_parser import exceptions as parser_exceptions
@@ -21,8 +21,12 @@ from dsl_parser import exceptions as parser_exceptions
 from manager_rest import cryptography_utils
 from manager_rest.storage import get_storage_manager
 from manager_rest.storage import get_node as get_storage_node
-from manager_rest.storage.models import NodeInstance, Deployment, Secret
+from manager_rest.storage.models import (Node,
+                                         NodeInstance,
+                                         Deployment,
+                                         Secret)
 from manager_rest.manager_exceptions import (
+    NotFoundError,
     FunctionsEvaluationError,
     DeploymentOutputsEvaluationError
 )
@@ -30,11 +34,138 @@ from manager_rest.manager_exceptions import (
 SecretType = namedtuple('Secret', 'key value')
 
 
-def evaluate_intrinsic_functions(payload, deployment_id, context=None):
+class EvaluationContext(object):
+    """Serve the storage callbacks used for evaluating intrinsic functions
+
+    Every lookup is memoized, and secrets are decrypted once per key.
+    When evaluating many payloads together, `prefetch` the deployments
+    first: their nodes and node instances are then loaded with a single
+    query each, and served from memory. Use a context for one evaluation,
+    or for a batch of evaluations done together: it doesn't see changes
+    made to the storage after loading.
+    """
+    def __init__(self, storage_manager=None):
+        self.sm = storage_manager or get_storage_manager()
+        # nodes and node instances of prefetched deployments, by deployment
+        self._nodes = {}
+        self._node_instances = {}
+        # single lookups, for deployments that weren't prefetched
+        self._node_lookups = {}
+        self._node_instance_lookups = {}
+        self._node_instances_lookups = {}
+        self._secrets = {}
+
+    def prefetch(self, deployment_ids):
+        """Load the nodes and node instances of all the deployments at once,
+        instead of with a query per deployment
+        """
+        deployment_ids = [deployment_id for deployment_id in
+                          set(deployment_ids)
+                          if deployment_id not in self._node_instances]
+        if not deployment_ids:
+            return
+        nodes = self.sm.list(Node,
+                             filters={'deployment_id': deployment_ids},
+                             get_all_results=True)
+        node_instances = self.sm.list(
+            NodeInstance,
+            filters={'deployment_id': deployment_ids},
+            get_all_results=True)
+        for deployment_id in deployment_ids:
+            self._nodes[deployment_id] = OrderedDict()
+            self._node_instances[deployment_id] = OrderedDict()
+        for node in nodes:
+            self._nodes[node.deployment_id][node.id] = node
+        for instance in node_instances:
+            self._node_instances[instance.deployment_id][instance.id] = \
+                instance
+
+    def get_node_instances(self, deployment_id, node_id=None):
+        if deployment_id in self._node_instances:
+            instances = self._node_instances[deployment_id].values()
+            if node_id:
+                instances = [instance for instance in instances
+                             if instance.node_id == node_id]
+            return instances
+        key = (deployment_id, node_id)
+        if key not in self._node_instances_lookups:
+            filters = dict(deployment_id=deployment_id)
+            if node_id:
+                filters['node_id'] = node_id
+            self._node_instances_lookups[key] = self.sm.list(
+                NodeInstance, filters=filters, get_all_results=True).items
+        return self._node_instances_lookups[key]
+
+    def get_node_instance(self, deployment_id, node_instance_id):
+        instance = self._node_instances.get(deployment_id, {}).get(
+            node_instance_id)
+        if instance is not None:
+            return instance
+        # Not prefetched, or not an instance of this deployment - look it
+        # up directly
+        if node_instance_id not in self._node_instance_lookups:
+            self._node_instance_lookups[node_instance_id] = self.sm.get(
+                NodeInstance, node_instance_id)
+        return self._node_instance_lookups[node_instance_id]
+
+    def get_node(self, deployment_id, node_id):
+        if deployment_id in self._nodes:
+            node = self._nodes[deployment_id].get(node_id)
+            if node is None:
+                raise NotFoundError(
+                    'Requested Node with ID `{0}` on Deployment `{1}` '
+                    'was not found'.format(node_id, deployment_id)
+                )
+            return node
+        key = (deployment_id, node_id)
+        if key not in self._node_lookups:
+            self._node_lookups[key] = get_storage_node(deployment_id, node_id)
+        return self._node_lookups[key]
+
+    def get_secret(self, secret_key):
+        if secret_key not in self._secrets:
+            secret = self.sm.get(Secret, secret_key)
+            decrypted_value = cryptography_utils.decrypt(secret.value)
+            self._secrets[secret_key] = SecretType(secret_key,
+                                                   decrypted_value)
+        return self._secrets[secret_key]
+
+    def get_methods(self, deployment_id):
+        """Retrieve a dict of all the callbacks necessary for function
+        evaluation in the deployment
+        """
+        def get_node_instances(node_id=None):
+            return self.get_node_instances(deployment_id, node_id)
+
+        def get_node_instance(node_instance_id):
+            return self.get_node_instance(deployment_id, node_instance_id)
+
+        def get_node(node_id):
+            return self.get_node(deployment_id, node_id)
+
+        return dict(
+            get_node_instances_method=get_node_instances,
+            get_node_instance_method=get_node_instance,
+            get_node_method=get_node,
+            get_secret_method=self.get_secret
+        )
+
+
+def evaluate_intrinsic_functions(payload,
+                                 deployment_id,
+                                 context=None,
+                                 evaluation_context=None):
+    """Evaluate the intrinsic functions in `payload`
+
+    :param evaluation_context: an EvaluationContext to serve the storage
+    callbacks from. Pass the same one when evaluating several payloads
+    together, so that the storage is only queried once
+    """
     context = context or {}
     sm = get_storage_manager()
     sm.get(Deployment, deployment_id, include=['id'])
-    methods = _get_methods(deployment_id, sm)
+    evaluation_context = evaluation_context or EvaluationContext(sm)
+    methods = evaluation_context.get_methods(deployment_id)
 
     try:
         return functions.evaluate_functions(
@@ -45,14 +176,49 @@ def evaluate_intrinsic_functions(payload, deployment_id, context=None):
         raise FunctionsEvaluationError(str(e))
 
 
-def evaluate_deployment_outputs(deployment_id):
+def evaluate_deployment_outputs(deployment_id, evaluation_context=None):
     sm = get_storage_manager()
     deployment = sm.get(Deployment, deployment_id, include=['outputs'])
-    methods = _get_methods(deployment_id, sm)
+    evaluation_context = evaluation_context or EvaluationContext(sm)
+    return _evaluate_outputs(deployment_id,
+                             deployment.outputs,
+                             evaluation_context)
+
+
+def evaluate_deployments_outputs(deployment_ids):
+    """Evaluate the outputs of several deployments together
+
+    The deployments, and all of their nodes and node instances, are loaded
+    with a query each, so the number of queries doesn't depend on the
+    number of deployments.
 
+    :return: A dict of the evaluated outputs, by deployment id
+    """
+    sm = get_storage_manager()
+    deployment_ids = set(deployment_ids)
+    deployments = sm.list(Deployment,
+                          include=['id', 'outputs'],
+                          filters={'id': list(deployment_ids)},
+                          get_all_results=True)
+    missing_ids = deployment_ids - {d.id for d in deployments}
+    if missing_ids:
+        raise NotFoundError(
+            'Requested `Deployment` with ID(s) `{0}` was not found'
+            .format(', '.join(sorted(missing_ids)))
+        )
+    evaluation_context = EvaluationContext(sm)
+    evaluation_context.prefetch(deployment_ids)
+    return {deployment.id: _evaluate_outputs(deployment.id,
+                                             deployment.outputs,
+                                             evaluation_context)
+            for deployment in deployments}
+
+
+def _evaluate_outputs(deployment_id, outputs, evaluation_context):
+    methods = evaluation_context.get_methods(deployment_id)
     try:
         return functions.evaluate_outputs(
-            outputs_def=deployment.outputs,
+            outputs_def=outputs,
             **methods
             )
     except parser_exceptions.FunctionEvaluationError, e:
@@ -60,34 +226,4 @@ def evaluate_deployment_outputs(deployment_id):
 
 
 def get_secret_method():
-    sm = get_storage_manager()
-    methods = _get_methods(None, sm)
-    return methods['get_secret_method']
-
-
-def _get_methods(deployment_id, storage_manager):
-    """Retrieve a dict of all the callbacks necessary for function evaluation
-    """
-    def get_node_instances(node_id=None):
-        filters = dict(deployment_id=deployment_id)
-        if node_id:
-            filters['node_id'] = node_id
-        return storage_manager.list(NodeInstance, filters=filters).items
-
-    def get_node_instance(node_instance_id):
-        return storage_manager.get(NodeInstance, node_instance_id)
-
-    def get_node(node_id):
-        return get_storage_node(deployment_id, node_id)
-
-    def get_secret(secret_key):
-        secret = storage_manager.get(Secret, secret_key)
-        decrypted_value = cryptography_utils.decrypt(secret.value)
-        return SecretType(secret_key, decrypted_value)
-
-    return dict(
-        get_node_instances_method=get_node_instances,
-        get_node_instance_method=get_node_instance,
-        get_node_method=get_node,
-        get_secret_method=get_secret
-    )
+    return EvaluationContext().get_secret
@@ -0,0 +1,138 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+from sqlalchemy import and_, exists, or_ as sql_or
+from sqlalchemy.orm import aliased
+
+from manager_rest.storage import db, models
+from manager_rest.storage.models_states import ExecutionState
+
+
+class ExecutionScheduler(object):
+    """Decide which executions may run, and dequeue queued executions.
+
+    All the queries here only ever touch queued or active executions, and
+    are served by the partial indexes defined on the executions table, so
+    their cost doesn't depend on the number of executions that have
+    already ended. Apart from the error-reporting helper, every query
+    returns at most a single row.
+    """
+
+    # Workflows that run without a deployment, but only touch a single
+    # resource, so they don't block other executions like system-wide
+    # workflows do
+    NON_BLOCKING_WORKFLOWS = ('upload_blueprint',)
+
+    def __init__(self, sm):
+        self.sm = sm
+
+    def _base_query(self):
+        query = db.session.query(models.Execution)
+        tenant = self.sm.current_tenant
+        if tenant:
+            query = query.filter(models.Execution._tenant_id == tenant.id)
+        return query
+
+    @staticmethod
+    def _filter_deployment(query, deployment_id):
+        return query.filter(
+            models.Execution._deployment_fk == models.Deployment._storage_id,
+            models.Deployment.id == deployment_id)
+
+    def _first(self, statuses, deployment_id=None, system_wide=False):
+        query = self._base_query().filter(
+            models.Execution.status.in_(statuses))
+        if system_wide:
+            query = query.filter(
+                models.Execution._deployment_fk.is_(None),
+                ~models.Execution.workflow_id.in_(
+                    self.NON_BLOCKING_WORKFLOWS))
+        elif deployment_id is not None:
+            query = self._filter_deployment(query, deployment_id)
+        return query.order_by(models.Execution.created_at).first()
+
+    def first_active(self, deployment_id=None):
+        """Return an active execution (of `deployment_id`, if passed),
+        or None if there are no active executions
+        """
+        return self._first(ExecutionState.ACTIVE_STATES,
+                           deployment_id=deployment_id)
+
+    def first_system_wide(self, include_queued=False):
+        """Return an active system-wide execution (one without a
+        deployment, apart from the NON_BLOCKING_WORKFLOWS), or None if
+        there isn't one
+
+        :param include_queued: Also consider queued system-wide executions
+        """
+        statuses = ExecutionState.ACTIVE_STATES
+        if include_queued:
+            statuses = statuses + ExecutionState.QUEUED_STATE
+        return self._first(statuses, system_wide=True)
+
+    def active_execution_ids(self, deployment_id=None):
+        """Return the ids of all the active executions. Only meant to be used
+        when building error messages
+        """
+        query = self._base_query().filter(
+            models.Execution.status.in_(ExecutionState.ACTIVE_STATES))
+        if deployment_id is not None:
+            query = self._filter_deployment(query, deployment_id)
+        return [e.id for e in query]
+
+    def _next_queued(self, skip_ids):
+        """Lock and return the oldest queued execution that isn't blocked by
+        an active execution of the same deployment.
+
+        Rows locked by a concurrent dequeue are skipped (`SKIP LOCKED`), so
+        two workers finishing executions at the same time never dispatch
+        the same queued execution. The lock is released when the dequeued
+        execution is committed with its new status.
+        """
+        execution = models.Execution
+        active = aliased(models.Execution)
+        deployment_busy = exists().where(and_(
+            active._deployment_fk == execution._deployment_fk,
+            active.status.in_(ExecutionState.ACTIVE_STATES)
+        ))
+        query = self._base_query().filter(
+            execution.status == ExecutionState.QUEUED,
+            sql_or(execution._deployment_fk.is_(None), ~deployment_busy)
+        )
+        if skip_ids:
+            query = query.filter(~execution._storage_id.in_(skip_ids))
+        query = query.order_by(execution.created_at, execution._storage_id)
+        return query.limit(1).with_for_update(skip_locked=True).first()
+
+    def dequeue(self):
+        """Yield the queued executions that may currently start, oldest first
+
+        Nothing is yielded while a system-wide execution is active. A queued
+        system-wide execution is only yielded if there are no active
+        executions at all; otherwise it stays at the head of the queue, and
+        dequeuing stops so that it isn't starved by later executions.
+        """
+        attempted = []
+        while True:
+            if self.first_system_wide():
+                return
+            execution = self._next_queued(attempted)
+            if execution is None:
+                return
+            if execution._deployment_fk is None and self.first_active():
+                db.session.rollback()  # release the row lock
+                return
+            attempted.append(execution._storage_id)
+            yield execution
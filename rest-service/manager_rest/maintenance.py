@@ -15,13 +15,17 @@
 #
 
 import os
+import time
+import errno
 import StringIO
+import threading
 import traceback
 
 from flask import jsonify, request
 
 from manager_rest import config
 from manager_rest import utils
+from manager_rest.storage import db, models
 from manager_rest.storage.models_states import ExecutionState
 from manager_rest.resource_manager import get_resource_manager
 from manager_rest.constants import (MAINTENANCE_MODE_ACTIVATED,
@@ -37,6 +41,12 @@ ALLOWED_ENDPOINTS = ['maintenance',
                      'status',
                      'version']
 LOCAL_ADDRESS = '127.0.0.1'
+RUNNING_EXECUTION_STATES = ExecutionState.ACTIVE_STATES + \
+    ExecutionState.QUEUED_STATE
+
+# How often (in seconds) the maintenance status file is checked for changes
+# made by other REST service processes
+STATE_CHECK_INTERVAL = 1
 
 
 def get_maintenance_file_path():
@@ -45,6 +55,79 @@ def get_maintenance_file_path():
             MAINTENANCE_MODE_STATUS_FILE)
 
 
+class _MaintenanceState(object):
+    """The contents of the maintenance status file, kept in memory.
+
+    The file is stat'ed at most once every STATE_CHECK_INTERVAL seconds,
+    and only read again when it changed, so that the before-request hook
+    doesn't touch the filesystem on every request. Changes made through
+    this process are seen immediately, changes made by other processes
+    within the interval.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path = None
+        self._file_stat = None
+        self._checked_at = 0
+        self._state = None
+
+    def get(self):
+        path = get_maintenance_file_path()
+        now = time.time()
+        with self._lock:
+            if path != self._path or \
+                    now - self._checked_at >= STATE_CHECK_INTERVAL:
+                self._refresh(path)
+                self._checked_at = now
+            return dict(self._state) if self._state is not None else None
+
+    def _refresh(self, path):
+        try:
+            stat = os.stat(path)
+            file_stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+        except OSError:
+            file_stat = None
+        if path == self._path and file_stat == self._file_stat:
+            return
+        self._path = path
+        self._file_stat = file_stat
+        self._state = utils.read_json_file(path) if file_stat else None
+
+    def store(self, state):
+        utils.mkdirs(config.instance.maintenance_folder)
+        with self._lock:
+            utils.write_dict_to_json_file(get_maintenance_file_path(), state)
+            self._path = None
+
+    def remove(self):
+        with self._lock:
+            try:
+                os.remove(get_maintenance_file_path())
+            except OSError as exc:
+                # already removed by another process
+                if exc.errno != errno.ENOENT:
+                    raise
+            self._path = None
+
+
+_maintenance_state = _MaintenanceState()
+
+
+def get_maintenance_state():
+    """Return the stored maintenance mode state, or None if maintenance
+    mode isn't activated (or being activated)
+    """
+    return _maintenance_state.get()
+
+
+def store_maintenance_state(state):
+    _maintenance_state.store(state)
+
+
+def remove_maintenance_state():
+    _maintenance_state.remove()
+
+
 def prepare_maintenance_dict(status,
                              activated_at='',
                              remaining_executions=None,
@@ -72,15 +155,11 @@ def maintenance_mode_handler():
     # Removing v*/ from the endpoint
     index = request.endpoint.find('/')
     request_endpoint = request.endpoint[index+1:]
-    maintenance_file = os.path.join(
-            config.instance.maintenance_folder,
-            MAINTENANCE_MODE_STATUS_FILE)
 
-    if os.path.isfile(maintenance_file):
-        state = utils.read_json_file(maintenance_file)
+    state = get_maintenance_state()
+    if state is not None:
         if state['status'] == MAINTENANCE_MODE_ACTIVATING:
-            running_executions = get_running_executions()
-            if not running_executions:
+            if not has_running_executions():
                 now = utils.get_formatted_timestamp()
                 state = prepare_maintenance_dict(
                         MAINTENANCE_MODE_ACTIVATED,
@@ -89,7 +168,7 @@ def maintenance_mode_handler():
                         requested_by=state['requested_by'],
                         activation_requested_at=state[
                             'activation_requested_at'])
-                utils.write_dict_to_json_file(maintenance_file, state)
+                store_maintenance_state(state)
             else:
                 return _handle_activating_mode(
                        state=state,
@@ -141,20 +220,27 @@ def _check_allowed_endpoint(request_endpoint):
 def get_running_executions():
     executions = get_resource_manager().list_executions(
         is_include_system_workflows=True,
+        filters={'status': RUNNING_EXECUTION_STATES},
         all_tenants=True,
         get_all_results=True
     )
-    running_executions = []
-    for execution in executions:
-        if execution.status not in ExecutionState.END_STATES:
-            running_executions.append({
-                'id': execution.id,
-                'status': execution.status,
-                'deployment_id': execution.deployment_id,
-                'workflow_id': execution.workflow_id
-            })
-
-    return running_executions
+    return [{'id': execution.id,
+             'status': execution.status,
+             'deployment_id': execution.deployment_id,
+             'workflow_id': execution.workflow_id}
+            for execution in executions]
+
+
+def has_running_executions():
+    """Check whether there are any unfinished executions, in any tenant.
+
+    Unlike get_running_executions, this is a single-row query served by
+    the partial indexes on the executions table, so it's cheap enough to
+    run on every request while maintenance mode is being activated.
+    """
+    running = db.session.query(models.Execution._storage_id).filter(
+        models.Execution.status.in_(RUNNING_EXECUTION_STATES))
+    return db.session.query(running.exists()).scalar()
 
 
 def _is_internal_request():
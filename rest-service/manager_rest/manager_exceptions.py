@@ -142,6 +142,15 @@ class UnsupportedContentTypeError(ManagerException):
             **kwargs)
 
 
+class PayloadTooLargeError(ManagerException):
+    PAYLOAD_TOO_LARGE_ERROR_CODE = 'payload_too_large_error'
+
+    def __init__(self, *args, **kwargs):
+        super(PayloadTooLargeError, self).__init__(
+            413, PayloadTooLargeError.PAYLOAD_TOO_LARGE_ERROR_CODE,
+            *args, **kwargs)
+
+
 class BadParametersError(ManagerException):
     BAD_PARAMETERS_ERROR_CODE = 'bad_parameters_error'
 
@@ -14,12 +14,15 @@
 #  * limitations under the License.
 
 import os
+import json
 import uuid
 import yaml
+import hashlib
 import shutil
 import itertools
 from copy import deepcopy
 from StringIO import StringIO
+from urlparse import urlparse
 
 from flask import current_app
 from flask_security import current_user
@@ -30,13 +33,14 @@ from dsl_parser import exceptions as parser_exceptions
 from manager_rest import premium_enabled
 from manager_rest.constants import DEFAULT_TENANT_NAME
 from manager_rest.dsl_functions import get_secret_method
+from manager_rest.execution_scheduler import ExecutionScheduler
 from manager_rest.utils import is_create_global_permitted, send_event
 from manager_rest.storage import (get_storage_manager,
                                   models,
-                                  get_node,
-                                  ListResult)
+                                  get_node)
 from manager_rest.storage.models_states import (SnapshotState,
                                                 ExecutionState,
+                                                BlueprintUploadState,
                                                 DeploymentModificationState,
                                                 VisibilityState)
 
@@ -52,6 +56,7 @@ class ResourceManager(object):
     def __init__(self):
         self.sm = get_storage_manager()
         self.task_mapping = _create_task_mapping()
+        self.execution_scheduler = ExecutionScheduler(self.sm)
 
     def list_executions(self, include=None, is_include_system_workflows=False,
                         filters=None, pagination=None, sort=None,
@@ -93,23 +98,11 @@ class ResourceManager(object):
         return res
 
     def start_queued_executions(self):
-        queued_executions = self._get_queued_executions()
-
-        for e in queued_executions:
+        for e in self.execution_scheduler.dequeue():
             self.execute_queued_workflow(e)
             if e.is_system_workflow:  # To avoid starvation of system workflows
                 break
 
-    def _get_queued_executions(self):
-        filters = {'status': ExecutionState.QUEUED_STATE}
-
-        queued_executions = self.list_executions(
-            is_include_system_workflows=True,
-            filters=filters,
-            sort={'created_at': 'asc'}).items
-
-        return queued_executions
-
     def _validate_execution_update(self, current_status, future_status):
         if current_status in ExecutionState.END_STATES:
             return False
@@ -147,14 +140,16 @@ class ResourceManager(object):
 
     def create_snapshot_model(self,
                               snapshot_id,
-                              status=SnapshotState.CREATING):
+                              status=SnapshotState.CREATING,
+                              base_snapshot_id=None):
         now = utils.get_formatted_timestamp()
         visibility = VisibilityState.PRIVATE
         new_snapshot = models.Snapshot(id=snapshot_id,
                                        created_at=now,
                                        status=status,
                                        visibility=visibility,
-                                       error='')
+                                       error='',
+                                       base_snapshot_id=base_snapshot_id)
         return self.sm.put(new_snapshot)
 
     def create_snapshot(self,
@@ -164,9 +159,20 @@ class ResourceManager(object):
                         include_logs,
                         include_events,
                         bypass_maintenance,
-                        queue):
-
-        self.create_snapshot_model(snapshot_id)
+                        queue,
+                        base_snapshot_id=None):
+        if base_snapshot_id is not None:
+            # Throws error if no snapshot found
+            base_snapshot = self.sm.get(models.Snapshot, base_snapshot_id)
+            if base_snapshot.status not in (SnapshotState.CREATED,
+                                            SnapshotState.UPLOADED):
+                raise manager_exceptions.SnapshotActionError(
+                    'Snapshot {0} is {1}, and can\'t be the base of an '
+                    'incremental snapshot'.format(base_snapshot_id,
+                                                  base_snapshot.status))
+
+        self.create_snapshot_model(snapshot_id,
+                                   base_snapshot_id=base_snapshot_id)
         try:
             execution = self._execute_system_workflow(
                 wf_id='create_snapshot',
@@ -177,6 +183,7 @@ class ResourceManager(object):
                     'include_credentials': include_credentials,
                     'include_logs': include_logs,
                     'include_events': include_events,
+                    'base_snapshot_id': base_snapshot_id,
                     'config': self._get_conf_for_snapshots_wf()
                 },
                 bypass_maintenance=bypass_maintenance,
@@ -309,11 +316,13 @@ class ResourceManager(object):
                 used_blueprints = list(set(
                     d.blueprint_id for d in
                     self.sm.list(models.Deployment, include=['blueprint_id'])))
-                plugins = [b.plan[constants.WORKFLOW_PLUGINS_TO_INSTALL] +
-                           b.plan[constants.DEPLOYMENT_PLUGINS_TO_INSTALL]
+                plugins = [b.workflow_plugins_to_install +
+                           b.deployment_plugins_to_install
                            for b in
                            self.sm.list(models.Blueprint,
-                                        include=['plan'],
+                                        include=[
+                                            'workflow_plugins_to_install',
+                                            'deployment_plugins_to_install'],
                                         filters={'id': used_blueprints})]
                 plugins = set((p.get('package_name'), p.get('package_version'))
                               for sublist in plugins for p in sublist)
@@ -337,11 +346,14 @@ class ResourceManager(object):
 
         # Remove from storage
         self.sm.delete(plugin)
+        app_context.invalidate_plugin_catalogs()
 
         # Remove from file system
         archive_path = utils.get_plugin_archive_path(plugin_id,
                                                      plugin.archive_name)
         shutil.rmtree(os.path.dirname(archive_path), ignore_errors=True)
+        # The yaml file was removed along with the rest of the plugin's files
+        plugin.yaml_file_name = ''
 
         return plugin
 
@@ -351,18 +363,20 @@ class ResourceManager(object):
                           resources_base,
                           blueprint_id,
                           private_resource,
-                          visibility):
+                          visibility,
+                          archive_digest=None):
         dsl_location = os.path.join(
             resources_base,
             application_dir,
             application_file_name
         )
-        try:
-            plan = tasks.parse_dsl(dsl_location,
-                                   resources_base,
-                                   **app_context.get_parser_context())
-        except Exception, ex:
-            raise manager_exceptions.DslParseException(str(ex))
+        plan_digest = self.get_plan_digest(archive_digest,
+                                           application_dir,
+                                           application_file_name,
+                                           resources_base)
+        plan = self.get_cached_plan(plan_digest)
+        if plan is None:
+            plan = self.parse_plan(dsl_location, resources_base)
 
         now = utils.get_formatted_timestamp()
         visibility = self.get_resource_visibility(models.Blueprint,
@@ -376,10 +390,164 @@ class ResourceManager(object):
             created_at=now,
             updated_at=now,
             main_file_name=application_file_name,
-            visibility=visibility
+            visibility=visibility,
+            state=BlueprintUploadState.UPLOADED,
+            plan_digest=plan_digest
         )
         return self.sm.put(new_blueprint)
 
+    def create_parsing_blueprint(self,
+                                 application_file_name,
+                                 blueprint_id,
+                                 private_resource,
+                                 visibility,
+                                 archive_digest=None,
+                                 application_dir=None,
+                                 resources_base=None):
+        """Store a blueprint without its plan, to be parsed in the
+        background by the `upload_blueprint` system workflow
+        """
+        now = utils.get_formatted_timestamp()
+        visibility = self.get_resource_visibility(models.Blueprint,
+                                                  blueprint_id,
+                                                  visibility,
+                                                  private_resource)
+        new_blueprint = models.Blueprint(
+            id=blueprint_id,
+            created_at=now,
+            updated_at=now,
+            main_file_name=application_file_name,
+            visibility=visibility,
+            state=BlueprintUploadState.PARSING,
+            plan_digest=self.get_plan_digest(archive_digest,
+                                             application_dir,
+                                             application_file_name,
+                                             resources_base)
+        )
+        return self.sm.put(new_blueprint)
+
+    def parse_blueprint_in_background(self, blueprint):
+        return self._execute_system_workflow(
+            wf_id='upload_blueprint',
+            task_mapping='cloudify_system_workflows.blueprint.upload',
+            execution_parameters={'blueprint_id': blueprint.id},
+            verify_no_executions=False)
+
+    def get_plan_digest(self, archive_digest, application_dir,
+                        application_file_name, resources_base):
+        """Return a digest of everything the plan parsed from a blueprint
+        archive depends on, or None if the plan can't be cached.
+
+        Besides the archive and its main blueprint file, that is the
+        parser settings, the files which the blueprint imports from the
+        file server, and the plugins which `plugin:` imports could be
+        resolved to. Blueprints with any other imports (e.g. over http)
+        can't be cached.
+
+        :param application_dir: Where the archive was extracted, relative
+        to `resources_base`
+        """
+        if not archive_digest or not application_dir:
+            return None
+        imports_digest = self._get_imports_digest(
+            os.path.join(resources_base, application_dir),
+            application_file_name,
+            resources_base)
+        if imports_digest is None:
+            return None
+        parser_fingerprint = app_context.get_parser_context_fingerprint(
+            self.sm)
+        if parser_fingerprint is None:
+            return None
+        plugin_catalog = app_context.get_plugin_catalog(self.sm).plugins
+        digest = hashlib.sha256()
+        for part in (archive_digest,
+                     application_file_name,
+                     imports_digest,
+                     parser_fingerprint,
+                     json.dumps(plugin_catalog)):
+            digest.update(part.encode('utf-8'))
+            digest.update('\0')
+        return digest.hexdigest()
+
+    @staticmethod
+    def _get_imports_digest(archive_dir, application_file_name,
+                            resources_base):
+        """Return a digest of the files which the blueprint, and the files
+        it imports, import from the file server, or None if anything is
+        imported from elsewhere than the archive, the file server and
+        plugins.
+
+        Relative imports are resolved like the parser does: next to the
+        importing file, or else in `resources_base`.
+        """
+        archive_dir = os.path.abspath(archive_dir)
+        digest = hashlib.sha256()
+        pending = [os.path.join(archive_dir, application_file_name)]
+        seen = set()
+        while pending:
+            location = pending.pop()
+            if location in seen:
+                continue
+            seen.add(location)
+            try:
+                with open(location) as f:
+                    content = f.read()
+                imports = (yaml.safe_load(content) or {}).get('imports')
+            except (IOError, AttributeError, yaml.YAMLError):
+                # Let the parser report it; there's nothing to cache
+                return None
+            if not location.startswith(archive_dir + os.sep):
+                digest.update(location)
+                digest.update('\0')
+                digest.update(content)
+                digest.update('\0')
+            for import_url in imports or []:
+                if not isinstance(import_url, basestring):
+                    return None
+                if import_url.startswith(app_context.ResolverWithPlugins
+                                         .PREFIX):
+                    continue
+                if urlparse(import_url).scheme or os.path.isabs(import_url):
+                    return None
+                imported = os.path.abspath(os.path.join(
+                    os.path.dirname(location), import_url))
+                if not os.path.isfile(imported):
+                    imported = os.path.abspath(os.path.join(
+                        resources_base, import_url))
+                if not os.path.isfile(imported):
+                    return None
+                pending.append(imported)
+        return digest.hexdigest()
+
+    def get_cached_plan(self, plan_digest):
+        """Return the plan of an uploaded blueprint with the same plan
+        digest, or None if there isn't one
+        """
+        if plan_digest is None:
+            return None
+        blueprints = self.sm.list(
+            models.Blueprint,
+            include=['plan'],
+            filters={'plan_digest': plan_digest,
+                     'state': BlueprintUploadState.UPLOADED},
+            pagination={'size': 1})
+        if not blueprints:
+            return None
+        current_app.logger.debug(
+            'Reusing the plan of a blueprint with plan digest {0}'
+            .format(plan_digest))
+        return blueprints[0].plan
+
+    @staticmethod
+    def parse_plan(dsl_location, resources_base):
+        try:
+            return tasks.parse_dsl(dsl_location,
+                                   resources_base,
+                                   **app_context.get_parser_context())
+        except Exception, ex:
+            raise manager_exceptions.DslParseException(str(ex))
+
     def delete_blueprint(self, blueprint_id):
         blueprint = self.sm.get(models.Blueprint, blueprint_id)
         self.validate_modification_permitted(blueprint)
@@ -464,7 +632,6 @@ class ResourceManager(object):
                          execution=None):
 
         deployment = self.sm.get(models.Deployment, deployment_id)
-        blueprint = self.sm.get(models.Blueprint, deployment.blueprint_id)
         self._verify_workflow_in_deployment(workflow_id, deployment,
                                             deployment_id)
         workflow = deployment.workflows[workflow_id]
@@ -506,8 +673,7 @@ class ResourceManager(object):
             return new_execution
 
         # executing the user workflow
-        workflow_plugins = blueprint.plan[
-            constants.WORKFLOW_PLUGINS_TO_INSTALL]
+        workflow_plugins = deployment.blueprint.workflow_plugins_to_install
         new_execution.status = ExecutionState.PENDING
         new_execution.started_at = utils.get_formatted_timestamp()
         self.sm.put(new_execution)
@@ -608,28 +774,20 @@ class ResourceManager(object):
         return system_exec_running or execution_running
 
     def _check_for_any_active_executions(self, queue):
-        filters = {
-            'status': ExecutionState.ACTIVE_STATES
-        }
-        executions = [
-            e.id
-            for e in self.list_executions(is_include_system_workflows=True,
-                                          filters=filters,
-                                          get_all_results=True).items
-        ]
         should_queue = False
         # Execution can't currently run because other executions are running,
         # since `queue` flag is on - we will queue the execution and it will
         # run when possible
-        if executions and queue:
+        if self.execution_scheduler.first_active() is None:
+            return should_queue
+        if queue:
             should_queue = True
-
-        elif executions:
+        else:
             raise manager_exceptions.ExistingRunningExecutionError(
                 'You cannot start a system-wide execution if there are '
                 'other executions running. '
                 'Currently running executions: {0}'
-                .format(executions))
+                .format(self.execution_scheduler.active_execution_ids()))
         return should_queue
 
     def _check_for_active_system_wide_execution(self, queue, execution):
@@ -640,27 +798,19 @@ class ResourceManager(object):
         run) we check for ACTIVE and QUEUED executions.
         We do this to avoid starving executions.
         """
-
-        status = ExecutionState.ACTIVE_STATES if execution else \
-            ExecutionState.ACTIVE_STATES+ExecutionState.QUEUED_STATE
-        filters = {
-            'status': status
-        }
         should_queue = False
-        for e in self.list_executions(is_include_system_workflows=True,
-                                      filters=filters,
-                                      get_all_results=True).items:
-            # Execution can't currently run because system execution is
-            # running. since `queue` flag is on - we will queue the execution
-            #  and it will run when possible
-            if e.deployment_id is None and queue:
-                should_queue = True
-                break
-            elif e.deployment_id is None:
-                raise manager_exceptions.ExistingRunningExecutionError(
-                    'You cannot start an execution if there is a running '
-                    'system-wide execution (id: {0})'
-                    .format(e.id))
+        system_execution = self.execution_scheduler.first_system_wide(
+            include_queued=execution is None)
+        # Execution can't currently run because system execution is
+        # running. since `queue` flag is on - we will queue the execution
+        #  and it will run when possible
+        if system_execution is not None and queue:
+            should_queue = True
+        elif system_execution is not None:
+            raise manager_exceptions.ExistingRunningExecutionError(
+                'You cannot start an execution if there is a running '
+                'system-wide execution (id: {0})'
+                .format(system_execution.id))
 
         return should_queue
 
@@ -910,6 +1060,11 @@ class ResourceManager(object):
                           skip_plugins_validation=False):
 
         blueprint = self.sm.get(models.Blueprint, blueprint_id)
+        if blueprint.state in (BlueprintUploadState.PARSING,
+                               BlueprintUploadState.INVALID):
+            raise manager_exceptions.ConflictError(
+                "Can't create deployment from blueprint {0} - the blueprint "
+                "is in the `{1}` state".format(blueprint_id, blueprint.state))
         plan = blueprint.plan
         try:
             deployment_plan = tasks.prepare_deployment_plan(
@@ -1244,49 +1399,45 @@ class ResourceManager(object):
         instance_dict['resource_availability'] = resource_availability
 
     def list_agents(self, deployment_id=None, node_ids=None,
-                    node_instance_ids=None, install_method=None):
+                    node_instance_ids=None, install_method=None,
+                    pagination=None):
         filters = {}
         if deployment_id is not None:
             filters['deployment_id'] = deployment_id
         if node_ids is not None:
-            filters['id'] = node_ids
-        nodes = {n._storage_id: n
-                 for n in self.sm.list(models.Node, filters=filters,
-                                       get_all_results=True)
-                 if self._is_agent_node(n)}
-
-        if not nodes:
-            pagination = {'total': 0, 'size': 0, 'offset': 0}
-            return ListResult([], metadata={'pagination': pagination})
-
-        instance_filters = {'_node_fk': list(nodes)}
-        if node_instance_ids:
-            instance_filters['id'] = node_instance_ids
-        node_instances = self.sm.list(models.NodeInstance,
-                                      filters=instance_filters,
-                                      get_all_results=True)
-        agents = []
-        for inst in node_instances:
-            agent = self._agent_from_instance(inst)
-            if agent is None:
-                continue
-            if install_method is not None and \
-                    agent['install_method'] not in install_method:
-                continue
-            agents.append(agent)
-
-        # there's no real way to implement pagination in a meaningful manner,
-        # since we need to query node-instances anyway; still, include the
-        # sizes to keep response object shape consistent with all other
-        # endpoints
-        pagination = {'total': len(agents), 'size': len(agents), 'offset': 0}
-        return ListResult(agents, metadata={'pagination': pagination})
+            filters['node_id'] = node_ids
+        if node_instance_ids is not None:
+            filters['id'] = node_instance_ids
+        if install_method is not None:
+            filters['install_method'] = install_method
+        return self.sm.list(models.Agent,
+                            filters=filters,
+                            pagination=pagination,
+                            sort={'id': 'asc'})
+
+    def update_agent(self, instance):
+        """Update the agents table after the runtime properties or the state
+        of a node instance have changed: store the instance's agent, or
+        remove it if the instance doesn't have one (anymore)
+        """
+        agent_fields = self._agent_from_instance(instance)
+        agent = instance.agents[0] if instance.agents else None
+        if agent_fields is None:
+            if agent is not None:
+                self.sm.delete(agent)
+            return
+        if agent is None:
+            agent = models.Agent(id=instance.id)
+            agent.set_node_instance(instance)
+        for field, value in agent_fields.iteritems():
+            setattr(agent, field, value)
+        self.sm.update(agent)
 
     def _agent_from_instance(self, instance):
         if instance.state != 'started':
             return
-        agent = instance.runtime_properties.get('cloudify_agent')
-        if not agent:
+        agent = (instance.runtime_properties or {}).get('cloudify_agent')
+        if not agent or not self._is_agent_node(instance.node):
             return
         if agent.get('windows'):
             system = 'windows'
@@ -1295,14 +1446,13 @@ class ResourceManager(object):
             if agent.get('distro_codename'):
                 system = '{0} {1}'.format(system, agent.get('distro_codename'))
         return dict(
-            id=instance.id,
             host_id=instance.host_id,
             ip=agent.get('ip'),
             install_method=agent.get('install_method'),
             system=system,
             version=agent.get('version'),
-            node=instance.node_id,
-            deployment=instance.deployment_id
+            node_id=instance.node_id,
+            deployment_id=instance.deployment_id
         )
 
     def _is_agent_node(self, node):
@@ -1528,43 +1678,33 @@ class ResourceManager(object):
             update_execution_status=False,
             verify_no_executions=False,
             execution_parameters={
-                'deployment_plugins_to_uninstall': blueprint.plan[
-                    constants.DEPLOYMENT_PLUGINS_TO_INSTALL],
-                'workflow_plugins_to_uninstall': blueprint.plan[
-                    constants.WORKFLOW_PLUGINS_TO_INSTALL],
+                'deployment_plugins_to_uninstall':
+                    blueprint.deployment_plugins_to_install,
+                'workflow_plugins_to_uninstall':
+                    blueprint.workflow_plugins_to_install,
             })
 
     def _check_for_active_executions(self, deployment_id, force, queue):
-
-        def _get_running_executions(deployment_id=None, include_system=True):
-            deployment_id_filter = self.create_filters_dict(
-                deployment_id=deployment_id,
-                status=ExecutionState.ACTIVE_STATES)
-            executions = self.list_executions(
-                filters=deployment_id_filter,
-                is_include_system_workflows=include_system).items
-            return [e.id for e in executions if
-                    self.sm.get(models.Execution, e.id).status
-                    not in ExecutionState.END_STATES]
-
         should_queue = False
 
         # validate no execution is currently in progress
         if not force:
-            running = _get_running_executions(deployment_id)
+            if self.execution_scheduler.first_active(deployment_id) is None:
+                return should_queue
 
             # Execution can't currently run since other executions are running.
             # `queue` flag is on - we will queue the execution and it will
             # run when possible
-            if len(running) > 0 and queue:
+            if queue:
                 should_queue = True
                 return should_queue
-            if len(running) > 0:
-                raise manager_exceptions.ExistingRunningExecutionError(
-                    'The following executions are currently running for this '
-                    'deployment: {0}. To execute this workflow anyway, pass '
-                    '"force=true" as a query parameter to this request'.format(
-                        running))
+            running = self.execution_scheduler.active_execution_ids(
+                deployment_id)
+            raise manager_exceptions.ExistingRunningExecutionError(
+                'The following executions are currently running for this '
+                'deployment: {0}. To execute this workflow anyway, pass '
+                '"force=true" as a query parameter to this request'.format(
+                    running))
 
         return should_queue
 
@@ -1636,7 +1776,10 @@ class ResourceManager(object):
         # Set the visibility
         resource.visibility = visibility
         resource.updated_at = utils.get_formatted_timestamp()
-        return self.sm.update(resource)
+        resource = self.sm.update(resource)
+        if model_class == models.Plugin:
+            app_context.invalidate_plugin_catalogs()
+        return resource
 
     def validate_visibility_value(self, model_class, resource, new_visibility):
         current_visibility = resource.visibility
@@ -59,6 +59,7 @@ def setup_resources(api):
         'ProviderContext': 'provider/context',
         'Version': 'version',
         'EvaluateFunctions': 'evaluate/functions',
+        'EvaluateOutputs': 'evaluate/outputs',
         'Tokens': 'tokens',
         'Plugins': 'plugins',
         'PluginsId': 'plugins/<string:plugin_id>',
@@ -21,7 +21,8 @@ from flask_restful.reqparse import Argument
 from flask_restful_swagger import swagger
 
 from manager_rest import manager_exceptions
-from manager_rest.resource_manager import ResourceManager
+from manager_rest.resource_manager import (ResourceManager,
+                                           get_resource_manager)
 from manager_rest.rest.rest_decorators import (
     exceptions_handled,
     marshal_with,
@@ -232,4 +233,8 @@ class NodeInstancesId(SecuredResource):
             instance.runtime_properties
         )
         instance.state = request_dict.get('state', instance.state)
-        return get_storage_manager().update(instance)
+        sm = get_storage_manager()
+        with sm.transaction():
+            sm.update(instance)
+            get_resource_manager().update_agent(instance)
+        return instance
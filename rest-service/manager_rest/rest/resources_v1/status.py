@@ -14,9 +14,13 @@
 #  * limitations under the License.
 #
 
+import copy
+import time
+import threading
+
 from flask_restful_swagger import swagger
 
-from manager_rest import config
+from manager_rest import config, utils
 from manager_rest.rest import responses, rest_utils
 from manager_rest.rest.rest_decorators import (
     exceptions_handled,
@@ -50,6 +54,60 @@ CLUSTER_SERVICES = {
     'cloudify-syncthing.service': 'Syncthing',
 }
 
+# For how long (in seconds) the collected status of the services is
+# considered fresh
+SERVICES_STATUS_TTL = 5
+
+
+class _ServicesStatus(object):
+    """The last collected status of the monitored services.
+
+    Load balancers and monitoring poll /status constantly, so the status
+    isn't collected on every request. Once the collected status is older
+    than SERVICES_STATUS_TTL, it's still served, while a background thread
+    collects it again; only the first request (for each set of units)
+    waits for systemd to be queried.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._collected = {}
+        self._refreshing = set()
+
+    def get(self, units):
+        """Return the status of `units` and the time it was collected at"""
+        key = frozenset(units.iteritems())
+        with self._lock:
+            collected = self._collected.get(key)
+            if collected is not None and key not in self._refreshing and \
+                    time.time() - collected[0] >= SERVICES_STATUS_TTL:
+                self._refreshing.add(key)
+                thread = threading.Thread(target=self._refresh,
+                                          args=(key, units))
+                thread.daemon = True
+                thread.start()
+        if collected is None:
+            collected = self._collect(key, units)
+        _, collected_at, services = collected
+        return copy.deepcopy(services), collected_at
+
+    def _collect(self, key, units):
+        collected = (time.time(),
+                     utils.get_formatted_timestamp(),
+                     get_services(units))
+        with self._lock:
+            self._collected[key] = collected
+        return collected
+
+    def _refresh(self, key, units):
+        try:
+            self._collect(key, units)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+_services_status = _ServicesStatus()
+
 
 class Status(SecuredResource):
 
@@ -63,8 +121,10 @@ class Status(SecuredResource):
     @marshal_with(responses.Status)
     def get(self, **kwargs):
         """Get the status of running system services"""
+        collected_at = None
         if get_services:
-            jobs = get_services(self._get_systemd_manager_services())
+            jobs, collected_at = _services_status.get(
+                self._get_systemd_manager_services())
             jobs = [
                 job for job in jobs
                 if self._should_be_in_services_output(job)
@@ -76,7 +136,9 @@ class Status(SecuredResource):
         else:
             jobs = ['undefined']
 
-        return {'status': 'running', 'services': jobs}
+        return {'status': 'running',
+                'services': jobs,
+                'services_collected_at': collected_at}
 
     def _should_be_in_services_output(self, job):
         if job['unit_id'] not in OPTIONAL_SERVICES:
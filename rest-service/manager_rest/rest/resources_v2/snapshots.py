@@ -139,6 +139,7 @@ class SnapshotsId(SecuredResource):
             'queue',
             request_dict.get('queue', 'false')
         )
+        base_snapshot_id = request_dict.get('base_snapshot_id')
         bypass_maintenance = is_bypass_maintenance_mode()
         execution = get_resource_manager().create_snapshot(
             snapshot_id,
@@ -147,7 +148,8 @@ class SnapshotsId(SecuredResource):
             include_logs,
             include_events,
             bypass_maintenance,
-            queue
+            queue,
+            base_snapshot_id=base_snapshot_id
         )
 
         return execution, 201
@@ -163,6 +165,19 @@ class SnapshotsId(SecuredResource):
     def delete(self, snapshot_id):
         sm = get_storage_manager()
         snapshot = sm.get(models.Snapshot, snapshot_id)
+        # Incremental snapshots can't be restored without their base
+        dependent_snapshots = sm.list(
+            models.Snapshot,
+            include=['id'],
+            filters={'base_snapshot_id': snapshot_id},
+            all_tenants=True,
+            get_all_results=True)
+        if dependent_snapshots:
+            raise manager_exceptions.ConflictError(
+                "Can't delete snapshot {0}, the incremental snapshots {1} "
+                "are based on it".format(
+                    snapshot_id,
+                    ', '.join(sorted(s.id for s in dependent_snapshots))))
         sm.delete(snapshot)
         path = _get_snapshot_path(snapshot_id)
         shutil.rmtree(path, ignore_errors=True)
@@ -13,18 +13,17 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
-import os
-
 from flask_security import current_user
 
-from manager_rest import config
 from manager_rest import utils
 from manager_rest.security import SecuredResource
 from manager_rest.security.authorization import authorize
 from manager_rest.constants import (MAINTENANCE_MODE_ACTIVATED,
                                     MAINTENANCE_MODE_ACTIVATING,
                                     MAINTENANCE_MODE_DEACTIVATED)
-from manager_rest.maintenance import (get_maintenance_file_path,
+from manager_rest.maintenance import (get_maintenance_state,
+                                      store_maintenance_state,
+                                      remove_maintenance_state,
                                       prepare_maintenance_dict,
                                       get_running_executions)
 from manager_rest.manager_exceptions import BadParametersError
@@ -38,10 +37,8 @@ class MaintenanceMode(SecuredResource):
     @authorize('maintenance_mode_get')
     @rest_decorators.marshal_with(MaintenanceModeResponse)
     def get(self, **_):
-        maintenance_file_path = get_maintenance_file_path()
-        if os.path.isfile(maintenance_file_path):
-            state = utils.read_json_file(maintenance_file_path)
-
+        state = get_maintenance_state()
+        if state is not None:
             if state['status'] == MAINTENANCE_MODE_ACTIVATED:
                 return state
             if state['status'] == MAINTENANCE_MODE_ACTIVATING:
@@ -61,10 +58,9 @@ class MaintenanceModeAction(SecuredResource):
     @authorize('maintenance_mode_set')
     @rest_decorators.marshal_with(MaintenanceModeResponse)
     def post(self, maintenance_action, **_):
-        maintenance_file_path = get_maintenance_file_path()
+        state = get_maintenance_state()
         if maintenance_action == 'activate':
-            if os.path.isfile(maintenance_file_path):
-                state = utils.read_json_file(maintenance_file_path)
+            if state is not None:
                 return state, 304
             now = utils.get_formatted_timestamp()
             try:
@@ -75,20 +71,19 @@ class MaintenanceModeAction(SecuredResource):
             status = MAINTENANCE_MODE_ACTIVATING \
                 if remaining_executions else MAINTENANCE_MODE_ACTIVATED
             activated_at = '' if remaining_executions else now
-            utils.mkdirs(config.instance.maintenance_folder)
             new_state = prepare_maintenance_dict(
                 status=status,
                 activation_requested_at=now,
                 activated_at=activated_at,
                 remaining_executions=remaining_executions,
                 requested_by=user)
-            utils.write_dict_to_json_file(maintenance_file_path, new_state)
+            store_maintenance_state(new_state)
             return new_state
         if maintenance_action == 'deactivate':
-            if not os.path.isfile(maintenance_file_path):
+            if state is None:
                 return prepare_maintenance_dict(
                         MAINTENANCE_MODE_DEACTIVATED), 304
-            os.remove(maintenance_file_path)
+            remove_maintenance_state()
             return prepare_maintenance_dict(MAINTENANCE_MODE_DEACTIVATED)
         valid_actions = ['activate', 'deactivate']
         raise BadParametersError(
@@ -14,7 +14,8 @@
 #  * limitations under the License.
 
 from manager_rest.security.authorization import authorize
-from manager_rest.dsl_functions import evaluate_intrinsic_functions
+from manager_rest.dsl_functions import (EvaluationContext,
+                                        evaluate_intrinsic_functions)
 
 from .. import rest_decorators
 from ..resources_v1.nodes import NodeInstancesId as v1_NodeInstancesId
@@ -29,9 +30,13 @@ class Nodes(v2_Nodes):
         # object, to avoid setting evaluated secrets in the node's properties
         nodes = super(Nodes, self).get(*args, **kwargs)
         if evaluate_functions:
+            # Share the loaded instances and secrets between the nodes
+            evaluation_context = EvaluationContext()
             for node in nodes['items']:
-                evaluate_intrinsic_functions(node['properties'],
-                                             node['deployment_id'])
+                evaluate_intrinsic_functions(
+                    node['properties'],
+                    node['deployment_id'],
+                    evaluation_context=evaluation_context)
         return nodes
 
 
@@ -31,7 +31,8 @@ from .plugins import (                           # NOQA
 
 from .deployments import (                       # NOQA
     DeploymentsId,
-    DeploymentsSetVisibility
+    DeploymentsSetVisibility,
+    EvaluateOutputs
 )
 
 from .blueprints import (                        # NOQA
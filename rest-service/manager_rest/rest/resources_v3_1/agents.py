@@ -42,4 +42,5 @@ class Agents(SecuredResource):
             deployment_id=args.get('deployment_id'),
             node_ids=args.get('node_ids'),
             node_instance_ids=args.get('node_instance_ids'),
-            install_method=args.get('install_methods'))
+            install_method=args.get('install_methods'),
+            pagination=pagination)
@@ -18,11 +18,16 @@ from flask_restful.inputs import boolean
 
 from manager_rest.storage import models
 from manager_rest.security import SecuredResource
+from manager_rest.dsl_functions import evaluate_deployments_outputs
 from manager_rest.security.authorization import authorize
 from manager_rest.resource_manager import get_resource_manager
 from manager_rest.storage.models_states import VisibilityState
 from manager_rest.maintenance import is_bypass_maintenance_mode
-from manager_rest.rest import rest_utils, resources_v1, rest_decorators
+from manager_rest.rest import (rest_utils,
+                               resources_v1,
+                               rest_decorators,
+                               responses)
+from manager_rest.rest.responses_v2 import ListResponse
 from manager_rest.rest.rest_utils import (get_args_and_verify_arguments,
                                           get_json_and_verify_params)
 
@@ -85,3 +90,27 @@ class DeploymentsSetVisibility(SecuredResource):
         return get_resource_manager().set_visibility(models.Deployment,
                                                      deployment_id,
                                                      visibility)
+
+
+class EvaluateOutputs(SecuredResource):
+
+    @rest_decorators.exceptions_handled
+    @authorize('deployment_modification_outputs')
+    @rest_decorators.marshal_with(responses.DeploymentOutputs)
+    def post(self, **kwargs):
+        """
+        Evaluate the outputs of several deployments
+        """
+        request_dict = get_json_and_verify_params({
+            'deployment_ids': {'type': list}
+        })
+        deployment_ids = []
+        for deployment_id in request_dict['deployment_ids']:
+            if deployment_id not in deployment_ids:
+                deployment_ids.append(deployment_id)
+        outputs = evaluate_deployments_outputs(deployment_ids)
+        items = [dict(deployment_id=deployment_id,
+                      outputs=outputs[deployment_id])
+                 for deployment_id in deployment_ids]
+        pagination = {'total': len(items), 'size': len(items), 'offset': 0}
+        return ListResponse(items=items, metadata={'pagination': pagination})
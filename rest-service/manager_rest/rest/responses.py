@@ -63,12 +63,14 @@ class Status(object):
 
     resource_fields = {
         'status': fields.String,
-        'services': fields.Raw
+        'services': fields.Raw,
+        'services_collected_at': fields.String
     }
 
     def __init__(self, **kwargs):
         self.status = kwargs.get('status')
         self.services = kwargs.get('services')
+        self.services_collected_at = kwargs.get('services_collected_at')
 
 
 @swagger.model
@@ -30,6 +30,7 @@ from .resource_models import (Blueprint,
                               Deployment,
                               Node,
                               NodeInstance,
+                              Agent,
                               Execution,
                               Event,
                               Log,
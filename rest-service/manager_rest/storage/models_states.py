@@ -33,6 +33,15 @@ class SnapshotState(object):
     END_STATES = [CREATED, FAILED, UPLOADED]
 
 
+class BlueprintUploadState(object):
+    PARSING = 'parsing'
+    UPLOADED = 'uploaded'
+    INVALID = 'invalid'
+
+    STATES = [PARSING, UPLOADED, INVALID]
+    END_STATES = [UPLOADED, INVALID]
+
+
 class ExecutionState(object):
     TERMINATED = 'terminated'
     FAILED = 'failed'
@@ -18,13 +18,16 @@ from datetime import datetime
 
 from sqlalchemy import case
 from flask_restful import fields as flask_fields
+from sqlalchemy.orm import deferred, validates
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.associationproxy import association_proxy
 
+from dsl_parser import constants as dsl_constants
+
 from manager_rest import config
 from manager_rest.rest.responses import Workflow
-from manager_rest.utils import classproperty, files_in_folder
+from manager_rest.utils import classproperty
 from manager_rest.deployment_update.constants import ACTION_TYPES, ENTITY_TYPES
 from manager_rest.constants import (FILE_SERVER_PLUGINS_FOLDER,
                                     FILE_SERVER_RESOURCES_FOLDER)
@@ -37,6 +40,7 @@ from .models_base import (
 from .relationships import foreign_key, one_to_many_relationship
 from .resource_models_base import SQLResourceBase
 from .models_states import (DeploymentModificationState,
+                            BlueprintUploadState,
                             SnapshotState,
                             ExecutionState)
 
@@ -48,14 +52,46 @@ class Blueprint(SQLResourceBase):
 
     skipped_fields = dict(
         SQLResourceBase.skipped_fields,
-        v1=['main_file_name', 'description']
+        v1=['main_file_name', 'description', 'state', 'error'],
+        v2=['state', 'error']
     )
 
     created_at = db.Column(UTCDateTime, nullable=False, index=True)
     main_file_name = db.Column(db.Text, nullable=False)
-    plan = db.Column(db.PickleType, nullable=False)
+    # The plan can be huge, so it's only loaded when actually accessed.
+    # It is empty until a blueprint uploaded asynchronously is parsed
+    plan = deferred(db.Column(db.PickleType))
     updated_at = db.Column(UTCDateTime)
     description = db.Column(db.Text)
+    state = db.Column(db.Enum(*BlueprintUploadState.STATES,
+                              name='blueprint_upload_state'))
+    error = db.Column(db.Text)
+
+    # A summary of the plan's plugins, kept in sync with the plan, so that
+    # starting executions doesn't require loading the whole plan
+    workflow_plugins_to_install = db.Column(db.PickleType)
+    deployment_plugins_to_install = db.Column(db.PickleType)
+    # Identifies the archive and parser inputs the plan was parsed from,
+    # so that re-uploading the same archive reuses the plan
+    plan_digest = db.Column(db.Text, index=True)
+
+    @validates('plan')
+    def _summarize_plan(self, key, plan):
+        if plan is None:
+            return plan
+        self.workflow_plugins_to_install = plan.get(
+            dsl_constants.WORKFLOW_PLUGINS_TO_INSTALL, [])
+        self.deployment_plugins_to_install = plan.get(
+            dsl_constants.DEPLOYMENT_PLUGINS_TO_INSTALL, [])
+        return plan
+
+    @classproperty
+    def response_fields(cls):
+        fields = super(Blueprint, cls).response_fields
+        fields.pop('workflow_plugins_to_install')
+        fields.pop('deployment_plugins_to_install')
+        fields.pop('plan_digest')
+        return fields
 
 
 class Snapshot(SQLResourceBase):
@@ -64,6 +100,8 @@ class Snapshot(SQLResourceBase):
     created_at = db.Column(UTCDateTime, nullable=False, index=True)
     status = db.Column(db.Enum(*SnapshotState.STATES, name='snapshot_status'))
     error = db.Column(db.Text)
+    # The snapshot this one is incremental to, if any
+    base_snapshot_id = db.Column(db.Text, index=True)
 
 
 class Plugin(SQLResourceBase):
@@ -81,33 +119,32 @@ class Plugin(SQLResourceBase):
     supported_py_versions = db.Column(db.PickleType)
     uploaded_at = db.Column(UTCDateTime, nullable=False, index=True)
     wheels = db.Column(db.PickleType, nullable=False)
+    # The name of the plugin's yaml file in its file server directory,
+    # recorded at upload time ('' if only a wagon was uploaded). None means
+    # it wasn't recorded: the plugin was uploaded by an older version, and
+    # its files weren't there when the snapshot restore recorded the names
+    yaml_file_name = db.Column(db.Text)
 
     def yaml_file_path(self):
-        plugin_dir = path.join(config.instance.file_server_root,
-                               FILE_SERVER_PLUGINS_FOLDER,
-                               self.id)
-        if not path.isdir(plugin_dir):
+        if not self.yaml_file_name:
             return None
-        yaml_files = files_in_folder(plugin_dir, '*.yaml')
-        return yaml_files[0] if yaml_files else None
-
-    def _yaml_file_name(self):
-        yaml_path = self.yaml_file_path()
-        return path.basename(yaml_path) if yaml_path else ''
+        return path.join(config.instance.file_server_root,
+                         FILE_SERVER_PLUGINS_FOLDER,
+                         self.id,
+                         self.yaml_file_name)
 
     @property
     def file_server_path(self):
-        file_name = self._yaml_file_name()
-        if not file_name:
+        if not self.yaml_file_name:
             return ''
         return path.join(FILE_SERVER_RESOURCES_FOLDER,
                          FILE_SERVER_PLUGINS_FOLDER,
                          self.id,
-                         file_name)
+                         self.yaml_file_name)
 
     @property
     def yaml_url_path(self):
-        if not self._yaml_file_name():
+        if not self.yaml_file_name:
             return ''
         return 'plugin:{0}?version={1}&distribution={2}'.format(
             self.package_name,
@@ -118,6 +155,7 @@ class Plugin(SQLResourceBase):
     @classproperty
     def response_fields(cls):
         fields = super(Plugin, cls).response_fields
+        fields.pop('yaml_file_name')
         fields['file_server_path'] = flask_fields.String
         fields['yaml_url_path'] = flask_fields.String
         return fields
@@ -227,6 +265,24 @@ class Execution(SQLResourceBase):
 
     _deployment_fk = foreign_key(Deployment._storage_id, nullable=True)
 
+    # Partial indexes used by the execution scheduler. Only queued and
+    # active executions are indexed, so they stay small regardless of the
+    # number of executions that have already ended
+    __table_args__ = (
+        db.Index(
+            'executions_queued_created_at_idx',
+            created_at,
+            postgresql_where=status.in_(ExecutionState.QUEUED_STATE),
+            sqlite_where=status.in_(ExecutionState.QUEUED_STATE)
+        ),
+        db.Index(
+            'executions_active_deployment_fk_idx',
+            _deployment_fk,
+            postgresql_where=status.in_(ExecutionState.ACTIVE_STATES),
+            sqlite_where=status.in_(ExecutionState.ACTIVE_STATES)
+        ),
+    )
+
     @declared_attr
     def deployment(cls):
         return one_to_many_relationship(cls, Deployment, cls._deployment_fk)
@@ -516,4 +572,41 @@ class NodeInstance(SQLResourceBase):
         self._set_parent(node)
         self.node = node
 
+
+class Agent(SQLResourceBase):
+    """The agent of a started node instance, as described by the instance's
+    `cloudify_agent` runtime property.
+
+    Kept up to date whenever the instance's runtime properties or state are
+    updated, so that agents can be filtered and paginated in the DB, without
+    loading all the node instances.
+    """
+    __tablename__ = 'agents'
+
+    ip = db.Column(db.Text)
+    host_id = db.Column(db.Text)
+    install_method = db.Column(db.Text, index=True)
+    system = db.Column(db.Text)
+    version = db.Column(db.Text)
+    node_id = db.Column(db.Text, index=True)
+    deployment_id = db.Column(db.Text, index=True)
+
+    _node_instance_fk = foreign_key(NodeInstance._storage_id, index=True)
+
+    @declared_attr
+    def node_instance(cls):
+        return one_to_many_relationship(cls,
+                                        NodeInstance,
+                                        cls._node_instance_fk)
+
+    def set_node_instance(self, node_instance):
+        self._set_parent(node_instance)
+        self.node_instance = node_instance
+
+    def to_response(self, **kwargs):
+        response = super(Agent, self).to_response(**kwargs)
+        response['node'] = self.node_id
+        response['deployment'] = self.deployment_id
+        return response
+
 # endregion
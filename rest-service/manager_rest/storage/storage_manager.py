@@ -15,11 +15,13 @@
 
 import psutil
 from collections import OrderedDict
+from contextlib import contextmanager
 from flask_security import current_user
-from sqlalchemy import or_ as sql_or, func
+from sqlalchemy import or_ as sql_or, func, inspect
 from sqlalchemy.exc import SQLAlchemyError
 from flask import current_app, has_request_context
 from sqlite3 import DatabaseError as SQLiteDBError
+from sqlalchemy.orm import undefer
 from sqlalchemy.orm.attributes import flag_modified
 
 from manager_rest.storage.models_base import db
@@ -35,12 +37,21 @@ except ImportError:
     Psycopg2DBError = None
 
 
+# Key in the session's info dict, counting the open `transaction` blocks
+_TRANSACTION_DEPTH = 'transaction_depth'
+
+
 class SQLStorageManager(object):
     @staticmethod
     def _safe_commit():
         """Try to commit changes in the session. Roll back if exception raised
         Excepts SQLAlchemy errors and rollbacks if they're caught
+
+        Inside a `transaction` block nothing is committed: the changes are
+        left in the session, and committed when the block exits.
         """
+        if db.session.info.get(_TRANSACTION_DEPTH):
+            return
         try:
             db.session.commit()
         except sql_errors as e:
@@ -49,6 +60,30 @@ class SQLStorageManager(object):
                 'SQL Storage error: {0}'.format(str(e))
             )
 
+    @contextmanager
+    def transaction(self):
+        """Apply all the changes made in the block in a single transaction
+
+        The puts, updates and deletes done inside the block aren't
+        committed one by one; the session flushes them together (so that
+        they can be sent in batches) and commits once, when the block
+        exits. If the block raises, all of its changes are rolled back.
+        Nested blocks are part of the outermost block's transaction.
+        """
+        info = db.session.info
+        depth = info.get(_TRANSACTION_DEPTH, 0)
+        info[_TRANSACTION_DEPTH] = depth + 1
+        try:
+            yield
+        except BaseException:
+            info[_TRANSACTION_DEPTH] = depth
+            if not depth:
+                db.session.rollback()
+            raise
+        info[_TRANSACTION_DEPTH] = depth
+        if not depth:
+            self._safe_commit()
+
     def _get_base_query(self, model_class, include, joins):
         """Create the initial query from the model class and included columns
 
@@ -328,6 +363,18 @@ class SQLStorageManager(object):
             # Put a label on the remote attribute with the name of the column
             return column.remote_attr.label(column_name)
 
+    @staticmethod
+    def _undefer_columns(query, model_class):
+        """Load deferred columns together with the listed rows, instead of
+        issuing a separate query per row when they are accessed
+        """
+        deferred_columns = [attr.key
+                            for attr in inspect(model_class).column_attrs
+                            if attr.deferred]
+        if deferred_columns:
+            query = query.options(*[undefer(c) for c in deferred_columns])
+        return query
+
     @staticmethod
     def _paginate(query, pagination, get_all_results=False):
         """Paginate the query by size and offset
@@ -534,6 +581,8 @@ class SQLStorageManager(object):
                                 substr_filters,
                                 sort,
                                 all_tenants)
+        if not include:
+            query = self._undefer_columns(query, model_class)
 
         results, total, size, offset = self._paginate(query,
                                                       pagination,
@@ -1,3 +1,5 @@
+from multiprocessing.pool import ThreadPool
+
 import dbus
 
 SYSTEMD_BUS = 'org.freedesktop.systemd1'
@@ -13,13 +15,18 @@ UNIT_PROPERTIES = ['Id', 'Description', 'LoadState', 'ActiveState',
 
 class DBusClient(object):
 
-    def __init__(self):
-        self.bus = dbus.SystemBus()
+    def __init__(self, private=False):
+        self.bus = dbus.SystemBus(private=private)
         self.proxy = self.bus.get_object(SYSTEMD_BUS, SYSTEMD_PATH)
         self.interface = dbus.Interface(self.proxy, MANAGER_IFACE)
 
-    def get_properties(self, name, prop_names, property_interface):
-        objpath = self.interface.GetUnit(name)
+    def close(self):
+        self.bus.close()
+
+    def get_properties(self, name, prop_names, property_interface,
+                       objpath=None):
+        if objpath is None:
+            objpath = self.interface.GetUnit(name)
         proxy = self.bus.get_object(SYSTEMD_BUS, objpath)
         interface = dbus.Interface(proxy, PROP_IFACE)
         properties = interface.GetAll(property_interface)
@@ -33,32 +40,66 @@ class DBusClient(object):
             properties = tmp_properties
         return properties
 
-    def get_unit_properties(self, unit_name, property_names=None):
+    def get_unit_properties(self, unit_name, property_names=None,
+                            objpath=None):
         if property_names is None:
             property_names = UNIT_PROPERTIES
-        return self.get_properties(unit_name, property_names, UNIT_IFACE)
+        return self.get_properties(unit_name, property_names, UNIT_IFACE,
+                                   objpath=objpath)
 
-    def get_service_properties(self, unit_name, property_names=None):
+    def get_service_properties(self, unit_name, property_names=None,
+                               objpath=None):
         if property_names is None:
             property_names = SVC_PROPERTIES
-        return self.get_properties(unit_name, property_names, SVC_IFACE)
+        return self.get_properties(unit_name, property_names, SVC_IFACE,
+                                   objpath=objpath)
 
-
-def get_services(units):
-    out = []
-    client = DBusClient()
-    for unit_id, display_name in units.iteritems():
-        service = {}
-        service['display_name'] = display_name
-        service['unit_id'] = unit_id
-        service['instances'] = []
+    def get_service(self, unit_id, display_name):
+        service = {
+            'display_name': display_name,
+            'unit_id': unit_id,
+            'instances': []
+        }
         try:
+            objpath = self.interface.GetUnit(unit_id)
             instance = {}
-            instance.update(client.get_unit_properties(unit_id))
-            instance.update(client.get_service_properties(unit_id))
+            instance.update(self.get_unit_properties(unit_id,
+                                                     objpath=objpath))
+            instance.update(self.get_service_properties(unit_id,
+                                                        objpath=objpath))
             instance['state'] = instance['SubState']
             service['instances'].append(instance)
         except dbus.exceptions.DBusException:
             pass
-        out.append(service)
-    return out
+        return service
+
+
+def _get_services(units):
+    # Each thread uses its own connection, so that the threads' calls
+    # aren't serialized on a shared one
+    client = DBusClient(private=True)
+    try:
+        return [client.get_service(unit_id, display_name)
+                for unit_id, display_name in units]
+    finally:
+        client.close()
+
+
+def get_services(units, concurrency=4):
+    """Get the status of the systemd `units`, a dict of
+    {unit_id: display_name}.
+
+    The units are split between up to `concurrency` threads.
+    """
+    units = list(units.iteritems())
+    concurrency = max(1, min(concurrency, len(units)))
+    if concurrency == 1:
+        return _get_services(units)
+    groups = [units[i::concurrency] for i in range(concurrency)]
+    pool = ThreadPool(concurrency)
+    try:
+        results = pool.map(_get_services, groups)
+    finally:
+        pool.close()
+        pool.join()
+    return [service for group in results for service in group]
@@ -14,14 +14,19 @@
 #  * limitations under the License.
 
 import os
-import tempfile
 import shutil
+import zipfile
+import tempfile
 
+import mock
 from manager_rest.test.attribute import attr
 
 from manager_rest import archiving
 from manager_rest.test import base_test
-from manager_rest.storage import FileServer
+from manager_rest.storage import FileServer, models
+from manager_rest.resource_manager import ResourceManager
+from manager_rest.upload_manager import (UploadedBlueprintsManager,
+                                         _zip_plugins)
 from .test_utils import generate_progress_func
 from cloudify_rest_client.exceptions import CloudifyClientError
 
@@ -77,6 +82,16 @@ class BlueprintsTestCase(base_test.BaseServerTestCase):
     def test_put_blueprint_archive(self):
         self._test_put_blueprint_archive(archiving.make_targzfile, 'tar.gz')
 
+    def test_put_blueprint_archive_too_large(self):
+        with mock.patch('manager_rest.upload_manager._max_upload_size',
+                        return_value=10):
+            response = self.put_file(
+                *self.put_blueprint_args(blueprint_id='too_large'))
+        self.assertEqual(413, response.status_code)
+        self.assertEqual('payload_too_large_error',
+                         response.json['error_code'])
+        self.assertEqual(0, len(self.client.blueprints.list()))
+
     def test_post_without_application_file_form_data(self):
         post_blueprints_response = self.put_file(
             *self.put_blueprint_args('blueprint_with_workflows.yaml',
@@ -95,6 +110,151 @@ class BlueprintsTestCase(base_test.BaseServerTestCase):
         self.assertEquals("this is my blueprint's description",
                           post_blueprints_response['description'])
 
+    def test_blueprint_plugins_summary(self):
+        self.put_file(*self.put_blueprint_args(blueprint_id='hello_world'))
+        blueprint = self.sm.get(models.Blueprint, 'hello_world')
+        self.assertEqual(
+            blueprint.plan['workflow_plugins_to_install'],
+            blueprint.workflow_plugins_to_install)
+        self.assertEqual(
+            blueprint.plan['deployment_plugins_to_install'],
+            blueprint.deployment_plugins_to_install)
+
+        response = self.client.blueprints.get('hello_world')
+        self.assertNotIn('workflow_plugins_to_install', response)
+        self.assertIn('plan', response)
+
+    def test_put_same_archive_reuses_plan(self):
+        resource_path, archive_path, query_params = \
+            self.put_blueprint_args(blueprint_id='first')
+        self.put_file(resource_path, archive_path, query_params)
+        with mock.patch('dsl_parser.tasks.parse_dsl') as mock_parse_dsl:
+            response = self.put_file(
+                resource_path.replace('first', 'second'),
+                archive_path,
+                query_params)
+        self.assertEqual(201, response.status_code)
+        self.assertFalse(mock_parse_dsl.called)
+        first = self.sm.get(models.Blueprint, 'first')
+        second = self.sm.get(models.Blueprint, 'second')
+        self.assertEqual(first.plan, second.plan)
+        self.assertEqual(first.plan_digest, second.plan_digest)
+
+        # A new plugin may change how `plugin:` imports are resolved
+        self.upload_plugin('cloudify-script-plugin', '1.2')
+        with mock.patch('dsl_parser.tasks.parse_dsl',
+                        return_value={}) as mock_parse_dsl:
+            self.put_file(resource_path.replace('first', 'third'),
+                          archive_path,
+                          query_params)
+        self.assertTrue(mock_parse_dsl.called)
+
+    def test_plan_imports_digest(self):
+        resources_base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, resources_base)
+        archive_dir = os.path.join(resources_base, 'archive')
+        os.makedirs(os.path.join(resources_base, 'types'))
+
+        def write(path, imports):
+            with open(os.path.join(resources_base, path), 'w') as f:
+                f.write('imports: [{0}]\n'.format(', '.join(imports)))
+
+        def imports_digest():
+            return ResourceManager._get_imports_digest(
+                archive_dir, 'blueprint.yaml', resources_base)
+
+        os.makedirs(archive_dir)
+        write('archive/blueprint.yaml',
+              ['inner.yaml', 'types/types.yaml', 'plugin:some-plugin'])
+        write('archive/inner.yaml', [])
+        write('types/types.yaml', [])
+        digest = imports_digest()
+        self.assertIsNotNone(digest)
+
+        # files imported from the file server are part of the digest
+        write('types/types.yaml', ['other.yaml'])
+        write('types/other.yaml', [])
+        self.assertNotIn(imports_digest(), [None, digest])
+
+        # anything imported from elsewhere can't be cached
+        write('archive/inner.yaml', ['http://example.com/types.yaml'])
+        self.assertIsNone(imports_digest())
+        write('archive/inner.yaml', ['/etc/types.yaml'])
+        self.assertIsNone(imports_digest())
+        write('archive/inner.yaml', ['missing.yaml'])
+        self.assertIsNone(imports_digest())
+
+    @attr(client_min_version=3.1,
+          client_max_version=base_test.LATEST_API_VERSION)
+    def test_put_blueprint_async(self):
+        resource_path, archive_path, query_params = \
+            self.put_blueprint_args(blueprint_id='async_blueprint')
+        query_params['async_upload'] = True
+        response = self.put_file(resource_path,
+                                 archive_path,
+                                 query_params).json
+        self.assertEqual('parsing', response['state'])
+        self.assertIsNone(response['plan'])
+        executions = self.client.executions.list(
+            workflow_id='upload_blueprint', include_system_workflows=True)
+        self.assertEqual(1, len(executions))
+        self.assertEqual({'blueprint_id': 'async_blueprint'},
+                         executions[0].parameters)
+        self.assertRaises(CloudifyClientError,
+                          self.client.deployments.create,
+                          'async_blueprint',
+                          'async_deployment')
+        # The upload isn't a system-wide execution, so it doesn't block
+        # executions of other deployments
+        self.put_deployment(deployment_id='other_deployment',
+                            blueprint_id='other_blueprint')
+        self.client.executions.start('other_deployment', 'install')
+
+        # This is what the upload_blueprint system workflow runs
+        UploadedBlueprintsManager.parse_uploaded_blueprint(
+            self.server_configuration.file_server_root, 'async_blueprint')
+        blueprint = self.client.blueprints.get('async_blueprint')
+        self.assertEqual('uploaded', blueprint['state'])
+        self.assertIsNone(blueprint['error'])
+        self.assertIn('nodes', blueprint['plan'])
+
+    @attr(client_min_version=3.1,
+          client_max_version=base_test.LATEST_API_VERSION)
+    def test_put_blueprint_async_unexpected_error(self):
+        resource_path, archive_path, query_params = \
+            self.put_blueprint_args(blueprint_id='async_blueprint')
+        query_params['async_upload'] = True
+        self.put_file(resource_path, archive_path, query_params)
+
+        with mock.patch.object(UploadedBlueprintsManager, '_process_plugins',
+                               side_effect=IOError('disk error')):
+            self.assertRaises(
+                IOError,
+                UploadedBlueprintsManager.parse_uploaded_blueprint,
+                self.server_configuration.file_server_root,
+                'async_blueprint')
+        blueprint = self.client.blueprints.get('async_blueprint')
+        self.assertEqual('invalid', blueprint['state'])
+        self.assertIn('disk error', blueprint['error'])
+
+    @attr(client_min_version=3.1,
+          client_max_version=base_test.LATEST_API_VERSION)
+    def test_put_blueprint_async_submit_error(self):
+        resource_path, archive_path, query_params = \
+            self.put_blueprint_args(blueprint_id='async_blueprint')
+        query_params['async_upload'] = True
+
+        with mock.patch('manager_rest.resource_manager.ResourceManager.'
+                        'parse_blueprint_in_background',
+                        side_effect=RuntimeError('no workflow')):
+            response = self.put_file(resource_path,
+                                     archive_path,
+                                     query_params)
+        self.assertEqual(500, response.status_code)
+        blueprint = self.client.blueprints.get('async_blueprint')
+        self.assertEqual('invalid', blueprint['state'])
+        self.assertIn('no workflow', blueprint['error'])
+
     def test_get_blueprint_by_id(self):
         post_blueprints_response = self.put_file(
             *self.put_blueprint_args()).json
@@ -138,6 +298,33 @@ class BlueprintsTestCase(base_test.BaseServerTestCase):
         self.check_if_resource_on_fileserver('hello_world',
                                              'plugins/stub-installer.zip')
 
+    def test_zip_plugins(self):
+        plugins_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, plugins_dir)
+        plugin_names = ['plugin_{0}'.format(i) for i in range(3)]
+        for name in plugin_names:
+            os.makedirs(os.path.join(plugins_dir, name, 'src'))
+            for filename in ['src/plugin.py', 'plugin.wgn']:
+                with open(os.path.join(plugins_dir, name, filename),
+                          'w') as f:
+                    f.write(name * 100)
+
+        _zip_plugins(plugins_dir, concurrency=2)
+
+        for name in plugin_names:
+            with zipfile.ZipFile(os.path.join(plugins_dir,
+                                              name + '.zip')) as zip_file:
+                infos = {info.filename: info
+                         for info in zip_file.infolist()}
+                self.assertEqual({name + '/src/plugin.py',
+                                  name + '/plugin.wgn'}, set(infos))
+                self.assertEqual(name * 100,
+                                 zip_file.read(name + '/src/plugin.py'))
+            self.assertEqual(zipfile.ZIP_DEFLATED,
+                             infos[name + '/src/plugin.py'].compress_type)
+            self.assertEqual(zipfile.ZIP_STORED,
+                             infos[name + '/plugin.wgn'].compress_type)
+
     def test_put_blueprint_archive_from_url(self):
         port = 53230
         blueprint_id = 'new_blueprint_id'
@@ -17,6 +17,7 @@ from manager_rest.deployment_update.step_extractor import (
 from manager_rest.deployment_update.step_extractor \
     import EntityIdBuilder, StepExtractor, \
     DeploymentUpdateStep
+from manager_rest.deployment_update.utils import index_relationships
 from manager_rest.test.utils import get_resource
 
 
@@ -156,8 +157,9 @@ class StepExtractorTestCase(base_test.BaseServerTestCase):
 
         topologically_sorted_added_nodes = ['node_f', 'node_a', 'node_b',
                                             'node_c', 'node_d', 'node_e']
+        add_node_steps = self.step_extractor._extract_add_node_steps(steps)
         self.step_extractor._update_topology_order_of_add_node_steps(
-            steps, topologically_sorted_added_nodes)
+            add_node_steps, topologically_sorted_added_nodes)
 
         self.assertEquals(5, add_node_e_step.topology_order)
         self.assertEquals(4, add_node_d_step.topology_order)
@@ -202,13 +204,10 @@ class StepExtractorTestCase(base_test.BaseServerTestCase):
         }
         self.step_extractor.new_deployment_plan = new_deployment_plan
 
-        # mock the _extract_added_nodes_names call
-        node_names = ['node_a', 'node_b', 'node_c',
-                      'node_d', 'node_e', 'node_f']
-        with patch.object(self.step_extractor, '_extract_added_nodes_names',
-                          return_value=node_names):
-            # create the added nodes graph
-            graph = self.step_extractor._create_added_nodes_graph('stub')
+        # create the added nodes graph
+        node_names = {'node_a', 'node_b', 'node_c',
+                      'node_d', 'node_e', 'node_f'}
+        graph = self.step_extractor._create_added_nodes_graph(node_names)
 
         # create the graph we expected to get from _create_added_nodes_graph
         expected_graph = nx.DiGraph()
@@ -1415,10 +1414,11 @@ class StepExtractorTestCase(base_test.BaseServerTestCase):
 
         self.assertEquals(
             ({'type': 'typeA', 'target_id': 'id_1', 'field2': 'value2'}, 0),
-            _get_matching_relationship(relationship, relationships_with_match))
+            _get_matching_relationship(
+                relationship, index_relationships(relationships_with_match)))
 
         self.assertEquals((None, None), _get_matching_relationship(
-            relationship, relationships_with_no_match))
+            relationship, index_relationships(relationships_with_no_match)))
 
     def test_sort_steps_compare_action(self):
 
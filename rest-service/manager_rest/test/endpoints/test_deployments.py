@@ -18,10 +18,13 @@ import os
 import uuid
 import exceptions
 
+from mock import patch
+
 from manager_rest.test.attribute import attr
 
 from manager_rest.test import base_test
 from manager_rest import manager_exceptions
+from manager_rest.dsl_functions import EvaluationContext
 from manager_rest.constants import DEFAULT_TENANT_NAME
 from cloudify_rest_client.exceptions import CloudifyClientError
 from cloudify_rest_client.deployments import Deployment
@@ -441,6 +444,86 @@ class DeploymentsTestCase(base_test.BaseServerTestCase):
         self.assertIn("More than one node instance found for node",
                       outputs['outputs']['ip_address'])
 
+    def test_evaluation_context_single_lookups(self):
+        id_ = 'i{0}'.format(uuid.uuid4())
+        self.put_deployment(
+            blueprint_file_name='blueprint_with_outputs.yaml',
+            blueprint_id=id_,
+            deployment_id=id_)
+        vm_instance = self.client.node_instances.list(
+            deployment_id=id_, node_id='vm')[0]
+        evaluation_context = EvaluationContext(self.sm)
+        with patch.object(self.sm, 'list', wraps=self.sm.list) as sm_list, \
+                patch.object(self.sm, 'get', wraps=self.sm.get) as sm_get:
+            methods = evaluation_context.get_methods(id_)
+            for _ in range(2):
+                instance = methods['get_node_instance_method'](
+                    vm_instance.id)
+        # a single instance is looked up directly, and only once
+        self.assertEqual(0, sm_list.call_count)
+        self.assertEqual(1, sm_get.call_count)
+        self.assertEqual(vm_instance.id, instance.id)
+
+    def test_evaluation_context_prefetch(self):
+        id_ = 'i{0}'.format(uuid.uuid4())
+        self.put_deployment(
+            blueprint_file_name='blueprint_with_outputs.yaml',
+            blueprint_id=id_,
+            deployment_id=id_)
+        evaluation_context = EvaluationContext(self.sm)
+        with patch.object(self.sm, 'list', wraps=self.sm.list) as sm_list, \
+                patch.object(self.sm, 'get', wraps=self.sm.get) as sm_get:
+            evaluation_context.prefetch([id_])
+            methods = evaluation_context.get_methods(id_)
+            instances = methods['get_node_instances_method']()
+            vm_instances = methods['get_node_instances_method']('vm')
+            instance = methods['get_node_instance_method'](
+                vm_instances[0].id)
+            node = methods['get_node_method']('vm')
+            self.assertRaises(manager_exceptions.NotFoundError,
+                              methods['get_node_method'], 'no_such_node')
+        # one query for the nodes, and one for the node instances
+        self.assertEqual(2, sm_list.call_count)
+        self.assertEqual(0, sm_get.call_count)
+        self.assertEqual(2, len(instances))
+        self.assertEqual(['vm'], [i.node_id for i in vm_instances])
+        self.assertEqual(vm_instances[0], instance)
+        self.assertEqual('vm', node.id)
+
+    @attr(client_min_version=3.1,
+          client_max_version=base_test.LATEST_API_VERSION)
+    def test_bulk_outputs(self):
+        deployment_ids = ['i{0}'.format(uuid.uuid4()) for _ in range(2)]
+        for index, id_ in enumerate(deployment_ids):
+            self.put_deployment(
+                blueprint_file_name='blueprint_with_outputs.yaml',
+                blueprint_id=id_,
+                deployment_id=id_)
+            instances = self.client.node_instances.list(deployment_id=id_)
+            vm = [x for x in instances if x.node_id == 'vm'][0]
+            self.client.node_instances.update(
+                vm.id, runtime_properties={'ip': '10.0.0.{0}'.format(index)})
+
+        response = self.post('/api/v3.1/evaluate/outputs', {
+            'deployment_ids': deployment_ids + deployment_ids[:1]
+        })
+        self.assertEqual(200, response.status_code)
+        items = response.json['items']
+        self.assertEqual(deployment_ids,
+                         [item['deployment_id'] for item in items])
+        for index, item in enumerate(items):
+            self.assertEqual(
+                '10.0.0.{0}'.format(index), item['outputs']['ip_address'])
+            self.assertEqual(
+                self.client.deployments.outputs.get(
+                    item['deployment_id']).outputs,
+                item['outputs'])
+
+        response = self.post('/api/v3.1/evaluate/outputs', {
+            'deployment_ids': [deployment_ids[0], 'no-such-deployment']
+        })
+        self.assertEqual(404, response.status_code)
+
     @attr(client_min_version=3.1,
           client_max_version=base_test.LATEST_API_VERSION)
     def test_creation_failure_when_plugin_not_found_central_deployment(self):
@@ -63,6 +63,45 @@ class DeploymentUpdateTestCase(unittest.TestCase):
         # assert nothing is return on invalid blueprint
         self.assertEqual(len(utils.get_raw_node({'no_nodes': 1}, 1)), 0)
 
+    def test_get_raw_node_duplicate_ids(self):
+        blueprint_to_test = {
+            'nodes': [{'id': 1, 'name': 'n1'}, {'id': 1, 'name': 'n2'}]
+        }
+
+        # assert the first node with the id is returned, like a scan would
+        self.assertDictEqual(utils.get_raw_node(blueprint_to_test, 1),
+                             {'id': 1, 'name': 'n1'})
+
+    def test_index_relationships(self):
+        relationships = [
+            {'type': 'typeA', 'target_id': 'id_1', 'field': 1},
+            {'type': 'typeB', 'target_id': 'id_1'},
+            {'type': 'typeA', 'target_id': 'id_1', 'field': 2}
+        ]
+        relationships_index = utils.index_relationships(relationships)
+
+        self.assertEqual(2, len(relationships_index))
+        self.assertEqual((relationships[0], 0),
+                         relationships_index[('typeA', 'id_1')])
+        self.assertEqual((relationships[1], 1),
+                         relationships_index[('typeB', 'id_1')])
+
+    def test_nodes_index(self):
+        class StorageNode(object):
+            def __init__(self, node_id):
+                self.id = node_id
+
+        raw_nodes = [{'id': 'n1'}, {'id': 'n2'}, {'id': 'n1', 'dup': True}]
+        nodes_index = utils.NodesIndex(raw_nodes)
+        self.assertIs(raw_nodes[0], nodes_index.get('n1'))
+        self.assertIn('n2', nodes_index)
+        self.assertIsNone(nodes_index.get('n3'))
+
+        storage_nodes = [StorageNode('n1'), StorageNode('n2')]
+        nodes_index = utils.NodesIndex(storage_nodes)
+        self.assertIs(storage_nodes[1], nodes_index.get('n2'))
+        self.assertNotIn('n3', nodes_index)
+
     def test_parse_index(self):
         self.assertEqual(utils.parse_index('[15]'), 15)
         self.assertFalse(utils.parse_index('[abc]'))
@@ -715,6 +715,47 @@ class ExecutionsTestCase(BaseServerTestCase):
             except exceptions.CloudifyClientError, e:
                 self.assertEqual(expected_status_code, e.status_code)
 
+    @attr(client_min_version=3.1, client_max_version=LATEST_API_VERSION)
+    def test_queued_execution_starts_when_deployment_is_free(self):
+        _, deployment_id, _, _ = self.put_deployment(self.DEPLOYMENT_ID)
+        execution = self.client.executions.start(deployment_id, 'install')
+        self._modify_execution_status_in_database(
+            execution=execution,
+            new_status=ExecutionState.STARTED)
+
+        queued = self.client.executions.start(deployment_id,
+                                              'install',
+                                              queue=True)
+        self.assertEqual(ExecutionState.QUEUED, queued.status)
+
+        self._modify_execution_status(execution.id, ExecutionState.TERMINATED)
+        dequeued = self.client.executions.get(queued.id)
+        self.assertEqual(ExecutionState.TERMINATED, dequeued.status)
+
+    @attr(client_min_version=3.1, client_max_version=LATEST_API_VERSION)
+    def test_queued_execution_waits_for_its_deployment(self):
+        _, deployment_id, _, _ = self.put_deployment(self.DEPLOYMENT_ID)
+        _, other_deployment_id, _, _ = self.put_deployment(
+            deployment_id='other_deployment',
+            blueprint_id='other_blueprint')
+        execution = self.client.executions.start(deployment_id, 'install')
+        self._modify_execution_status_in_database(
+            execution=execution,
+            new_status=ExecutionState.STARTED)
+        other_execution = self.client.executions.start(other_deployment_id,
+                                                       'install')
+        self._modify_execution_status_in_database(
+            execution=other_execution,
+            new_status=ExecutionState.STARTED)
+
+        queued = self.client.executions.start(deployment_id,
+                                              'install',
+                                              queue=True)
+        self._modify_execution_status(other_execution.id,
+                                      ExecutionState.TERMINATED)
+        still_queued = self.client.executions.get(queued.id)
+        self.assertEqual(ExecutionState.QUEUED, still_queued.status)
+
     def test_get_non_existent_execution(self):
         resource_path = '/executions/idonotexist'
         response = self.get(resource_path)
@@ -13,10 +13,18 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+import os
+
 import mock
+from flask import current_app, request
 from manager_rest.test.attribute import attr
 
 from manager_rest.test import base_test
+from manager_rest.app_context import (ResolverWithPlugins,
+                                      get_plugin_catalog,
+                                      invalidate_plugin_catalogs)
+from manager_rest.storage import models
+from manager_rest.manager_exceptions import InvalidPluginError
 from cloudify_rest_client.exceptions import CloudifyClientError
 from dsl_parser import constants
 from dsl_parser.utils import ResolverInstantiationError
@@ -97,3 +105,58 @@ class UploadBlueprtinsWithImportResolverTests(base_test.BaseServerTestCase):
                 self.fail('CloudifyClientError expected')
             except CloudifyClientError, ex:
                 self.assertIn(err_msg, str(ex))
+
+
+@attr(client_min_version=2, client_max_version=base_test.LATEST_API_VERSION)
+class ResolverWithPluginsTests(base_test.BaseServerTestCase):
+
+    def test_resolve_plugin_import(self):
+        old_plugin = self.upload_plugin('cloudify-script-plugin', '1.1').json
+        new_plugin = self.upload_plugin('cloudify-script-plugin', '1.2').json
+        resolver = ResolverWithPlugins()
+
+        with mock.patch('glob.glob') as mock_glob:
+            yaml_url = resolver._resolve_plugin_yaml_url(
+                'plugin:cloudify-script-plugin')
+            self.assertIn(new_plugin['id'], yaml_url)
+            yaml_url = resolver._resolve_plugin_yaml_url(
+                'plugin:cloudify-script-plugin?version=1.1')
+            self.assertIn(old_plugin['id'], yaml_url)
+        # the yaml file names are stored with the plugins
+        self.assertFalse(mock_glob.called)
+        self.assertTrue(os.path.isfile(yaml_url[len('file://'):]))
+
+        self.assertRaises(InvalidPluginError,
+                          resolver._resolve_plugin_yaml_url,
+                          'plugin:cloudify-script-plugin?version=1.3')
+
+    def test_resolve_plugin_without_recorded_yaml(self):
+        uploaded = self.upload_plugin('cloudify-script-plugin', '1.1').json
+        # The snapshot restore records the yaml file names of older
+        # plugins; resolving imports doesn't look them up or store them
+        plugin = self.sm.get(models.Plugin, uploaded['id'])
+        plugin.yaml_file_name = None
+        self.sm.update(plugin)
+        invalidate_plugin_catalogs()
+
+        with mock.patch('glob.glob') as mock_glob:
+            self.assertRaises(InvalidPluginError,
+                              ResolverWithPlugins()._resolve_plugin_yaml_url,
+                              'plugin:cloudify-script-plugin')
+        self.assertFalse(mock_glob.called)
+        self.assertIsNone(self.sm.get(models.Plugin,
+                                      uploaded['id']).yaml_file_name)
+
+    def test_plugin_catalogs_cache_size(self):
+        invalidate_plugin_catalogs()
+        with mock.patch('manager_rest.app_context.'
+                        'MAX_CACHED_PLUGIN_CATALOGS', 2), \
+                mock.patch('manager_rest.app_context.current_user') as user:
+            for user_id in [1, 2, 1, 3]:
+                user.id = user_id
+                if hasattr(request, 'plugin_catalog'):
+                    del request.plugin_catalog
+                get_plugin_catalog()
+        # the least recently used catalog is dropped
+        self.assertEqual([1, 3], [user_id for _, user_id
+                                  in current_app.plugin_catalogs])
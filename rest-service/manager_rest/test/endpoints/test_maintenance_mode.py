@@ -71,6 +71,23 @@ class MaintenanceModeTest(BaseServerTestCase):
         state = utils.read_json_file(maintenance_file)
         self.assertEqual(state['status'], MAINTENANCE_MODE_ACTIVATED)
 
+    def test_maintenance_state_is_cached(self):
+        self._activate_maintenance_mode()
+        with patch('manager_rest.maintenance.utils.read_json_file') as read:
+            self.client.manager.get_version()
+            self.client.maintenance_mode.status()
+        self.assertFalse(read.called)
+
+    def test_maintenance_state_changed_by_another_process(self):
+        self._activate_maintenance_mode()
+        os.remove(os.path.join(self.maintenance_mode_dir,
+                               MAINTENANCE_MODE_STATUS_FILE))
+        with patch('manager_rest.maintenance.STATE_CHECK_INTERVAL', 0):
+            # not denied: the removed status file was noticed
+            self.client.blueprints.list()
+            self.assertEqual(MAINTENANCE_MODE_DEACTIVATED,
+                             self.client.maintenance_mode.status().status)
+
     def test_request_denial_in_maintenance_mode(self):
         self._activate_maintenance_mode()
         self.assertRaises(exceptions.MaintenanceModeActiveError,
@@ -391,6 +391,49 @@ class NodesTest(base_test.BaseServerTestCase):
 
         self.assertEqual(cm.exception.status_code, 404)
 
+    @attr(client_min_version=3.1,
+          client_max_version=base_test.LATEST_API_VERSION)
+    def test_patch_node_instance_updates_agents(self):
+        """Agents are listed as soon as their instance is started, and are
+        removed when the instance isn't started anymore
+        """
+        instance = self.put_node_instance(instance_id='vm_1',
+                                          deployment_id='dep')
+        instance.node.type_hierarchy = ['cloudify.nodes.Root',
+                                        'cloudify.nodes.Compute']
+        instance.node.properties = {}
+        self.sm.update(instance.node)
+        self.put_node_instance(instance_id='vm_2', deployment_id='dep',
+                               node_id='not_compute')
+        agent = {'ip': '10.0.0.1',
+                 'install_method': 'remote',
+                 'distro': 'centos',
+                 'distro_codename': 'core',
+                 'version': '4.5'}
+        for instance_id in ['vm_1', 'vm_2']:
+            self.client.node_instances.update(
+                instance_id,
+                state='started',
+                runtime_properties={'cloudify_agent': agent},
+                version=1)
+
+        response = self.get('/agents', query_params={'_size': 1}).json
+        self.assertEqual(1, response['metadata']['pagination']['total'])
+        self.assertEqual([{
+            'id': 'vm_1',
+            'host_id': None,
+            'ip': '10.0.0.1',
+            'install_method': 'remote',
+            'system': 'centos core',
+            'version': '4.5',
+            'node': 'node_id',
+            'deployment': 'dep',
+        }], response['items'])
+
+        self.client.node_instances.update('vm_1', state='deleted', version=2)
+        response = self.get('/agents').json
+        self.assertEqual([], response['items'])
+
     def put_node_instance(self,
                           instance_id,
                           deployment_id,
@@ -4,6 +4,8 @@ import os
 from manager_rest.test.attribute import attr
 
 from manager_rest.test import base_test
+from manager_rest.resource_manager import get_resource_manager
+from manager_rest.storage.models_states import SnapshotState
 from .test_utils import generate_progress_func
 from manager_rest.test.base_test import BaseServerTestCase
 from cloudify_rest_client.exceptions import CloudifyClientError
@@ -27,6 +29,39 @@ class SnapshotsTest(BaseServerTestCase):
                                 False,
                                 False)
 
+    def test_create_incremental_snapshot_invalid_base(self):
+        response = self.put('/snapshots/snapshot_1',
+                            {'base_snapshot_id': 'missing'})
+        self.assertEqual(404, response.status_code)
+
+        get_resource_manager().create_snapshot_model(
+            'failed_snapshot', status=SnapshotState.FAILED)
+        response = self.put('/snapshots/snapshot_1',
+                            {'base_snapshot_id': 'failed_snapshot'})
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('snapshot_action_error',
+                         response.json['error_code'])
+        self.assertEqual(1, len(self.client.snapshots.list()))
+
+    def test_delete_base_snapshot(self):
+        rm = get_resource_manager()
+        rm.create_snapshot_model('base', status=SnapshotState.CREATED)
+        rm.create_snapshot_model('incremental',
+                                 status=SnapshotState.CREATED,
+                                 base_snapshot_id='base')
+        self.assertEqual('base',
+                         self.client.snapshots.get('incremental')
+                         ['base_snapshot_id'])
+
+        with self.assertRaises(CloudifyClientError) as cm:
+            self.client.snapshots.delete('base')
+        self.assertEqual(409, cm.exception.status_code)
+        self.assertIn('incremental', str(cm.exception))
+
+        self.client.snapshots.delete('incremental')
+        self.client.snapshots.delete('base')
+        self.assertEqual(0, len(self.client.snapshots.list()))
+
     @attr(client_min_version=3,
           client_max_version=base_test.LATEST_API_VERSION)
     def test_snapshot_upload_progress(self):
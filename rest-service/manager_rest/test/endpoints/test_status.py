@@ -13,9 +13,12 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+from mock import patch
+
 from manager_rest.test.attribute import attr
 
 from manager_rest.test import base_test
+from manager_rest.rest.resources_v1 import status
 
 
 @attr(client_min_version=1, client_max_version=base_test.LATEST_API_VERSION)
@@ -28,3 +31,18 @@ class StatusTestCase(base_test.BaseServerTestCase):
     def test_get_services(self):
         result = self.get('/status')
         self.assertEqual(type(result.json['services']), list)
+
+    def test_services_status_is_cached(self):
+        services = [{'display_name': 'Webserver',
+                     'unit_id': 'nginx.service',
+                     'instances': [{'state': 'running'}]}]
+        with patch.object(status, 'get_services',
+                          return_value=services) as get_services, \
+                patch.object(status, '_services_status',
+                             status._ServicesStatus()):
+            first = self.get('/status').json
+            second = self.get('/status').json
+        self.assertEqual(1, get_services.call_count)
+        self.assertEqual(services, first['services'])
+        self.assertEqual(first, second)
+        self.assertTrue(first['services_collected_at'])
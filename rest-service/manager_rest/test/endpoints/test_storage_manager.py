@@ -13,11 +13,13 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+from mock import patch
+
 from manager_rest.test.attribute import attr
 
 from manager_rest import utils
 from manager_rest.test import base_test
-from manager_rest.storage import models
+from manager_rest.storage import db, models
 from manager_rest.storage.models_states import VisibilityState
 from manager_rest.manager_exceptions import IllegalActionError
 
@@ -216,3 +218,36 @@ class StorageManagerTests(base_test.BaseServerTestCase):
             get_all_results=True
         )
         self.assertEquals(1001, len(secret_list))
+
+    def _make_secret(self, secret_id):
+        now = utils.get_formatted_timestamp()
+        return models.Secret(id=secret_id,
+                             value='value',
+                             created_at=now,
+                             updated_at=now,
+                             visibility=VisibilityState.TENANT)
+
+    def test_transaction(self):
+        with patch.object(db.session, 'commit',
+                          wraps=db.session.commit) as commit:
+            with self.sm.transaction():
+                self.sm.put(self._make_secret('secret_1'))
+                self.sm.put(self._make_secret('secret_2'))
+                with self.sm.transaction():
+                    self.sm.put(self._make_secret('secret_3'))
+                self.assertFalse(commit.called)
+        self.assertEqual(1, commit.call_count)
+        self.assertEquals(3, len(self.sm.list(models.Secret)))
+
+    def test_transaction_rollback(self):
+        self.sm.put(self._make_secret('secret_1'))
+        with self.assertRaises(RuntimeError):
+            with self.sm.transaction():
+                self.sm.put(self._make_secret('secret_2'))
+                raise RuntimeError()
+        secrets = self.sm.list(models.Secret)
+        self.assertEquals(['secret_1'], [secret.id for secret in secrets])
+
+        # after the rollback, changes are committed immediately again
+        self.sm.put(self._make_secret('secret_3'))
+        self.assertEquals(2, len(self.sm.list(models.Secret)))
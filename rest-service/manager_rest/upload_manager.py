@@ -15,6 +15,7 @@
 
 import os
 import json
+import hashlib
 import tarfile
 import uuid
 
@@ -25,6 +26,7 @@ import shutil
 import zipfile
 import tempfile
 import contextlib
+from multiprocessing.pool import ThreadPool
 
 from setuptools import archive_util
 from urllib2 import urlopen, URLError
@@ -40,9 +42,11 @@ from manager_rest.constants import (FILE_SERVER_PLUGINS_FOLDER,
 from manager_rest.deployment_update.manager import \
     get_deployment_updates_manager
 from manager_rest.archiving import get_archive_type
-from manager_rest.storage.models import Plugin
-from manager_rest.storage.models_states import SnapshotState
-from manager_rest import config, chunked, manager_exceptions
+from manager_rest.storage import db, get_storage_manager
+from manager_rest.storage.models import Blueprint, Plugin
+from manager_rest.storage.models_states import (BlueprintUploadState,
+                                                SnapshotState)
+from manager_rest import app_context, config, chunked, manager_exceptions
 from manager_rest.utils import (mkdirs,
                                 get_formatted_timestamp,
                                 current_tenant,
@@ -56,10 +60,122 @@ from manager_rest.rest.rest_utils import get_args_and_verify_arguments
 
 _PRIVATE_RESOURCE = 'private_resource'
 _VISIBILITY = 'visibility'
+_FORM_MIMETYPES = ('multipart/form-data', 'application/x-www-form-urlencoded')
+# Files that are compressed already are stored in plugin zips as they are,
+# since deflating them again takes time and saves next to no space.
+# Snapshots store the same files as they are too, see COMPRESSED_EXTENSIONS
+# in cloudify_system_workflows.snapshots.constants; keep the two identical
+# (the system workflows are installed without the REST service package)
+_COMPRESSED_EXTENSIONS = ('.wgn', '.whl', '.zip', '.gz', '.tgz', '.bz2',
+                          '.xz', '.egg', '.jar')
+
+# Uploaded archives are written to disk in chunks of this size, so that
+# memory usage doesn't depend on the size of the archive
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# How many plugins of a blueprint are zipped at the same time
+ZIP_PLUGINS_CONCURRENCY = 4
+
+
+def _read_chunks(source, chunk_size=UPLOAD_CHUNK_SIZE):
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _max_upload_size():
+    return (config.instance.max_upload_size_mb or 0) * 1024 * 1024
+
+
+def _verify_upload_size(size, data_type):
+    max_size = _max_upload_size()
+    if max_size and size > max_size:
+        raise manager_exceptions.PayloadTooLargeError(
+            'The {0} archive is bigger than the maximum allowed upload '
+            'size ({1}MB)'.format(data_type,
+                                  config.instance.max_upload_size_mb))
+
+
+def _stream_to_file(chunks, target_path, data_type):
+    """Write `chunks` to `target_path` one at a time, verifying the size
+    of the written data doesn't exceed the maximum upload size
+
+    :return: The sha256 hex digest of the written data
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(target_path, 'wb') as f:
+        for chunk in chunks:
+            size += len(chunk)
+            _verify_upload_size(size, data_type)
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def _has_request_body():
+    """Was the archive passed as the raw request body?
+
+    Unlike `request.data`, this doesn't read the body into memory.
+    """
+    return bool(request.content_length) and \
+        request.mimetype not in _FORM_MIMETYPES
+
+
+def _zip_dir(dir_to_zip, target_zip_path):
+    zipf = zipfile.ZipFile(target_zip_path, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        plugin_dir_base_name = os.path.basename(dir_to_zip)
+        rootlen = len(dir_to_zip) - len(plugin_dir_base_name)
+        for base, dirs, files in os.walk(dir_to_zip):
+            for entry in files:
+                fn = os.path.join(base, entry)
+                if entry.lower().endswith(_COMPRESSED_EXTENSIONS):
+                    compress_type = zipfile.ZIP_STORED
+                else:
+                    compress_type = zipfile.ZIP_DEFLATED
+                zipf.write(fn, fn[rootlen:], compress_type)
+    finally:
+        zipf.close()
+
+
+def _zip_plugins(plugins_directory, concurrency=ZIP_PLUGINS_CONCURRENCY):
+    """Zip each plugin directory in `plugins_directory` to a zip file next
+    to it.
+
+    Plugins are zipped in parallel by a pool of threads (zlib releases the
+    GIL while compressing). Threads are used rather than processes, because
+    forking a REST worker would copy its DB connections and session.
+    """
+    if not os.path.isdir(plugins_directory):
+        return
+    plugin_dirs = [os.path.join(plugins_directory, directory)
+                   for directory in os.listdir(plugins_directory)
+                   if os.path.isdir(os.path.join(plugins_directory,
+                                                 directory))]
+    jobs = [(plugin_dir, '{0}.zip'.format(plugin_dir))
+            for plugin_dir in plugin_dirs]
+    if len(jobs) < 2:
+        for job in jobs:
+            _zip_dir(*job)
+        return
+    pool = ThreadPool(min(len(jobs), concurrency))
+    try:
+        pool.map(lambda job: _zip_dir(*job), jobs)
+    finally:
+        pool.close()
+        pool.join()
 
 
 class UploadedDataManager(object):
 
+    def __init__(self):
+        # The sha256 hex digest of the uploaded archive, computed while
+        # the archive is being saved
+        self.archive_digest = None
+
     def receive_uploaded_data(self, data_id=None, **kwargs):
         file_server_root = config.instance.file_server_root
         resource_target_path = tempfile.mktemp(dir=file_server_root)
@@ -129,7 +245,7 @@ class UploadedDataManager(object):
 
     @staticmethod
     def _save_file_from_url(archive_target_path, data_url, data_type):
-        if any([request.data,
+        if any([_has_request_body(),
                 'Transfer-Encoding' in request.headers,
                 'blueprint_archive' in request.files]):
             raise manager_exceptions.BadParametersError(
@@ -137,8 +253,9 @@ class UploadedDataManager(object):
                 ", multi-form and chunked.".format(data_type))
         try:
             with contextlib.closing(urlopen(data_url)) as urlf:
-                with open(archive_target_path, 'w') as f:
-                    f.write(urlf.read())
+                return _stream_to_file(_read_chunks(urlf),
+                                       archive_target_path,
+                                       data_type)
         except URLError:
             raise manager_exceptions.ParamUrlNotFoundError(
                     "URL {0} not found - can't download {1} archive"
@@ -150,14 +267,15 @@ class UploadedDataManager(object):
 
     @staticmethod
     def _save_file_from_chunks(archive_target_path, data_type):
-        if any([request.data,
+        if any([_has_request_body(),
                 'blueprint_archive' in request.files]):
             raise manager_exceptions.BadParametersError(
                 "Can't pass both a {0} URL via request body , multi-form "
                 "and chunked.".format(data_type))
-        with open(archive_target_path, 'w') as f:
-            for buffered_chunked in chunked.decode(request.input_stream):
-                f.write(buffered_chunked)
+        return _stream_to_file(chunked.decode(request.input_stream,
+                                              UPLOAD_CHUNK_SIZE),
+                               archive_target_path,
+                               data_type)
 
     @staticmethod
     def _save_file_content(archive_target_path, data_type):
@@ -165,9 +283,9 @@ class UploadedDataManager(object):
             raise manager_exceptions.BadParametersError(
                 "Can't pass both a {0} URL via request body , multi-form"
                 .format(data_type))
-        uploaded_file_data = request.data
-        with open(archive_target_path, 'w') as f:
-            f.write(uploaded_file_data)
+        return _stream_to_file(_read_chunks(request.stream),
+                               archive_target_path,
+                               data_type)
 
     def _save_files_multipart(self, archive_target_path):
         inputs = {}
@@ -187,25 +305,29 @@ class UploadedDataManager(object):
                 elif 'text' in content.content_type:
                     inputs = json.load(content)
             elif file_key == 'blueprint_archive':
-                self._save_bytes(request.files[file_key],
-                                 archive_target_path)
+                self.archive_digest = self._save_bytes(
+                    request.files[file_key],
+                    archive_target_path,
+                    self._get_kind())
         return inputs
 
     @staticmethod
-    def _save_bytes(content, target_path=None):
+    def _save_bytes(content, target_path=None, data_type='unknown'):
         """
         content should support read() function if target isn't supplied,
         string rep is returned
 
         :param content:
         :param target_path:
-        :return:
+        :return: the content if target isn't supplied, otherwise the sha256
+        hex digest of the content
         """
         if not target_path:
             return content.getvalue().decode("utf-8")
         else:
-            with open(target_path, 'wb') as f:
-                f.write(content.read())
+            return _stream_to_file(_read_chunks(content),
+                                   target_path,
+                                   data_type)
 
     def _save_file_locally_and_extract_inputs(self,
                                               archive_target_path,
@@ -221,18 +343,23 @@ class UploadedDataManager(object):
         :return: None
         """
         inputs = {}
+        if request.content_length:
+            _verify_upload_size(request.content_length, data_type)
 
         # Handling importing blueprint through url
         if url_key in request.args:
-            self._save_file_from_url(archive_target_path,
-                                     request.args[url_key],
-                                     data_type)
+            self.archive_digest = self._save_file_from_url(
+                archive_target_path,
+                request.args[url_key],
+                data_type)
         # handle receiving chunked blueprint
         elif 'Transfer-Encoding' in request.headers:
-            self._save_file_from_chunks(archive_target_path, data_type)
+            self.archive_digest = self._save_file_from_chunks(
+                archive_target_path, data_type)
         # handler receiving entire content through data
-        elif request.data:
-            self._save_file_content(archive_target_path, data_type)
+        elif _has_request_body():
+            self.archive_digest = self._save_file_content(
+                archive_target_path, data_type)
 
         # handle inputs from form-data (for both the blueprint and inputs
         # in body in form-data format)
@@ -311,9 +438,24 @@ class UploadedSnapshotsManager(UploadedDataManager):
                                  **kwargs):
         return get_resource_manager().create_snapshot_model(
             data_id,
-            status=SnapshotState.UPLOADED
+            status=SnapshotState.UPLOADED,
+            base_snapshot_id=self._read_base_snapshot_id(
+                archive_target_path)
         ), None
 
+    @staticmethod
+    def _read_base_snapshot_id(archive_path):
+        """Return the id of the snapshot that an uploaded incremental
+        snapshot is based on, as recorded in the archive's metadata
+        """
+        try:
+            with zipfile.ZipFile(archive_path) as zipf:
+                metadata = json.loads(zipf.read('metadata.json'))
+        except (IOError, KeyError, ValueError, zipfile.BadZipfile):
+            # Not a valid snapshot - restoring it will report that
+            return None
+        return metadata.get('base_snapshot_id')
+
 
 class UploadedBlueprintsDeploymentUpdateManager(UploadedDataManager):
 
@@ -434,32 +576,7 @@ class UploadedBlueprintsDeploymentUpdateManager(UploadedDataManager):
 
     @classmethod
     def _process_plugins(cls, file_server_root, app_dir):
-        plugins_directory = os.path.join(file_server_root, app_dir, 'plugins')
-        if not os.path.isdir(plugins_directory):
-            return
-        plugins = [os.path.join(plugins_directory, directory)
-                   for directory in os.listdir(plugins_directory)
-                   if os.path.isdir(os.path.join(plugins_directory,
-                                                 directory))]
-
-        for plugin_dir in plugins:
-            final_zip_name = '{0}.zip'.format(os.path.basename(plugin_dir))
-            target_zip_path = os.path.join(file_server_root, app_dir,
-                                           'plugins', final_zip_name)
-            cls._zip_dir(plugin_dir, target_zip_path)
-
-    @classmethod
-    def _zip_dir(cls, dir_to_zip, target_zip_path):
-        zipf = zipfile.ZipFile(target_zip_path, 'w', zipfile.ZIP_DEFLATED)
-        try:
-            plugin_dir_base_name = os.path.basename(dir_to_zip)
-            rootlen = len(dir_to_zip) - len(plugin_dir_base_name)
-            for base, dirs, files in os.walk(dir_to_zip):
-                for entry in files:
-                    fn = os.path.join(base, entry)
-                    zipf.write(fn, fn[rootlen:])
-        finally:
-            zipf.close()
+        _zip_plugins(os.path.join(file_server_root, app_dir, 'plugins'))
 
 
 class UploadedBlueprintsManager(UploadedDataManager):
@@ -487,59 +604,48 @@ class UploadedBlueprintsManager(UploadedDataManager):
                 file_server_root
             )
         visibility = kwargs.get(_VISIBILITY, None)
-        return self._prepare_and_submit_blueprint(file_server_root,
-                                                  application_dir,
-                                                  data_id,
-                                                  visibility), None
+        return self._prepare_and_submit_blueprint(
+            file_server_root,
+            application_dir,
+            data_id,
+            visibility,
+            archive_digest=self.archive_digest), None
 
     @classmethod
     def _process_plugins(cls, file_server_root, blueprint_id):
-        plugins_directory = os.path.join(
+        _zip_plugins(os.path.join(
             file_server_root,
             FILE_SERVER_BLUEPRINTS_FOLDER,
             current_tenant.name,
             blueprint_id,
-            "plugins")
-        if not os.path.isdir(plugins_directory):
-            return
-        plugins = [os.path.join(plugins_directory, directory)
-                   for directory in os.listdir(plugins_directory)
-                   if os.path.isdir(os.path.join(plugins_directory,
-                                                 directory))]
-
-        for plugin_dir in plugins:
-            final_zip_name = '{0}.zip'.format(os.path.basename(plugin_dir))
-            target_zip_path = os.path.join(plugins_directory, final_zip_name)
-            cls._zip_dir(plugin_dir, target_zip_path)
-
-    @classmethod
-    def _zip_dir(cls, dir_to_zip, target_zip_path):
-        zipf = zipfile.ZipFile(target_zip_path, 'w', zipfile.ZIP_DEFLATED)
-        try:
-            plugin_dir_base_name = os.path.basename(dir_to_zip)
-            rootlen = len(dir_to_zip) - len(plugin_dir_base_name)
-            for base, dirs, files in os.walk(dir_to_zip):
-                for entry in files:
-                    fn = os.path.join(base, entry)
-                    zipf.write(fn, fn[rootlen:])
-        finally:
-            zipf.close()
+            "plugins"))
 
     @classmethod
     def _prepare_and_submit_blueprint(cls,
                                       file_server_root,
                                       app_dir,
                                       blueprint_id,
-                                      visibility):
+                                      visibility,
+                                      archive_digest=None):
         args = get_args_and_verify_arguments([
             Argument('private_resource', type=boolean),
             Argument('visibility'),
             Argument('application_file_name',
-                     default='')])
+                     default=''),
+            Argument('async_upload', type=boolean, default=False)])
 
         app_file_name = cls._extract_application_file(
             file_server_root, app_dir, args.application_file_name)
 
+        if args.async_upload:
+            return cls._submit_blueprint_for_parsing(file_server_root,
+                                                     app_dir,
+                                                     app_file_name,
+                                                     blueprint_id,
+                                                     args.private_resource,
+                                                     visibility,
+                                                     archive_digest)
+
         # add to blueprints manager (will also dsl_parse it)
         try:
             blueprint = get_resource_manager().publish_blueprint(
@@ -548,7 +654,8 @@ class UploadedBlueprintsManager(UploadedDataManager):
                 file_server_root,
                 blueprint_id,
                 args.private_resource,
-                visibility
+                visibility,
+                archive_digest=archive_digest
             )
 
             # moving the app directory in the file server to be under a
@@ -567,6 +674,98 @@ class UploadedBlueprintsManager(UploadedDataManager):
             raise manager_exceptions.InvalidBlueprintError(
                 'Invalid blueprint - {0}'.format(ex.message))
 
+    @classmethod
+    def _submit_blueprint_for_parsing(cls,
+                                      file_server_root,
+                                      app_dir,
+                                      app_file_name,
+                                      blueprint_id,
+                                      private_resource,
+                                      visibility,
+                                      archive_digest):
+        """Store the blueprint in the `parsing` state, and leave the parsing
+        to the `upload_blueprint` system workflow.
+
+        Clients poll the blueprint until its state is either `uploaded` or
+        `invalid`.
+        """
+        resource_manager = get_resource_manager()
+        try:
+            blueprint = resource_manager.create_parsing_blueprint(
+                app_file_name,
+                blueprint_id,
+                private_resource,
+                visibility,
+                archive_digest=archive_digest,
+                application_dir=app_dir,
+                resources_base=file_server_root
+            )
+        except Exception:
+            shutil.rmtree(os.path.join(file_server_root, app_dir))
+            raise
+        try:
+            tenant_dir = os.path.join(
+                file_server_root,
+                FILE_SERVER_BLUEPRINTS_FOLDER,
+                current_tenant.name)
+            mkdirs(tenant_dir)
+            shutil.move(os.path.join(file_server_root, app_dir),
+                        os.path.join(tenant_dir, blueprint.id))
+            resource_manager.parse_blueprint_in_background(blueprint)
+        except Exception, ex:
+            # Nothing will parse the blueprint, so don't leave it in the
+            # parsing state forever
+            db.session.rollback()
+            shutil.rmtree(os.path.join(file_server_root, app_dir),
+                          ignore_errors=True)
+            cls._set_blueprint_invalid(
+                get_storage_manager(), blueprint,
+                'Failed submitting blueprint for parsing - {0}'.format(ex))
+            raise
+        return blueprint
+
+    @classmethod
+    def parse_uploaded_blueprint(cls, file_server_root, blueprint_id):
+        """Parse a blueprint that was uploaded asynchronously, and store
+        its plan. This runs in the `upload_blueprint` system workflow.
+        """
+        sm = get_storage_manager()
+        blueprint = sm.get(Blueprint, blueprint_id)
+        dsl_location = os.path.join(
+            file_server_root,
+            FILE_SERVER_BLUEPRINTS_FOLDER,
+            current_tenant.name,
+            blueprint.id,
+            blueprint.main_file_name)
+        resource_manager = get_resource_manager()
+        try:
+            plan = resource_manager.get_cached_plan(blueprint.plan_digest)
+            if plan is None:
+                plan = resource_manager.parse_plan(dsl_location,
+                                                   file_server_root)
+            cls._process_plugins(file_server_root, blueprint.id)
+        except manager_exceptions.DslParseException, ex:
+            return cls._set_blueprint_invalid(
+                sm, blueprint, 'Invalid blueprint - {0}'.format(ex.message))
+        except Exception, ex:
+            # Don't leave the blueprint in the parsing state forever
+            db.session.rollback()
+            cls._set_blueprint_invalid(
+                sm, blueprint, 'Failed parsing blueprint - {0}'.format(ex))
+            raise
+        blueprint.plan = plan
+        blueprint.description = plan.get('description')
+        blueprint.state = BlueprintUploadState.UPLOADED
+        blueprint.updated_at = get_formatted_timestamp()
+        return sm.update(blueprint)
+
+    @staticmethod
+    def _set_blueprint_invalid(sm, blueprint, error):
+        blueprint.state = BlueprintUploadState.INVALID
+        blueprint.error = error
+        blueprint.updated_at = get_formatted_timestamp()
+        return sm.update(blueprint)
+
     @classmethod
     def _extract_application_file(cls,
                                   file_server_root,
@@ -621,6 +820,7 @@ class UploadedPluginsManager(UploadedDataManager):
 
         # support previous implementation
         wagon_target_path = archive_target_path
+        yaml_target_path = None
 
         # handle the archive_target_path, which may be zip or wagon
         if not self._is_wagon_file(archive_target_path):
@@ -632,7 +832,7 @@ class UploadedPluginsManager(UploadedDataManager):
             os.remove(archive_target_path)
             shutil.move(archive_name, archive_target_path)
             try:
-                wagon_target_path, _ = \
+                wagon_target_path, yaml_target_path = \
                     self._verify_archive(archive_target_path)
             except RuntimeError as re:
                 raise manager_exceptions.InvalidPluginError(re.message)
@@ -646,6 +846,9 @@ class UploadedPluginsManager(UploadedDataManager):
                                                       wagon_target_path,
                                                       args.private_resource,
                                                       visibility)
+        # The archive's files are moved as is to the plugin's directory
+        new_plugin.yaml_file_name = \
+            os.path.basename(yaml_target_path) if yaml_target_path else ''
         filter_by_name = {'package_name': new_plugin.package_name}
         sm = get_resource_manager().sm
         plugins = sm.list(Plugin, filters=filter_by_name)
@@ -659,6 +862,7 @@ class UploadedPluginsManager(UploadedDataManager):
                                        package_name=new_plugin.package_name,
                                        version=new_plugin.package_version))
         sm.put(new_plugin)
+        app_context.invalidate_plugin_catalogs()
         return new_plugin, new_plugin.archive_name
 
     def _is_wagon_file(self, file_path):
@@ -0,0 +1,36 @@
+########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+from cloudify.workflows import ctx
+from cloudify.decorators import workflow
+
+from manager_rest import config, flask_utils
+from manager_rest.upload_manager import UploadedBlueprintsManager
+
+
+@workflow(system_wide=True)
+def upload(blueprint_id, **kwargs):
+    ctx.logger.info('Parsing blueprint `{0}`'.format(blueprint_id))
+    app = flask_utils.setup_flask_app()
+    flask_utils.set_admin_current_user(app)
+    tenant = flask_utils.get_tenant_by_name(ctx.tenant_name)
+    flask_utils.set_tenant_in_app(tenant)
+
+    blueprint = UploadedBlueprintsManager.parse_uploaded_blueprint(
+        config.instance.file_server_root, blueprint_id)
+    if blueprint.error:
+        ctx.logger.error(blueprint.error)
+    ctx.logger.info('Blueprint `{0}` is {1}'.format(blueprint_id,
+                                                    blueprint.state))
@@ -28,13 +28,15 @@ def create(snapshot_id, config, **kwargs):
     include_credentials = kwargs.get('include_credentials', False)
     include_logs = kwargs.get('include_logs', True)
     include_events = kwargs.get('include_events', True)
+    base_snapshot_id = kwargs.get('base_snapshot_id')
     create_snapshot = SnapshotCreate(
         snapshot_id,
         config,
         include_metrics,
         include_credentials,
         include_logs,
-        include_events
+        include_events,
+        base_snapshot_id
     )
     create_snapshot.create()
 
@@ -19,7 +19,6 @@ import json
 from cloudify.workflows import ctx
 from cloudify import broker_config
 from cloudify.manager import get_rest_client
-from cloudify_rest_client.exceptions import CloudifyClientError
 from cloudify.utils import get_broker_ssl_cert_path
 
 from .constants import V_4_1_0, V_4_4_0
@@ -42,21 +41,14 @@ class Agents(object):
             self._insert_agents_data(agents)
             return
         for tenant_name, deployments in agents.iteritems():
-            self._insert_agents_data(agents[tenant_name], tenant_name)
+            self._insert_agents_data(deployments, tenant_name)
 
     def dump(self, tempdir, manager_version):
         self._manager_version = manager_version
         result = {}
         for tenant_name in get_tenants_list():
-            result[tenant_name] = {}
             tenant_client = get_rest_client(tenant_name)
-            tenant_deployments = tenant_client.deployments.list(
-                _include=['id'],
-                _get_all_results=True
-            )
-            for deployment in tenant_deployments:
-                result[tenant_name][deployment.id] = \
-                    self._get_deployment_result(tenant_client, deployment.id)
+            result[tenant_name] = self._get_tenant_result(tenant_client)
         self._dump_result_to_file(tempdir, result)
 
     def _dump_result_to_file(self, tempdir, result):
@@ -64,29 +56,39 @@ class Agents(object):
         with open(agents_file_path, 'w') as out:
             out.write(json.dumps(result))
 
-    def _get_deployment_result(self, client, deployment_id):
-        deployment_result = {}
-        nodes_list = client.nodes.list(deployment_id=deployment_id,
-                                       _include=['id', 'type_hierarchy'],
-                                       _get_all_results=True)
-        for node in nodes_list:
-            if is_compute(node):
-                deployment_result[node.id] = self._get_node_result(
-                    client, deployment_id, node.id)
-        return deployment_result
+    def _get_tenant_result(self, client):
+        """Collect the agents of all the deployments of a tenant.
 
-    def _get_node_result(self, client, deployment_id, node_id):
-        node_result = {}
+        All the nodes and node instances of the tenant are listed at once,
+        instead of listing them per deployment and per node.
+        """
+        tenant_result = {}
+        for deployment in client.deployments.list(_include=['id'],
+                                                  _get_all_results=True):
+            tenant_result[deployment.id] = {}
+        compute_nodes = set()
+        for node in client.nodes.list(
+                _include=['id', 'deployment_id', 'type_hierarchy'],
+                _get_all_results=True):
+            if is_compute(node):
+                compute_nodes.add((node.deployment_id, node.id))
+                tenant_result.setdefault(node.deployment_id, {})[node.id] = {}
         for node_instance in client.node_instances.list(
-                deployment_id=deployment_id, node_name=node_id):
+                _include=['id', 'deployment_id', 'node_id', 'state',
+                          'runtime_properties'],
+                _get_all_results=True):
+            deployment_id = node_instance.deployment_id
+            node_id = node_instance.node_id
+            if (deployment_id, node_id) not in compute_nodes:
+                continue
             # Only patch agent config for nodes that have been initialized;
             # uninitialized nodes don't have an agent config yet in their
             # runtime properties
             if node_instance.state == 'uninitialized':
                 continue
-            node_result[node_instance.id] = self._get_node_instance_result(
-                node_instance)
-        return node_result
+            tenant_result[deployment_id][node_id][node_instance.id] = \
+                self._get_node_instance_result(node_instance)
+        return tenant_result
 
     def _get_node_instance_result(self, node_instance):
         """
@@ -105,42 +107,43 @@ class Agents(object):
         }
 
     def _insert_agents_data(self, agents, tenant_name=None):
+        node_instances = self._get_node_instances(tenant_name)
+        clients = {}
         for deployment_id, nodes in agents.iteritems():
             try:
-                self._create_agent(nodes, tenant_name)
+                self._create_agent(nodes, node_instances, clients)
             except Exception:
                 ctx.logger.warning(
                     'Failed restoring agents for deployment `{0}` in tenant '
                     '`{1}`'.format(deployment_id, tenant_name),
                     exc_info=True)
 
-    @classmethod
-    def _get_tenant_name(cls, node_instance_id):
-        """
+    @staticmethod
+    def _get_node_instances(tenant_name):
+        """Return a dict of {node instance id: node instance} of all the
+        node instances of a tenant.
+
         When restoring a snapshot from versions 4.0.0/4.0.1 the tenant name is
-        not defined and the only way to `guess` it is by finding the
-        node_instance from the agents.json file in the DB and checking its
-        tenant. Using list to scan all tenants and filter by id.
-        :param node_instance_id: a node instance from the agents.json file
-        :return: the tenant of the given node instance
+        not defined, and the only way to `guess` it is by finding the node
+        instances of the agents.json file in the DB and checking their
+        tenant, so the node instances of all the tenants are returned.
         """
-        client = get_rest_client()
-        try:
-            node_instance = client.node_instances.list(
-                _all_tenants=True, id=node_instance_id).items[0]
-            return node_instance['tenant_name']
-        except CloudifyClientError:
-            pass
-
-    def _create_agent(self, nodes, tenant_name):
-        client = None
-        for node_instances in nodes.itervalues():
-            for node_instance_id, agent in node_instances.iteritems():
+        client = get_rest_client(tenant_name)
+        node_instances = client.node_instances.list(
+            _all_tenants=tenant_name is None,
+            _include=['id', 'tenant_name', 'version', 'runtime_properties'],
+            _get_all_results=True)
+        return dict((node_instance.id, node_instance)
+                    for node_instance in node_instances)
+
+    def _create_agent(self, nodes, node_instances, clients):
+        for node_instances_agents in nodes.itervalues():
+            for node_instance_id, agent in node_instances_agents.iteritems():
                 broker_config = self._get_broker_config(agent)
-                tenant_name = tenant_name or self._get_tenant_name(
-                    node_instance_id)
-                client = client or get_rest_client(tenant_name)
-                node_instance = client.node_instances.get(node_instance_id)
+                node_instance = node_instances[node_instance_id]
+                tenant_name = node_instance['tenant_name']
+                if tenant_name not in clients:
+                    clients[tenant_name] = get_rest_client(tenant_name)
                 runtime_properties = node_instance.runtime_properties
                 old_agent = runtime_properties.get('cloudify_agent', {})
                 if not broker_config.get('broker_ip'):
@@ -157,7 +160,7 @@ class Agents(object):
                 if self._manager_version < V_4_4_0:
                     runtime_properties.pop('rest_tenant', None)
 
-                client.node_instances.update(
+                clients[tenant_name].node_instances.update(
                     node_instance_id=node_instance_id,
                     runtime_properties=runtime_properties,
                     version=node_instance.version
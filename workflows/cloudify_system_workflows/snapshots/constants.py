@@ -24,6 +24,11 @@ M_SCHEMA_REVISION = 'schema_revision'
 M_STAGE_SCHEMA_REVISION = 'stage_schema_revision'
 M_COMPOSER_SCHEMA_REVISION = 'composer_schema_revision'
 M_HAS_CLOUDIFY_EVENTS = 'has_cloudify_events'
+M_DUMP_TIMINGS = 'dump_timings'
+M_BASE_SNAPSHOT = 'base_snapshot_id'
+M_EVENTS_HIGH_WATER_MARK = 'events_high_water_mark'
+FILES_MANIFEST_FILENAME = 'files_manifest.json'
+BASE_SNAPSHOTS_DIR = 'base_snapshots'
 ARCHIVE_CERT_DIR = 'ssl'
 CERT_DIR = '/etc/cloudify/ssl'
 INTERNAL_CA_CERT_FILENAME = 'cloudify_internal_ca_cert.pem'
@@ -49,6 +54,21 @@ COMPOSER_CONFIG_FOLDER = 'backend/conf'
 COMPOSER_BLUEPRINTS_FOLDER = 'backend/dev'
 SECURITY_FILENAME = 'rest-security.conf'
 SECURITY_FILE_LOCATION = join('/opt/manager/', SECURITY_FILENAME)
+# Files that are already compressed, and are stored in the snapshot archive
+# without being deflated again. The same as the REST service's
+# manager_rest.upload_manager._COMPRESSED_EXTENSIONS, which can't be
+# imported here, since the REST service isn't installed with the workflows
+COMPRESSED_EXTENSIONS = ('.wgn', '.whl', '.zip', '.gz', '.tgz', '.bz2',
+                         '.xz', '.egg', '.jar')
+# How many plugins are installed, and how many deployment environments are
+# created, at the same time during a restore
+RESTORE_CONCURRENCY = 8
+# Bounds (in seconds) of the interval between checks of the status of the
+# plugin installation executions started by a restore
+EXECUTION_POLL_MIN_INTERVAL = 0.5
+EXECUTION_POLL_MAX_INTERVAL = 5
+# How many threads extract the snapshot archive
+EXTRACT_CONCURRENCY = 4
 
 V_4_0_0 = ManagerVersion('4.0.0')
 V_4_1_0 = ManagerVersion('4.1.0')
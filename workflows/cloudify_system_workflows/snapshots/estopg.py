@@ -14,15 +14,15 @@
 #    * limitations under the License.
 
 import os
+import csv
 import sys
 import json
 import logging
 import argparse
 
-from manager_rest import manager_exceptions
 from manager_rest import flask_utils
 from manager_rest import utils
-from manager_rest.storage import models, get_storage_manager
+from manager_rest.storage import db, models, get_storage_manager
 
 format_str = '%(asctime)s [%(name)s] %(levelname)s: %(message)s'
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG, format=format_str)
@@ -30,6 +30,23 @@ logger = logging.getLogger('estopg')
 
 COMPUTE_NODE_TYPE = 'cloudify.nodes.Compute'
 
+# The columns that are restored with COPY: events and logs share all of them
+# apart from the ones specific to each
+_EXECUTION_ITEM_COLUMNS = (
+    'id', 'timestamp', 'reported_timestamp', 'message', 'message_code',
+    'operation', 'node_id', '_execution_fk', '_tenant_id', '_creator_id',
+    'visibility',
+)
+EVENT_COLUMNS = _EXECUTION_ITEM_COLUMNS + ('event_type',)
+LOG_COLUMNS = _EXECUTION_ITEM_COLUMNS + ('logger', 'level')
+
+
+def _to_csv(value):
+    # None is written as an unquoted empty field, which COPY reads as NULL
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
 
 # Make storage manager work correctly
 os.environ["MANAGER_REST_CONFIG_PATH"] = (
@@ -159,74 +176,119 @@ class EsToPg(object):
 
     def _restore_events(self):
         """Restore events to postgres."""
-        for line in open(self._events_path, 'r'):
-            es_document = json.loads(line)
-            es_event = es_document['_source']
-            execution_id = es_event['context']['execution_id']
-            try:
-                execution = self._storage_manager.get(
-                    models.Execution,
-                    execution_id,
-                )
-            except manager_exceptions.NotFoundError:
-                logger.warning(
-                    'Event *not* added to database: %s. '
-                    'Execution not found: %s',
-                    es_document['_id'],
-                    execution_id,
-                )
-                continue
-
-            pg_event = {
-                'id': es_document['_id'],
-                'timestamp': es_event['@timestamp'],
-                'reported_timestamp': es_event['timestamp'],
-                'message': es_event['message']['text'],
-                'message_code': es_event['message_code'],
+        self._copy_execution_items(
+            models.Event,
+            self._events_path,
+            EVENT_COLUMNS,
+            lambda es_event: {
                 'event_type': es_event['event_type'],
-                'operation': es_event['context'].get('operation'),
-                'node_id': es_event['context'].get('node_id'),
-                'execution': execution,
             }
-            event = models.Event(**pg_event)
-            self._storage_manager.put(event)
-            logger.debug('Event added to database: %s', pg_event['id'])
+        )
 
     def _restore_logs(self):
         """Restore logs to postgres."""
-        for line in open(self._logs_path, 'r'):
-            es_document = json.loads(line)
-            es_log = es_document['_source']
-            execution_id = es_log['context']['execution_id']
-            try:
-                execution = self._storage_manager.get(
-                    models.Execution,
-                    execution_id,
-                )
-            except manager_exceptions.NotFoundError:
-                logger.warning(
-                    'Log not inserted into database: %s. '
-                    'Execution not found: %s',
-                    es_document['_id'],
-                    execution_id,
-                )
-                continue
-
-            pg_log = {
-                'id': es_document['_id'],
-                'timestamp': es_log['@timestamp'],
-                'reported_timestamp': es_log['timestamp'],
-                'message': es_log['message']['text'],
-                'message_code': es_log['message_code'],
+        self._copy_execution_items(
+            models.Log,
+            self._logs_path,
+            LOG_COLUMNS,
+            lambda es_log: {
                 'logger': es_log['logger'],
                 'level': es_log['level'],
-                'operation': es_log['context'].get('operation'),
-                'node_id': es_log['context'].get('node_id'),
-                'execution': execution,
             }
-            log = models.Log(**pg_log)
-            self._storage_manager.put(log)
-            logger.debug('Log added to database: %s', pg_log['id'])
+        )
+
+    def _get_executions(self):
+        """Return a dict of {execution id: the columns that the events and
+        logs of the execution take from it}, for all the executions of the
+        current tenant
+        """
+        execution = models.Execution
+        query = db.session.query(
+            execution.id,
+            execution._storage_id,
+            execution._tenant_id,
+            execution._creator_id,
+            execution.visibility,
+        ).filter(
+            execution._tenant_id == self._storage_manager.current_tenant.id
+        )
+        return dict(
+            (execution_id, {
+                '_execution_fk': storage_id,
+                '_tenant_id': tenant_id,
+                '_creator_id': creator_id,
+                'visibility': visibility,
+            })
+            for execution_id, storage_id, tenant_id, creator_id, visibility
+            in query
+        )
+
+    def _count_rows(self, model):
+        return db.session.query(model).filter(
+            model._tenant_id == self._storage_manager.current_tenant.id
+        ).count()
+
+    def _copy_execution_items(self, model, dump_path, columns, get_fields):
+        """Load the events or logs in `dump_path` into the table of `model`.
+
+        The ES documents are converted into a CSV file, which is loaded
+        with a single COPY. Items of executions that don't exist are skipped.
+
+        :param columns: The columns of the table the CSV file has
+        :param get_fields: Called with every ES document's source, returns
+                           the fields that are specific to `model`
+        """
+        item_name = model.__tablename__
+        executions = self._get_executions()
+        copy_path = '{0}.copy'.format(dump_path)
+        expected = 0
+        with open(copy_path, 'wb') as copy_file:
+            writer = csv.writer(copy_file)
+            for line in open(dump_path, 'r'):
+                es_document = json.loads(line)
+                es_item = es_document['_source']
+                execution_id = es_item['context']['execution_id']
+                if execution_id not in executions:
+                    logger.warning(
+                        'Item of %s *not* added to database: %s. '
+                        'Execution not found: %s',
+                        item_name,
+                        es_document['_id'],
+                        execution_id,
+                    )
+                    continue
+                fields = {
+                    'id': es_document['_id'],
+                    'timestamp': es_item['@timestamp'],
+                    'reported_timestamp': es_item['timestamp'],
+                    'message': es_item['message']['text'],
+                    'message_code': es_item['message_code'],
+                    'operation': es_item['context'].get('operation'),
+                    'node_id': es_item['context'].get('node_id'),
+                }
+                fields.update(get_fields(es_item))
+                fields.update(executions[execution_id])
+                writer.writerow([_to_csv(fields[column])
+                                 for column in columns])
+                expected += 1
+
+        try:
+            rows_before = self._count_rows(model)
+            with open(copy_path, 'rb') as copy_file:
+                cursor = db.session.connection().connection.cursor()
+                cursor.copy_expert(
+                    'COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)'.format(
+                        item_name, ', '.join(columns)),
+                    copy_file
+                )
+            db.session.commit()
+        finally:
+            os.remove(copy_path)
+        restored = self._count_rows(model) - rows_before
+        if restored != expected:
+            raise Exception('Restored {0} {1}, but {2} were expected'
+                            .format(restored, item_name, expected))
+        logger.debug('Restored %d %s', restored, item_name)
 
     def _get_node(self, node_id, deployment_id):
         nodes = self._storage_manager.list(
@@ -14,34 +14,79 @@
 #    * limitations under the License.
 
 import os
+import re
 import json
 import subprocess
+import collections
+
+import requests
 
 from cloudify.exceptions import NonRecoverableError
 
 
 class InfluxDB(object):
     _INFLUXDB = 'influxdb_data'
+    _INFLUXDB_SERIES_URL = 'http://localhost:8086/db/cloudify/series'
+    _INFLUXDB_AUTH = {'u': 'root', 'p': 'root'}
     _INFLUXDB_DUMP_CMD = ('curl -s -G "http://localhost:8086/db/cloudify/series'  # NOQA
                           '?u=root&p=root&chunked=true" --data-urlencode'
                           ' "q=select * from /.*/" > {0}')
-    _INFLUXDB_RESTORE_CMD = ('cat {0} | while read -r line; do curl -X POST '
-                             '-d "[${{line}}]" "http://localhost:8086/db/cloudify/'  # NOQA
-                             'series?u=root&p=root" ;done')
+    # How many points are sent to InfluxDB in a single request on restore
+    _RESTORE_BATCH_POINTS = 10000
+    _READ_CHUNK_SIZE = 1024 * 1024
+    _WHITESPACE = re.compile(r'\s*')
 
     @staticmethod
     def restore(tempdir):
         influxdb_f = os.path.join(tempdir, InfluxDB._INFLUXDB)
-        if os.path.exists(influxdb_f):
-            return_code = subprocess.call(
-                InfluxDB._INFLUXDB_RESTORE_CMD.format(influxdb_f),
-                shell=True
-            )
-            if return_code != 0:
-                raise NonRecoverableError(
-                    'Error during restoring InfluxDB data, '
-                    'error code: {0}'.format(return_code)
-                )
+        if not os.path.exists(influxdb_f):
+            return
+        session = requests.Session()
+        try:
+            with open(influxdb_f, 'r') as f:
+                series = InfluxDB._read_json_objects(f)
+                for batch in InfluxDB._get_batches(series):
+                    InfluxDB._write_batch(session, batch)
+        finally:
+            session.close()
+
+    @staticmethod
+    def _get_batches(series):
+        """Group the points of `series` into batches of about
+        _RESTORE_BATCH_POINTS points.
+
+        The points of a series that appears several times in a batch are
+        merged, so every batch is a list of series with distinct names and
+        columns.
+        """
+        batch = collections.OrderedDict()
+        batch_points = 0
+        for serie in series:
+            key = serie['name'], tuple(serie['columns'])
+            batch.setdefault(key, []).extend(serie['points'])
+            batch_points += len(serie['points'])
+            if batch_points >= InfluxDB._RESTORE_BATCH_POINTS:
+                yield InfluxDB._batch_to_series(batch)
+                batch = collections.OrderedDict()
+                batch_points = 0
+        if batch:
+            yield InfluxDB._batch_to_series(batch)
+
+    @staticmethod
+    def _batch_to_series(batch):
+        return [{'name': name, 'columns': list(columns), 'points': points}
+                for (name, columns), points in batch.items()]
+
+    @staticmethod
+    def _write_batch(session, batch):
+        try:
+            response = session.post(InfluxDB._INFLUXDB_SERIES_URL,
+                                    params=InfluxDB._INFLUXDB_AUTH,
+                                    data=json.dumps(batch))
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise NonRecoverableError(
+                'Error during restoring InfluxDB data: {0}'.format(e))
 
     @staticmethod
     def dump(tempdir):
@@ -55,36 +100,52 @@ class InfluxDB(object):
             raise NonRecoverableError('Error during dumping InfluxDB data, '
                                       'error code: {0}'.format(return_code))
         with open(influxdb_temp_file, 'r') as f, open(influxdb_file, 'w') as g:
-            for obj in InfluxDB._get_json_objects(f):
-                g.write(obj + os.linesep)
+            for obj in InfluxDB._read_json_objects(f):
+                g.write(json.dumps(obj) + os.linesep)
 
         os.remove(influxdb_temp_file)
 
     @staticmethod
-    def _get_json_objects(f):
-        def chunks(g):
-            ch = g.read(10000)
-            yield ch
-            while ch:
-                ch = g.read(10000)
-                yield ch
+    def _read_json_objects(f, chunk_size=None):
+        """Yield the JSON objects that are concatenated in `f`.
 
-        s = ''
-        n = 0
+        The file is read in chunks, which are only joined and decoded once
+        one of them could end an object (has a `}`). If that doesn't
+        complete the object, decoding isn't tried again until the unread
+        data doubles, so objects spanning many chunks aren't decoded over
+        and over.
+        """
+        chunk_size = chunk_size or InfluxDB._READ_CHUNK_SIZE
         decoder = json.JSONDecoder()
-        for ch in chunks(f):
-            s += ch
-            try:
-                while s:
-                    obj, idx = decoder.raw_decode(s)
-                    n += 1
-                    yield json.dumps(obj)
-                    s = s[idx:]
-            except Exception:
-                pass
-
-        # assert not n or not s
-        # not (not n or not s) -> n and s
-        if n and s:
+        chunks = []
+        pending = 0
+        next_attempt = 0
+        buf = ''
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                chunks.append(chunk)
+                pending += len(chunk)
+                if '}' not in chunk or pending < next_attempt:
+                    continue
+            buf = ''.join(chunks)
+            pos = 0
+            while True:
+                pos = InfluxDB._WHITESPACE.match(buf, pos).end()
+                if pos == len(buf):
+                    break
+                try:
+                    obj, pos = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # The object continues in the next chunks
+                    break
+                yield obj
+            buf = buf[pos:]
+            chunks = [buf] if buf else []
+            pending = len(buf)
+            next_attempt = 2 * pending
+            if not chunk:
+                break
+        if buf:
             raise NonRecoverableError('Error during converting InfluxDB dump '
                                       'data to data appropriate for snapshot.')
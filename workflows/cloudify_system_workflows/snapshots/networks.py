@@ -20,10 +20,10 @@ from .utils import is_compute
 
 
 class Networks(object):
-    _NETWORKS = 'networks.json'
+    NETWORKS_FILENAME = 'networks.json'
 
     def dump(self, tempdir, client):
-        networks_dump_path = join(tempdir, self._NETWORKS)
+        networks_dump_path = join(tempdir, self.NETWORKS_FILENAME)
         networks = self.get_networks_from_provider_context(client)
         active_networks = self._get_active_networks(client)
         output = {
@@ -88,6 +88,6 @@ class Networks(object):
 
     @staticmethod
     def get_networks_from_snapshot(tempdir):
-        networks_dump_path = join(tempdir, Networks._NETWORKS)
+        networks_dump_path = join(tempdir, Networks.NETWORKS_FILENAME)
         with open(networks_dump_path, 'r') as f:
             return json.load(f)
@@ -14,9 +14,12 @@
 #    * limitations under the License.
 
 import os
+import sys
+import glob
 import psycopg2
+import multiprocessing
 from uuid import uuid4
-from contextlib import closing
+from contextlib import closing, contextmanager
 from cryptography.fernet import Fernet
 from psycopg2.extras import execute_values
 
@@ -37,11 +40,26 @@ class Postgres(object):
     """
     _TRUNCATE_QUERY = "TRUNCATE {0} CASCADE;"
     _POSTGRES_DUMP_FILENAME = 'pg_data'
+    # Queries to run after restoring a custom format dump, which (unlike
+    # plain SQL dumps) can't be appended to
+    _POST_RESTORE_FILENAME = 'pg_data_post_restore.sql'
+    # Custom format dumps start with this signature
+    _CUSTOM_DUMP_SIGNATURE = 'PGDMP'
     _STAGE_DB_NAME = 'stage'
     _COMPOSER_DB_NAME = 'composer'
     _TABLES_TO_KEEP = ['alembic_version', 'provider_context', 'roles']
     _TABLES_TO_EXCLUDE_ON_DUMP = _TABLES_TO_KEEP + ['snapshots']
+    # Dumped separately from the rest of the DB, so that incremental
+    # snapshots only need to contain the rows added since their base
+    _EVENTS_TABLES = ['events', 'logs']
+    _EVENTS_DUMP_FILENAME = 'pg_{0}'
     _TABLES_TO_RESTORE = ['users', 'tenants']
+    # The rows that let the admin user log in to the default tenant, as
+    # (table, condition) tuples
+    _ADMIN_ROWS = [('users', 'id = 0'),
+                   ('tenants', 'id = 0'),
+                   ('users_roles', 'user_id = 0'),
+                   ('users_tenants', 'user_id = 0 AND tenant_id = 0')]
     _STAGE_TABLES_TO_EXCLUDE = ['"SequelizeMeta"']
     _COMPOSER_TABLES_TO_EXCLUDE = ['"SequelizeMeta"']
 
@@ -62,7 +80,17 @@ class Postgres(object):
     def restore(self, tempdir):
         ctx.logger.info('Restoring DB from postgres dump')
         dump_file = os.path.join(tempdir, self._POSTGRES_DUMP_FILENAME)
+        if self._is_custom_format_dump(dump_file):
+            self._restore_custom_format_dump(tempdir, dump_file)
+        else:
+            self._restore_plain_dump(dump_file)
 
+        self._make_api_token_keys()
+
+        ctx.logger.debug('Postgres restored')
+
+    def _restore_plain_dump(self, dump_file):
+        """Restore a plain SQL dump, made by older versions"""
         # Add to the beginning of the dump queries that recreate the schema
         clear_tables_queries = self._get_clear_tables_queries()
         dump_file = self._prepend_dump(dump_file, clear_tables_queries)
@@ -77,35 +105,280 @@ class Postgres(object):
 
         self._restore_dump(dump_file, self._db_name)
 
-        self._make_api_token_keys()
+    def _restore_custom_format_dump(self, tempdir, dump_file):
+        """Restore a custom format dump, with `pg_restore` loading the
+        tables in parallel.
+
+        The data of the tables is loaded concurrently, in no particular
+        order, so the foreign keys are dropped before it is loaded, and
+        created again (and validated) afterwards, like `pg_restore` does
+        when restoring the schema as well.
+
+        The tables are cleared before the data is loaded, and not in the
+        same transaction, so the dump is checked to be readable first.
+        If loading the data fails nonetheless, the admin user, the default
+        tenant and the current execution are put back, so that the manager
+        stays usable (e.g. to retry the restore). The foreign keys are then
+        created again without validating the partially loaded rows, and
+        the restore's error is raised.
+        """
+        self._check_custom_format_dump(dump_file)
+        # These read the current execution and admin user, so they're
+        # built before the tables are cleared
+        fix_up_queries = [self._get_execution_restore_query(),
+                          self._get_admin_user_update_query()]
+        self._execute(self._get_save_admin_rows_queries())
+        self._execute(self._get_clear_tables_queries())
+        foreign_keys = self._get_foreign_keys()
+        self._execute(
+            'ALTER TABLE {0} DROP CONSTRAINT {1};'.format(table, name)
+            for table, name, _ in foreign_keys)
+        # NOT VALID doesn't check the existing rows, so this can't fail on
+        # a partial restore; the rows are validated separately
+        add_foreign_keys_queries = [
+            'ALTER TABLE {0} ADD CONSTRAINT {1} {2} NOT VALID;'.format(
+                table, name, definition)
+            for table, name, definition in foreign_keys]
+        try:
+            self._restore_dump_parallel(dump_file, self._db_name)
+        except Exception:
+            exc_info = sys.exc_info()
+            try:
+                self._execute(add_foreign_keys_queries)
+                self._execute(self._get_restore_admin_rows_queries())
+                self._execute(fix_up_queries)
+            except Exception as e:
+                ctx.logger.error('Failed recovering the admin user after '
+                                 'the failed restore: {0}'.format(e))
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._execute(add_foreign_keys_queries)
+        self._execute(
+            'ALTER TABLE {0} VALIDATE CONSTRAINT {1};'.format(table, name)
+            for table, name, _ in foreign_keys)
+
+        post_restore_file = os.path.join(tempdir, self._POST_RESTORE_FILENAME)
+        if os.path.exists(post_restore_file):
+            with open(post_restore_file) as f:
+                self._execute([f.read()])
+        self._execute(fix_up_queries)
+
+    def _check_custom_format_dump(self, dump_file):
+        """Make sure `pg_restore` can read the dump's table of contents"""
+        pg_restore_bin = os.path.join(self._bin_dir, 'pg_restore')
+        try:
+            run_shell([pg_restore_bin, '--list', dump_file])
+        except RuntimeError as e:
+            raise NonRecoverableError(
+                'Invalid DB dump, not restoring it: {0}'.format(e))
 
-        ctx.logger.debug('Postgres restored')
+    def _get_save_admin_rows_queries(self):
+        """Return queries that copy the rows of the admin user and the
+        default tenant to temporary tables, which clearing the tables
+        doesn't affect
+        """
+        queries = []
+        for table, condition in self._ADMIN_ROWS:
+            backup_table = '{0}_admin_backup'.format(table)
+            queries.append('DROP TABLE IF EXISTS {0};'.format(backup_table))
+            queries.append(
+                'CREATE TEMP TABLE {0} AS SELECT * FROM {1} WHERE {2};'
+                .format(backup_table, table, condition))
+        return queries
+
+    def _get_restore_admin_rows_queries(self):
+        """Return queries that put back the rows saved by the queries of
+        `_get_save_admin_rows_queries`, unless they were restored already
+        """
+        return ['INSERT INTO {0} SELECT * FROM {0}_admin_backup '
+                'ON CONFLICT DO NOTHING;'.format(table)
+                for table, _ in self._ADMIN_ROWS]
+
+    def _get_foreign_keys(self):
+        """Return the foreign keys of all the tables, as tuples of
+        (table, constraint name, constraint definition)
+
+        The definitions don't include NOT VALID, which constraints left
+        by a failed restore have.
+        """
+        result = self.run_query(
+            "SELECT conrelid::regclass, conname, pg_get_constraintdef(oid) "
+            "FROM pg_constraint "
+            "WHERE contype = 'f' AND connamespace = 'public'::regnamespace;")
+        return [(table, name, self._strip_not_valid(definition))
+                for table, name, definition in result['all']]
+
+    @staticmethod
+    def _strip_not_valid(definition):
+        suffix = ' NOT VALID'
+        if definition.endswith(suffix):
+            return definition[:-len(suffix)]
+        return definition
+
+    def _execute(self, queries):
+        """Run `queries`, failing on the first error (unlike `run_query`)
+        """
+        with closing(self._connection.cursor()) as cur:
+            for query in queries:
+                ctx.logger.debug('Running query: {0}'.format(query))
+                cur.execute(query)
+
+    def _is_custom_format_dump(self, dump_file):
+        with open(dump_file, 'rb') as f:
+            signature = f.read(len(self._CUSTOM_DUMP_SIGNATURE))
+        return signature == self._CUSTOM_DUMP_SIGNATURE
+
+    def dump(self, tempdir, include_logs, include_events,
+             high_water_mark=None):
+        """Dump the DB to `tempdir`.
 
-    def dump(self, tempdir, include_logs, include_events):
+        Events and logs are dumped to their own files, and only the rows
+        with a `_storage_id` above `high_water_mark` (a dict of
+        {table: storage id}, taken from the base of an incremental
+        snapshot) are dumped.
+
+        :return: The high water mark of this dump
+        """
         ctx.logger.info('Dumping Postgres, include logs {0} include events {1}'
                         .format(include_logs, include_events))
         destination_path = os.path.join(tempdir, self._POSTGRES_DUMP_FILENAME)
         admin_dump_path = os.path.join(tempdir, ADMIN_DUMP_FILE)
+        high_water_mark = high_water_mark or {}
+        events_tables = []
+        if include_events:
+            events_tables.append('events')
+        if include_logs:
+            events_tables.append('logs')
         try:
-            if not include_logs:
-                self._TABLES_TO_EXCLUDE_ON_DUMP = \
-                    self._TABLES_TO_EXCLUDE_ON_DUMP + ['logs']
-            if not include_events:
-                self._TABLES_TO_EXCLUDE_ON_DUMP = \
-                    self._TABLES_TO_EXCLUDE_ON_DUMP + ['events']
-            self._dump_to_file(
-                destination_path,
-                self._db_name,
-                exclude_tables=self._TABLES_TO_EXCLUDE_ON_DUMP
-            )
-            self._dump_admin_user_to_file(
-                admin_dump_path,
-                self._db_name,
-            )
+            with self._dump_transaction(events_tables) as snapshot_id:
+                self._dump_to_file(
+                    destination_path,
+                    self._db_name,
+                    exclude_tables=self._TABLES_TO_EXCLUDE_ON_DUMP +
+                    self._EVENTS_TABLES,
+                    custom_format=True,
+                    snapshot=snapshot_id
+                )
+                self._dump_admin_user_to_file(
+                    admin_dump_path,
+                    self._db_name,
+                )
+                new_high_water_mark = {}
+                for table in events_tables:
+                    new_high_water_mark[table] = self._dump_events_table(
+                        tempdir, table, high_water_mark.get(table, 0))
         except Exception as ex:
             raise NonRecoverableError('Error during dumping Postgres data, '
                                       'exception: {0}'.format(ex))
-        self._append_delete_current_execution(destination_path)
+        self._append_delete_current_execution(
+            os.path.join(tempdir, self._POST_RESTORE_FILENAME))
+        return new_high_water_mark
+
+    @contextmanager
+    def _dump_transaction(self, events_tables):
+        """Run the dump in a single REPEATABLE READ transaction, and yield
+        the id of its snapshot, so that `pg_dump` dumps the same snapshot.
+
+        While the snapshot is taken, `events_tables` are locked (on another
+        connection, and only until it's taken) against inserts, so no
+        transaction inserting into them is in flight. The rows committed
+        after the snapshot then all have a larger `_storage_id` than the
+        ones in it, and the largest dumped `_storage_id` is a high water
+        mark that no row is missed below.
+        """
+        with closing(self._connection.cursor()) as cur:
+            cur.execute('BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        try:
+            with self._lock_tables(events_tables):
+                with closing(self._connection.cursor()) as cur:
+                    # The snapshot is taken on the first query
+                    cur.execute('SELECT pg_export_snapshot()')
+                    snapshot_id = cur.fetchone()[0]
+            yield snapshot_id
+        finally:
+            with closing(self._connection.cursor()) as cur:
+                cur.execute('COMMIT')
+
+    @contextmanager
+    def _lock_tables(self, tables):
+        """Lock `tables` in SHARE mode, which waits for the transactions
+        writing to them to finish, and blocks new ones until released
+        """
+        if not tables:
+            yield
+            return
+        with closing(self._connect()) as connection:
+            with closing(connection.cursor()) as cur:
+                cur.execute('BEGIN')
+                cur.execute('LOCK TABLE {0} IN SHARE MODE'
+                            .format(', '.join(tables)))
+                try:
+                    yield
+                finally:
+                    cur.execute('COMMIT')
+
+    def _dump_events_table(self, tempdir, table, after_storage_id):
+        """Dump the rows of `table` added after `after_storage_id`, in the
+        COPY format. This runs in the dump's transaction, see
+        `_dump_transaction`.
+
+        :return: The largest storage id that was dumped
+        """
+        with closing(self._connection.cursor()) as cur:
+            cur.execute('SELECT COALESCE(MAX(_storage_id), 0) FROM {0}'
+                        .format(table))
+            max_storage_id = cur.fetchone()[0]
+            query = cur.mogrify(
+                'COPY (SELECT * FROM {0} '
+                'WHERE _storage_id > %s AND _storage_id <= %s '
+                'ORDER BY _storage_id) TO STDOUT'.format(table),
+                (after_storage_id, max_storage_id))
+            dump_path = os.path.join(
+                tempdir, self._EVENTS_DUMP_FILENAME.format(table))
+            with open(dump_path, 'w') as dump_file:
+                cur.copy_expert(query, dump_file)
+        ctx.logger.debug('Dumped {0} rows {1} - {2}'.format(
+            table, after_storage_id, max_storage_id))
+        return max_storage_id
+
+    @classmethod
+    def get_events_dump_filenames(cls):
+        return [cls._EVENTS_DUMP_FILENAME.format(table)
+                for table in cls._EVENTS_TABLES]
+
+    def restore_events(self, dump_dirs):
+        """Load the events and logs dumped to each of `dump_dirs`, in order.
+
+        Rows that belong to executions, tenants or users that don't exist
+        (anymore) are skipped: when restoring an incremental snapshot, the
+        events of its base are loaded into the DB state of the incremental
+        snapshot.
+        """
+        for dump_dir in dump_dirs:
+            for table in self._EVENTS_TABLES:
+                dump_path = os.path.join(
+                    dump_dir, self._EVENTS_DUMP_FILENAME.format(table))
+                if os.path.exists(dump_path):
+                    self._restore_events_table(table, dump_path)
+
+    def _restore_events_table(self, table, dump_path):
+        ctx.logger.debug('Restoring {0} from {1}'.format(table, dump_path))
+        staging_table = '{0}_restore'.format(table)
+        with closing(self._connection.cursor()) as cur:
+            cur.execute('CREATE TEMP TABLE {0} (LIKE {1})'
+                        .format(staging_table, table))
+            try:
+                with open(dump_path) as dump_file:
+                    cur.copy_expert('COPY {0} FROM STDIN'
+                                    .format(staging_table), dump_file)
+                cur.execute(
+                    'INSERT INTO {1} SELECT * FROM {0} '
+                    'WHERE _execution_fk IN '
+                    '(SELECT _storage_id FROM executions) '
+                    'AND _tenant_id IN (SELECT id FROM tenants) '
+                    'AND _creator_id IN (SELECT id FROM users) '
+                    'ON CONFLICT DO NOTHING'.format(staging_table, table))
+            finally:
+                cur.execute('DROP TABLE {0}'.format(staging_table))
 
     def dump_stage(self, tempdir):
         self._dump_db(
@@ -164,7 +437,7 @@ class Postgres(object):
         return bool(response['all'])
 
     def _append_delete_current_execution(self, dump_file):
-        """Append to the dump file a query that deletes the current execution
+        """Append to `dump_file` a query that deletes the current execution
         """
         delete_current_execution_query = "DELETE FROM executions " \
                                          "WHERE id = '{0}';" \
@@ -228,7 +501,8 @@ class Postgres(object):
                    self._db_name]
         run_shell(command)
 
-    def _dump_to_file(self, destination_path, db_name, exclude_tables=None):
+    def _dump_to_file(self, destination_path, db_name, exclude_tables=None,
+                      custom_format=False, snapshot=None):
         ctx.logger.debug('Creating db dump file: {0}, excluding: {1}'.
                          format(destination_path, exclude_tables))
         flags = []
@@ -245,6 +519,10 @@ class Postgres(object):
                    '-U', self._username,
                    db_name,
                    '-f', destination_path]
+        if custom_format:
+            command.append('--format=custom')
+        if snapshot:
+            command.append('--snapshot={0}'.format(snapshot))
         command.extend(flags)
         run_shell(command)
 
@@ -288,6 +566,23 @@ class Postgres(object):
         ])
         run_shell(command)
 
+    def _restore_dump_parallel(self, dump_file, db_name):
+        """Execute `pg_restore` to load the data of a custom format dump
+        into the DB, using a job per CPU
+        """
+        ctx.logger.debug('Restoring db dump file: {0}'.format(dump_file))
+        pg_restore_bin = os.path.join(self._bin_dir, 'pg_restore')
+        command = [pg_restore_bin,
+                   '--data-only',
+                   '--exit-on-error',
+                   '--jobs', str(multiprocessing.cpu_count()),
+                   '--host', self._host,
+                   '--port', self._port,
+                   '-U', self._username,
+                   '--dbname', db_name,
+                   dump_file]
+        run_shell(command)
+
     @staticmethod
     def _append_dump(dump_file, query):
         ctx.logger.debug('Adding to end of dump: {0}'.format(query))
@@ -337,41 +632,35 @@ class Postgres(object):
         # If this is from a snapshot that precedes token keys we need to
         # generate them
         result = self.run_query(
-            "SELECT id, api_token_key FROM users"
+            "SELECT id FROM users "
+            "WHERE api_token_key IS NULL OR api_token_key = ''"
         )
+        if not result['all']:
+            return
 
-        for row in result['all']:
-            uid = row[0]
-            api_token_key = row[1]
-            if not api_token_key:
-                api_token_key = uuid4().hex
-                self.run_query(
-                    "UPDATE users "
-                    "SET api_token_key=%s "
-                    "WHERE id=%s",
-                    (api_token_key, uid),
-                )
+        api_token_keys = [(row[0], uuid4().hex) for row in result['all']]
+        update_query = """UPDATE users
+                          SET api_token_key = token_keys.api_token_key
+                          FROM (VALUES %s) AS token_keys (id, api_token_key)
+                          WHERE users.id = token_keys.id"""
+        self.run_query(update_query, vars=api_token_keys, bulk_query=True)
 
     def get_deployment_creator_ids_and_tokens(self):
         result = self.run_query(
             "SELECT tenants.name, deployments.id,"
             "users.id, users.api_token_key "
-            "FROM deployments, users, tenants "
-            "WHERE deployments._creator_id=users.id "
-            "AND tenants.id=deployments._tenant_id"
+            "FROM deployments "
+            "JOIN users ON users.id = deployments._creator_id "
+            "JOIN tenants ON tenants.id = deployments._tenant_id"
         )
 
         details = {}
         # Make structure the same as the deployments:
         # { 'tenant1': {'deploymentid': {info}, ...}, ...}
-        for row in result['all']:
-            tenant = row[0]
-            deployment = row[1]
-            if tenant not in details:
-                details[tenant] = {}
-            details[tenant][deployment] = {
-                'uid': row[2],
-                'token': row[3],
+        for tenant, deployment, uid, token in result['all']:
+            details.setdefault(tenant, {})[deployment] = {
+                'uid': uid,
+                'token': token,
             }
         return details
 
@@ -397,6 +686,36 @@ class Postgres(object):
             .format(table_name, column_name)
         self.run_query(update_query, vars=encrypted_values, bulk_query=True)
 
+    def record_plugin_yaml_files(self, plugins_dir):
+        """Record the yaml file names of the plugins that older versions
+        didn't store in the DB, once the plugins' files were restored
+        """
+        result = self.run_query("SELECT _storage_id, id FROM plugins "
+                                "WHERE yaml_file_name IS NULL")
+        yaml_file_names = []
+        for storage_id, plugin_id in result['all'] or []:
+            plugin_dir = os.path.join(plugins_dir, plugin_id)
+            # Without the plugin's files, there's no telling if it has a
+            # yaml file, so the name is left unrecorded
+            if not os.path.isdir(plugin_dir):
+                continue
+            yaml_files = sorted(
+                yaml_file for yaml_file in
+                glob.glob(os.path.join(plugin_dir, '*.yaml'))
+                if os.path.isfile(yaml_file))
+            yaml_file_names.append((
+                storage_id,
+                os.path.basename(yaml_files[0]) if yaml_files else ''))
+        if not yaml_file_names:
+            return
+
+        update_query = """UPDATE plugins
+                          SET yaml_file_name = yaml_files.yaml_file_name
+                          FROM (VALUES %s) AS yaml_files
+                              (_storage_id, yaml_file_name)
+                          WHERE plugins._storage_id = yaml_files._storage_id"""
+        self.run_query(update_query, vars=yaml_file_names, bulk_query=True)
+
     def _connect(self):
         try:
             conn = psycopg2.connect(
@@ -15,11 +15,16 @@
 
 import os
 import json
+import time
+import Queue
 import shutil
 import tempfile
+from multiprocessing.pool import ThreadPool
 
 from cloudify.workflows import ctx
+from cloudify.state import current_workflow_ctx
 from cloudify.manager import get_rest_client
+from cloudify.exceptions import NonRecoverableError
 from cloudify.constants import FILE_SERVER_SNAPSHOTS_FOLDER
 
 from . import utils
@@ -38,15 +43,21 @@ class SnapshotCreate(object):
                  include_metrics,
                  include_credentials,
                  include_logs,
-                 include_events):
+                 include_events,
+                 base_snapshot_id=None):
         self._snapshot_id = snapshot_id
         self._config = utils.DictToAttributes(config)
         self._include_metrics = include_metrics
         self._include_credentials = include_credentials
         self._include_logs = include_logs
         self._include_events = include_events
+        self._base_snapshot_id = base_snapshot_id
 
         self._tempdir = None
+        self._archived_files = []
+        self._base_manifest = {}
+        self._base_high_water_mark = {}
+        self._high_water_mark = {}
         self._client = get_rest_client()
 
     def create(self):
@@ -60,18 +71,29 @@ class SnapshotCreate(object):
                 utils.stage_db_schema_get_current_revision()
             composer_schema_revision = \
                 utils.composer_db_schema_get_current_revision()
+            if self._base_snapshot_id:
+                self._load_base_snapshot(schema_revision)
 
-            self._dump_files()
-            self._dump_postgres()
-            self._dump_influxdb()
-            self._dump_networks()
-            self._dump_credentials(manager_version)
+            timings = self._run_dumps([
+                ('files', self._dump_files, []),
+                ('postgres', self._dump_postgres, []),
+                ('influxdb', self._dump_influxdb, []),
+                ('networks', self._dump_networks, []),
+                ('credentials',
+                 lambda: self._dump_credentials(manager_version), []),
+                # Dumping the credentials temporarily switches the workflow
+                # context to each tenant, so agents (that are also dumped
+                # per tenant) wait for it
+                ('agents',
+                 lambda: self._dump_agents(manager_version),
+                 ['credentials']),
+            ])
             self._dump_metadata(metadata,
                                 manager_version,
                                 schema_revision,
                                 stage_schema_revision,
-                                composer_schema_revision)
-            self._dump_agents(manager_version)
+                                composer_schema_revision,
+                                timings)
 
             self._create_archive()
             self._update_snapshot_status(self._config.created_status)
@@ -83,6 +105,82 @@ class SnapshotCreate(object):
             ctx.logger.debug('Removing temp dir: {0}'.format(self._tempdir))
             shutil.rmtree(self._tempdir)
 
+    def _load_base_snapshot(self, schema_revision):
+        """Read what's needed to create an incremental snapshot on top of
+        the base snapshot: its files manifest and its events high water mark
+        """
+        ctx.logger.info('Creating an incremental snapshot, based on {0}'
+                        .format(self._base_snapshot_id))
+        metadata, manifest = utils.read_snapshot_metadata(
+            utils.get_snapshot_path(self._config.file_server_root,
+                                    self._base_snapshot_id))
+        if not manifest or \
+                constants.M_EVENTS_HIGH_WATER_MARK not in metadata:
+            raise NonRecoverableError(
+                'Snapshot {0} was created by an older version, and can\'t '
+                'be the base of an incremental snapshot'
+                .format(self._base_snapshot_id))
+        # The events of the base snapshot are restored into the schema of
+        # this snapshot
+        if metadata.get(constants.M_SCHEMA_REVISION) != schema_revision:
+            raise NonRecoverableError(
+                'Snapshot {0} was created with a different DB schema, and '
+                'can\'t be the base of an incremental snapshot'
+                .format(self._base_snapshot_id))
+        self._base_manifest = manifest
+        self._base_high_water_mark = \
+            metadata[constants.M_EVENTS_HIGH_WATER_MARK]
+
+    def _run_dumps(self, dumps):
+        """Run the dumps concurrently, each as soon as the dumps it depends
+        on are done.
+
+        :param dumps: A list of (name, function, names of the dumps that
+                      have to finish first)
+        :return: A dict of {name: how long the dump took, in seconds}
+        """
+        workflow_ctx = current_workflow_ctx.get_ctx()
+        finished = Queue.Queue()
+
+        def run_dump(name, dump):
+            current_workflow_ctx.set(workflow_ctx)
+            started = time.time()
+            try:
+                dump()
+            except BaseException, e:
+                finished.put((name, None, e))
+            else:
+                finished.put((name, time.time() - started, None))
+            finally:
+                current_workflow_ctx.clear()
+
+        pending = list(dumps)
+        running = set()
+        timings = {}
+        pool = ThreadPool(len(dumps))
+        try:
+            while pending or running:
+                for dump in list(pending):
+                    name, func, requires = dump
+                    if all(required in timings for required in requires):
+                        pending.remove(dump)
+                        running.add(name)
+                        pool.apply_async(run_dump, (name, func))
+                if not running:
+                    raise RuntimeError('Unsatisfiable snapshot dump '
+                                       'dependencies: {0}'.format(pending))
+                name, duration, error = finished.get()
+                running.remove(name)
+                if error is not None:
+                    raise error
+                timings[name] = duration
+                ctx.logger.info('Dumped {0} in {1:.1f} seconds'
+                                .format(name, duration))
+        finally:
+            pool.close()
+            pool.join()
+        return timings
+
     def _update_snapshot_status(self, status, error=None):
         self._client.snapshots.update_status(
             self._snapshot_id,
@@ -91,21 +189,19 @@ class SnapshotCreate(object):
         )
 
     def _dump_files(self):
-        ctx.logger.info('Dumping files to the archive from the manager')
-        utils.copy_files_between_manager_and_snapshot(
-            self._tempdir,
-            self._config,
-            to_archive=True
-        )
-        utils.copy_stage_files(self._tempdir)
-        utils.copy_composer_files(self._tempdir)
+        # The files aren't copied anywhere: they're added to the archive
+        # straight from the manager, when it's created
+        ctx.logger.info('Collecting the manager files to archive')
+        self._archived_files = utils.get_files_to_archive(self._config)
 
     def _dump_postgres(self):
         ctx.logger.info('Dumping Postgres data')
         with Postgres(self._config) as postgres:
-            postgres.dump(self._tempdir,
-                          self._include_logs,
-                          self._include_events)
+            self._high_water_mark = postgres.dump(
+                self._tempdir,
+                self._include_logs,
+                self._include_events,
+                high_water_mark=self._base_high_water_mark)
             postgres.dump_stage(self._tempdir)
             postgres.dump_composer(self._tempdir)
 
@@ -124,7 +220,8 @@ class SnapshotCreate(object):
                        manager_version,
                        schema_revision,
                        stage_schema_revision,
-                       composer_schema_revision):
+                       composer_schema_revision,
+                       timings):
         ctx.logger.info('Dumping metadata')
         metadata[constants.M_VERSION] = str(manager_version)
         metadata[constants.M_SCHEMA_REVISION] = schema_revision
@@ -133,6 +230,10 @@ class SnapshotCreate(object):
         if composer_schema_revision:
             metadata[constants.M_COMPOSER_SCHEMA_REVISION] = \
                 composer_schema_revision
+        metadata[constants.M_DUMP_TIMINGS] = timings
+        metadata[constants.M_EVENTS_HIGH_WATER_MARK] = self._high_water_mark
+        if self._base_snapshot_id:
+            metadata[constants.M_BASE_SNAPSHOT] = self._base_snapshot_id
         metadata_filename = os.path.join(
             self._tempdir,
             constants.METADATA_FILENAME
@@ -152,7 +253,12 @@ class SnapshotCreate(object):
         snapshot_archive_name = self._get_snapshot_archive_name()
         ctx.logger.info(
             'Creating snapshot archive: {0}'.format(snapshot_archive_name))
-        utils.make_zip64_archive(snapshot_archive_name, self._tempdir)
+        with utils.SnapshotArchive(
+                snapshot_archive_name,
+                base_manifest=self._base_manifest) as archive:
+            archive.add_directory(self._tempdir)
+            for source, archive_path in self._archived_files:
+                archive.add_path(source, archive_path)
 
     def _get_snapshot_archive_name(self):
         """Return the base name for the snapshot archive
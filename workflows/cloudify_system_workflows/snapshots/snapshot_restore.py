@@ -20,15 +20,18 @@ import shutil
 import zipfile
 import platform
 import tempfile
+import threading
 import subprocess
 from contextlib import closing
+from multiprocessing.pool import ThreadPool
 
 import wagon
 
 from cloudify.workflows import ctx
+from cloudify.state import current_workflow_ctx
 from cloudify.manager import get_rest_client
 from cloudify.exceptions import NonRecoverableError
-from cloudify.constants import FILE_SERVER_SNAPSHOTS_FOLDER
+from cloudify.constants import FILE_SERVER_PLUGINS_FOLDER
 from cloudify.utils import ManagerVersion, get_local_rest_certificate
 
 from cloudify_rest_client.executions import Execution
@@ -46,18 +49,22 @@ from .credentials import restore as restore_credentials
 from .constants import (
     ADMIN_DUMP_FILE,
     ARCHIVE_CERT_DIR,
+    BASE_SNAPSHOTS_DIR,
     CERT_DIR,
+    EXECUTION_POLL_MAX_INTERVAL,
+    EXECUTION_POLL_MIN_INTERVAL,
     HASH_SALT_FILENAME,
     INTERNAL_CA_CERT_FILENAME,
     INTERNAL_CA_KEY_FILENAME,
     INTERNAL_CERT_FILENAME,
     INTERNAL_KEY_FILENAME,
     INTERNAL_P12_FILENAME,
-    METADATA_FILENAME,
+    M_BASE_SNAPSHOT,
     M_SCHEMA_REVISION,
     M_STAGE_SCHEMA_REVISION,
     M_VERSION,
     MANAGER_PYTHON,
+    RESTORE_CONCURRENCY,
     V_4_0_0,
     V_4_2_0,
     V_4_3_0,
@@ -96,6 +103,8 @@ class SnapshotRestore(object):
         self._post_restore_commands = []
 
         self._tempdir = None
+        self._extractor = None
+        self._events_dump_dirs = []
         self._snapshot_version = None
         self._client = get_rest_client()
         self._manager_version = utils.get_manager_version(self._client)
@@ -107,7 +116,7 @@ class SnapshotRestore(object):
         ctx.logger.debug('Going to restore snapshot, '
                          'snapshot_path: {0}'.format(snapshot_path))
         try:
-            metadata = self._extract_snapshot_archive(snapshot_path)
+            metadata = self._plan_snapshot_extraction(snapshot_path)
             self._snapshot_version = ManagerVersion(metadata[M_VERSION])
             schema_revision = metadata.get(
                 M_SCHEMA_REVISION,
@@ -121,10 +130,16 @@ class SnapshotRestore(object):
 
             existing_plugins = self._get_existing_plugin_names()
 
+            # The manager files are only needed once the DB is restored
+            ctx.logger.info('Extracting the snapshot')
+            self._extractor.extract(
+                exclude=utils.get_restored_files_paths(self._config))
+
             with Postgres(self._config) as postgres:
                 self._restore_db(postgres, schema_revision, stage_revision)
                 self._update_visibility(postgres)
                 self._restore_files_to_manager()
+                self._record_plugin_yaml_files(postgres)
                 self._encrypt_secrets(postgres)
                 self._encrypt_rabbitmq_passwords(postgres)
                 self._restore_plugins(existing_plugins)
@@ -191,55 +206,109 @@ class SnapshotRestore(object):
     def _restore_deployment_envs(self, postgres):
         deps = utils.get_dep_contexts(self._snapshot_version)
         token_info = postgres.get_deployment_creator_ids_and_tokens()
-        failed_deployments = []
+        tenant_clients = {}
+        to_restore = []
         for tenant, deployments in deps:
-            ctx.logger.info(
-                'Restoring deployment environments for {tenant}'.format(
-                    tenant=tenant,
-                )
-            )
-            tenant_client = get_rest_client(tenant=tenant)
+            tenant_clients[tenant] = get_rest_client(tenant=tenant)
             for deployment_id, dep_ctx in deployments.iteritems():
-                try:
-                    ctx.logger.info('Restoring deployment {dep_id}'.format(
-                        dep_id=deployment_id,
-                    ))
-                    api_token = self._get_api_token(
-                        token_info[tenant][deployment_id]
+                to_restore.append((tenant, deployment_id, dep_ctx))
+        ctx.logger.info(
+            'Restoring {0} deployment environments, {1} at a time'.format(
+                len(to_restore), RESTORE_CONCURRENCY))
+
+        def restore_deployment_env(item):
+            tenant, deployment_id, dep_ctx = item
+            tenant_client = tenant_clients[tenant]
+            ctx.logger.info('Restoring deployment {dep_id} of {tenant}'.format(
+                dep_id=deployment_id,
+                tenant=tenant,
+            ))
+            api_token = self._get_api_token(
+                token_info[tenant][deployment_id]
+            )
+            with dep_ctx:
+                dep = tenant_client.deployments.get(deployment_id)
+                blueprint = tenant_client.blueprints.get(
+                    dep_ctx.blueprint.id,
+                )
+                tasks_graph = self._get_tasks_graph(
+                    dep_ctx,
+                    blueprint,
+                    dep,
+                    api_token,
+                )
+                tasks_graph.execute()
+                ctx.logger.info(
+                    'Successfully created deployment environment '
+                    'for deployment {deployment}'.format(
+                        deployment=deployment_id,
                     )
-                    with dep_ctx:
-                        dep = tenant_client.deployments.get(deployment_id)
-                        blueprint = tenant_client.blueprints.get(
-                            dep_ctx.blueprint.id,
-                        )
-                        tasks_graph = self._get_tasks_graph(
-                            dep_ctx,
-                            blueprint,
-                            dep,
-                            api_token,
-                        )
-                        tasks_graph.execute()
-                        ctx.logger.info(
-                            'Successfully created deployment environment '
-                            'for deployment {deployment}'.format(
-                                deployment=deployment_id,
-                            )
-                        )
-                except RuntimeError as re:
-                    if self.__should_ignore_deployment_failure(re.message):
-                        ctx.logger.warning('Failed to create deployment: {0},'
-                                           'ignore_plugin_failure'
-                                           'flag used, proceeding...'
-                                           .format(deployment_id))
-                        ctx.logger.debug('Deployment creation error: {0}'
-                                         .format(re))
-                        failed_deployments.append(deployment_id)
-                    else:
-                        raise re
+                )
+
+        def should_ignore(error):
+            return isinstance(error, RuntimeError) and \
+                self.__should_ignore_deployment_failure(error.message)
+
+        failures = self._run_concurrently(
+            restore_deployment_env, to_restore, should_ignore)
+
+        failed_deployments = {}
+        for (tenant, deployment_id, _), error in failures:
+            ctx.logger.warning('Failed to create deployment: {0}, '
+                               'ignore_plugin_failure '
+                               'flag used, proceeding...'
+                               .format(deployment_id))
+            ctx.logger.debug('Deployment creation error: {0}'.format(error))
+            failed_deployments.setdefault(tenant, []).append(deployment_id)
+        for tenant, deployments in deps:
+            tenant_failures = failed_deployments.get(tenant, [])
             SnapshotRestore.__remove_failed_deployments_footprints(
-                tenant_client, failed_deployments)
+                tenant_clients[tenant], tenant_failures)
             SnapshotRestore.__log_message_for_deployment_restore(
-                deployments, failed_deployments, tenant)
+                deployments, tenant_failures, tenant)
+
+    def _run_concurrently(self, func, items, should_ignore):
+        """Call `func` on each of `items`, RESTORE_CONCURRENCY calls at a time.
+
+        Errors that `should_ignore` returns True for are collected, and
+        returned as a list of (item, error). Any other error stops the items
+        that didn't start yet from being handled, and is raised once the
+        calls that are already running are done.
+        """
+        workflow_ctx = current_workflow_ctx.get_ctx()
+        aborted = threading.Event()
+
+        def call(item):
+            if aborted.is_set():
+                return item, None
+            current_workflow_ctx.set(workflow_ctx)
+            try:
+                func(item)
+            except Exception as e:
+                if not should_ignore(e):
+                    aborted.set()
+                return item, e
+            finally:
+                current_workflow_ctx.clear()
+            return item, None
+
+        failures = []
+        error = None
+        pool = ThreadPool(RESTORE_CONCURRENCY)
+        try:
+            for item, item_error in pool.imap_unordered(call, items):
+                if item_error is None:
+                    continue
+                if should_ignore(item_error):
+                    failures.append((item, item_error))
+                elif error is None:
+                    error = item_error
+        finally:
+            pool.close()
+            pool.join()
+        if error is not None:
+            raise error
+        return failures
 
     def _restore_amqp_vhosts_and_users(self):
         subprocess.check_call(
@@ -353,6 +422,7 @@ class SnapshotRestore(object):
         subprocess.Popen(command, shell=True)
 
     def _validate_snapshot(self):
+        self._extractor.extract([Networks.NETWORKS_FILENAME])
         validator = SnapshotRestoreValidator(
             self._snapshot_version,
             self._premium_enabled,
@@ -364,6 +434,8 @@ class SnapshotRestore(object):
         validator.validate()
 
     def _restore_files_to_manager(self):
+        ctx.logger.info('Extracting the manager files from the snapshot')
+        self._extractor.extract()
         ctx.logger.info('Restoring files from the archive to the manager')
         utils.copy_files_between_manager_and_snapshot(
             self._tempdir,
@@ -422,6 +494,7 @@ class SnapshotRestore(object):
         if self._snapshot_version >= V_4_0_0:
             with utils.db_schema(schema_revision, config=self._config):
                 admin_user_update_command = postgres.restore(self._tempdir)
+                postgres.restore_events(self._events_dump_dirs)
             self._restore_stage(postgres, self._tempdir, stage_revision)
             self._restore_composer(postgres, self._tempdir)
         else:
@@ -460,6 +533,12 @@ class SnapshotRestore(object):
 
         ctx.logger.info('Successfully updated visibility')
 
+    def _record_plugin_yaml_files(self, postgres):
+        ctx.logger.info('Recording the yaml files of the plugins')
+        postgres.record_plugin_yaml_files(os.path.join(
+            self._config.file_server_root,
+            FILE_SERVER_PLUGINS_FOLDER))
+
     def _encrypt_secrets(self, postgres):
         # The secrets are encrypted
         if self._snapshot_version >= V_4_4_0:
@@ -510,32 +589,74 @@ class SnapshotRestore(object):
                                          _include=['id'],
                                          _get_all_results=True).items
 
-    def _extract_snapshot_archive(self, snapshot_path):
-        """Extract the snapshot archive to a temp folder
+    def _plan_snapshot_extraction(self, snapshot_path):
+        """Read the snapshot metadata straight from the archive, and plan
+        the extraction of the archive (and of its base snapshots, if it's
+        incremental), without extracting anything yet.
+
+        The files are then extracted as the restore phases need them, with
+        `self._extractor.extract`.
 
         :param snapshot_path: Path to the snapshot archive
         :return: A dict representing the metadata json file
         """
-        ctx.logger.debug('Extracting snapshot: {0}'.format(snapshot_path))
-        with zipfile.ZipFile(snapshot_path, 'r') as zipf:
-            zipf.extractall(self._tempdir)
-        with open(os.path.join(self._tempdir, METADATA_FILENAME), 'r') as f:
-            metadata = json.load(f)
+        ctx.logger.debug('Reading snapshot: {0}'.format(snapshot_path))
+        metadata, manifest = utils.read_snapshot_metadata(snapshot_path)
+        self._extractor = utils.ArchiveExtractor(self._tempdir)
+        names = set(self._extractor.add(snapshot_path))
+        self._events_dump_dirs = [self._tempdir]
+        if metadata.get(M_BASE_SNAPSHOT):
+            self._plan_base_snapshots_extraction(metadata[M_BASE_SNAPSHOT],
+                                                 manifest,
+                                                 names)
         return metadata
 
-    def _get_snapshot_path(self):
+    def _plan_base_snapshots_extraction(self, base_snapshot_id, manifest,
+                                        names):
+        """Complete an incremental snapshot from its bases.
+
+        The files that didn't change since the base snapshot are extracted
+        from the base (or from its own base, and so on), and the events
+        dumps of all the bases are extracted, to be restored before the
+        incremental snapshot's own events.
+        """
+        missing = {path: digest for path, digest in manifest.iteritems()
+                   if path not in names}
+        while base_snapshot_id:
+            snapshot_path = self._get_snapshot_path(base_snapshot_id)
+            if not os.path.exists(snapshot_path):
+                raise NonRecoverableError(
+                    'Base snapshot {0} of snapshot {1} not found'
+                    .format(base_snapshot_id, self._snapshot_id))
+            base_metadata, base_manifest = \
+                utils.read_snapshot_metadata(snapshot_path)
+            with zipfile.ZipFile(snapshot_path, 'r') as zipf:
+                base_names = set(zipf.namelist())
+            from_base = []
+            for path, digest in missing.items():
+                if path in base_names and base_manifest.get(path) == digest:
+                    from_base.append(path)
+                    del missing[path]
+            self._extractor.add(snapshot_path, from_base)
+            events_dir = os.path.join(self._tempdir, BASE_SNAPSHOTS_DIR,
+                                      base_snapshot_id)
+            self._extractor.add(
+                snapshot_path,
+                [filename for filename in Postgres.get_events_dump_filenames()
+                 if filename in base_names],
+                events_dir)
+            self._events_dump_dirs.insert(0, events_dir)
+            base_snapshot_id = base_metadata.get(M_BASE_SNAPSHOT)
+        if missing:
+            raise NonRecoverableError(
+                'Files missing from the base snapshots of snapshot {0}: {1}'
+                .format(self._snapshot_id, ', '.join(sorted(missing))))
+
+    def _get_snapshot_path(self, snapshot_id=None):
         """Calculate the snapshot path from the config + snapshot ID
         """
-        file_server_root = self._config.file_server_root
-        snapshots_dir = os.path.join(
-            file_server_root,
-            FILE_SERVER_SNAPSHOTS_FOLDER
-        )
-        return os.path.join(
-            snapshots_dir,
-            self._snapshot_id,
-            '{0}.zip'.format(self._snapshot_id)
-        )
+        return utils.get_snapshot_path(self._config.file_server_root,
+                                       snapshot_id or self._snapshot_id)
 
     def _get_existing_plugin_names(self):
         ctx.logger.debug('Collecting existing plugins')
@@ -621,26 +742,42 @@ class SnapshotRestore(object):
             # In any case, failure or success, delete tmp* folder
             os.remove(temp_plugin)
 
-    def _wait_for_plugin_executions(self, client):
-        while True:
-            executions = client.executions.list(
-                include_system_workflows=True,
-                _all_tenants=True
+    def _wait_for_plugin_executions(self):
+        """Wait for the plugin installation executions to end.
+
+        Only the executions that are running when this is called are waited
+        for, and all of them are checked with a single request. Checks are
+        frequent at first, and get further apart the longer the executions
+        take.
+        """
+        def running_executions():
+            return dict(
+                (execution.id, execution.status) for execution in
+                self._client.executions.list(
+                    workflow_id='install_plugin',
+                    include_system_workflows=True,
+                    _all_tenants=True,
+                    _include=['id', 'status'],
+                    _get_all_results=True)
+                if execution.status not in Execution.END_STATES
             )
-            waiting = []
-            for execution in executions:
-                if execution.workflow_id == 'install_plugin':
-                    if execution.status not in Execution.END_STATES:
-                        waiting.append(execution)
-            if not waiting:
-                break
-            else:
-                msg = ', '.join('{0} (state: {1})'
-                                .format(execution.id, execution.status))
-                ctx.logger.info(
-                    'Waiting for plugin install executions to finish: '
-                    '{0}'.format(msg))
-                time.sleep(3)
+
+        waiting = set(running_executions())
+        interval = EXECUTION_POLL_MIN_INTERVAL
+        while waiting:
+            ctx.logger.info(
+                'Waiting for {0} plugin install executions to finish'
+                .format(len(waiting)))
+            time.sleep(interval)
+            interval = min(interval * 2, EXECUTION_POLL_MAX_INTERVAL)
+            running = running_executions()
+            waiting = set(
+                execution_id for execution_id in waiting
+                if execution_id in running
+            )
+            ctx.logger.debug('Still running: {0}'.format(', '.join(
+                '{0} (state: {1})'.format(execution_id, running[execution_id])
+                for execution_id in waiting)))
 
     @staticmethod
     def __remove_failed_plugins_footprints(client, failed_plugins):
@@ -671,34 +808,43 @@ class SnapshotRestore(object):
         """
         ctx.logger.info('Restoring plugins')
         plugins_to_install = self._get_plugins_to_install(existing_plugins)
-        failed_plugins = []
-        for tenant, plugins in plugins_to_install.items():
-            client = get_rest_client(tenant=tenant)
+        tenant_clients = dict(
+            (tenant, get_rest_client(tenant=tenant))
+            for tenant in plugins_to_install
+        )
+        to_restore = [
+            (tenant, plugin)
+            for tenant, plugins in plugins_to_install.items()
+            for plugin in plugins
+        ]
+
+        def restore_plugin(item):
+            tenant, plugin = item
             plugins_tmp = tempfile.mkdtemp()
             try:
-                for plugin in plugins:
-                    try:
-                        self._restore_plugin(client,
-                                             tenant,
-                                             plugin,
-                                             plugins_tmp)
-                    except Exception as ex:
-                        if self._ignore_plugin_failure:
-                            ctx.logger.warning(
-                                'Failed to restore plugin: {0}, '
-                                'ignore-plugin-failure flag '
-                                'used. Proceeding...'.format(plugin))
-                            ctx.logger.debug('Restore plugin failure error: '
-                                             '{0}'.format(ex))
-                            failed_plugins.append(plugin)
-                        else:
-                            raise ex
-                self._wait_for_plugin_executions(client)
-                SnapshotRestore.__remove_failed_plugins_footprints(
-                    client, failed_plugins)
+                self._restore_plugin(tenant_clients[tenant],
+                                     tenant,
+                                     plugin,
+                                     plugins_tmp)
             finally:
-                os.rmdir(plugins_tmp)
-        SnapshotRestore.__log_message_for_plugin_restore(failed_plugins)
+                shutil.rmtree(plugins_tmp, ignore_errors=True)
+
+        failures = self._run_concurrently(
+            restore_plugin, to_restore,
+            lambda error: self._ignore_plugin_failure)
+        for (_, plugin), error in failures:
+            ctx.logger.warning(
+                'Failed to restore plugin: {0}, '
+                'ignore-plugin-failure flag '
+                'used. Proceeding...'.format(plugin))
+            ctx.logger.debug('Restore plugin failure error: '
+                             '{0}'.format(error))
+        self._wait_for_plugin_executions()
+        for (tenant, plugin), _ in failures:
+            SnapshotRestore.__remove_failed_plugins_footprints(
+                tenant_clients[tenant], [plugin])
+        SnapshotRestore.__log_message_for_plugin_restore(
+            [plugin for (_, plugin), _ in failures])
 
     @staticmethod
     def _plugin_installable_on_current_platform(plugin):
@@ -16,10 +16,12 @@
 import os
 import json
 import shlex
+import hashlib
 import shutil
 import zipfile
 import subprocess
 import contextlib
+from multiprocessing.pool import ThreadPool
 
 from cloudify.workflows import ctx
 from cloudify import constants, manager
@@ -65,7 +67,22 @@ def copy_files_between_manager_and_snapshot(archive_root,
         Expected to be used only for 3.x upgrades.
     """
     ctx.logger.info('Copying files/directories...')
+    data_to_copy = _get_manager_files(config, to_archive, tenant_name)
+    ctx.logger.info(str(data_to_copy))
+    for p1, p2 in data_to_copy:
+        p2 = os.path.join(archive_root, p2)
+
+        # make p1 to always point to source and p2 to target of copying
+        if not to_archive:
+            p1, p2 = p2, p1
+
+        copy_snapshot_path(p1, p2)
 
+
+def _get_manager_files(config, to_archive=True, tenant_name=None):
+    """Return the files/dirs that are stored in the snapshot, as tuples of
+    (absolute path in the manager, relative path in the snapshot archive)
+    """
     data_to_copy = [
         constants.FILE_SERVER_BLUEPRINTS_FOLDER,
         constants.FILE_SERVER_DEPLOYMENTS_FOLDER,
@@ -102,31 +119,28 @@ def copy_files_between_manager_and_snapshot(archive_root,
                              snapshot_constants.ARCHIVE_CERT_DIR))
         data_to_copy.append((SECURITY_FILE_LOCATION, SECURITY_FILENAME))
 
-    ctx.logger.info(str(data_to_copy))
-    for p1, p2 in data_to_copy:
-        # first expand relative paths
-        if p1[0] != '/':
-            p1 = os.path.join(config.file_server_root, p1)
-        if p2[0] != '/':
-            p2 = os.path.join(archive_root, p2)
+    # expand relative paths
+    return [(os.path.join(config.file_server_root, manager_path),
+             archive_path)
+            for manager_path, archive_path in data_to_copy]
 
-        # make p1 to always point to source and p2 to target of copying
-        if not to_archive:
-            p1, p2 = p2, p1
 
-        copy_snapshot_path(p1, p2)
-
-
-def copy_stage_files(archive_root):
-    """Copy Cloudify Stage files into the snapshot"""
-    stage_data = [
-        snapshot_constants.STAGE_CONFIG_FOLDER,
-        snapshot_constants.STAGE_USERDATA_FOLDER
-    ]
-    for folder in stage_data:
-        copy_snapshot_path(
+def get_files_to_archive(config):
+    """Return the manager files/dirs that are added to a new snapshot, as
+    tuples of (absolute path in the manager, path in the snapshot archive)
+    """
+    files = _get_manager_files(config)
+    for folder in [snapshot_constants.STAGE_CONFIG_FOLDER,
+                   snapshot_constants.STAGE_USERDATA_FOLDER]:
+        files.append((
             os.path.join(snapshot_constants.STAGE_BASE_FOLDER, folder),
-            os.path.join(archive_root, 'stage', folder))
+            os.path.join('stage', folder)))
+    for folder in [snapshot_constants.COMPOSER_CONFIG_FOLDER,
+                   snapshot_constants.COMPOSER_BLUEPRINTS_FOLDER]:
+        files.append((
+            os.path.join(snapshot_constants.COMPOSER_BASE_FOLDER, folder),
+            os.path.join('composer', folder)))
+    return files
 
 
 def restore_stage_files(archive_root, override=False):
@@ -168,18 +182,6 @@ def restore_stage_files(archive_root, override=False):
          ignore_failures=True)
 
 
-def copy_composer_files(archive_root):
-    """Copy Cloudify Composer files into the snapshot"""
-    composer_data = [
-        snapshot_constants.COMPOSER_CONFIG_FOLDER,
-        snapshot_constants.COMPOSER_BLUEPRINTS_FOLDER,
-    ]
-    for folder in composer_data:
-        copy_snapshot_path(
-            os.path.join(snapshot_constants.COMPOSER_BASE_FOLDER, folder),
-            os.path.join(archive_root, 'composer', folder))
-
-
 def restore_composer_files(archive_root):
     """Copy Composer files from the snapshot archive to Composer folder.
     """
@@ -301,20 +303,224 @@ def is_compute(node):
     return constants.COMPUTE_NODE_TYPE in node.type_hierarchy
 
 
-def make_zip64_archive(zip_filename, directory):
-    """Create zip64 archive that contains all files in a directory.
+class SnapshotArchive(object):
+    """A zip64 snapshot archive, that files and directories are added to
+    directly from where they are, without copying them to a staging
+    directory first.
 
     zip64 is a set of extensions on top of the zip file format that allows to
     have files larger than 2GB. This is important in snapshots where the amount
     of data to backup might be huge.
 
-    Note that `shutil` provides a method to register new formats based on the
-    extension of the target file, since a `.zip` extension is still desired,
-    using such an extension mechanism is not an option to avoid patching the
-    already registered zip format.
+    Files that are compressed already (wagons, wheels, tarballs...) are
+    stored as they are, since deflating them again takes time and saves next
+    to no space.
 
-    In any case, this function is heavily inspired in stdlib's
-    `shutil._make_zipfile`.
+    The content hash of every file added with `add_path` is recorded in the
+    archive's files manifest. Files whose hash is the same as in
+    `base_manifest` (the manifest of the base of an incremental snapshot)
+    aren't stored again.
+    """
+    def __init__(self, zip_filename, base_manifest=None):
+        self._zip_file = zipfile.ZipFile(
+            zip_filename,
+            'w',
+            compression=zipfile.ZIP_DEFLATED,
+            allowZip64=True,
+        )
+        self._base_manifest = base_manifest or {}
+        self.manifest = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if self.manifest:
+            self._zip_file.writestr(
+                snapshot_constants.FILES_MANIFEST_FILENAME,
+                json.dumps(self.manifest))
+        self._zip_file.close()
+
+    def add_directory(self, directory):
+        """Add the contents of `directory` at the root of the archive"""
+        base_dir = os.path.normpath(directory)
+        ctx.logger.debug('Adding to the archive: {0}'.format(base_dir))
+        for dirpath, dirnames, filenames in os.walk(base_dir):
+            for dirname in sorted(dirnames):
+                path = os.path.join(dirpath, dirname)
+                self._zip_file.write(path, os.path.relpath(path, base_dir))
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                # Not sure why this check is needed,
+                # but it's in the original stdlib's implementation
+                if os.path.isfile(path):
+                    self._write_file(path, os.path.relpath(path, base_dir))
+
+    def add_path(self, source, archive_path):
+        """Add the file or directory `source` to the archive as
+        `archive_path`. Missing sources are skipped.
+        """
+        if not os.path.exists(source):
+            ctx.logger.warning(
+                'Source not found: {0}. Skipping...'.format(source))
+            return
+        ctx.logger.debug(
+            'Adding to the archive: {0} as {1}'.format(source, archive_path))
+        if os.path.isfile(source):
+            self._add_tracked_file(source, archive_path)
+            return
+        self._zip_file.write(source, archive_path)
+        for dirpath, dirnames, filenames in os.walk(source):
+            target_dir = os.path.join(archive_path,
+                                      os.path.relpath(dirpath, source))
+            for dirname in sorted(dirnames):
+                self._zip_file.write(
+                    os.path.join(dirpath, dirname),
+                    os.path.normpath(os.path.join(target_dir, dirname)))
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if os.path.isfile(path):
+                    self._add_tracked_file(path, os.path.normpath(
+                        os.path.join(target_dir, filename)))
+
+    def _add_tracked_file(self, path, archive_path):
+        digest = file_digest(path)
+        self.manifest[archive_path] = digest
+        if self._base_manifest.get(archive_path) != digest:
+            self._write_file(path, archive_path)
+
+    def _write_file(self, path, archive_path):
+        if path.lower().endswith(snapshot_constants.COMPRESSED_EXTENSIONS):
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = zipfile.ZIP_DEFLATED
+        self._zip_file.write(path, archive_path, compress_type)
+
+
+def file_digest(path, chunk_size=2**16):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_snapshot_metadata(snapshot_path):
+    """Read the metadata and the files manifest of a snapshot archive,
+    without extracting it
+
+    :return: A tuple of (metadata, files manifest). The manifest is empty
+             for snapshots created before manifests were added.
+    """
+    with zipfile.ZipFile(snapshot_path, 'r') as zipf:
+        metadata = json.loads(
+            zipf.read(snapshot_constants.METADATA_FILENAME))
+        try:
+            manifest = json.loads(
+                zipf.read(snapshot_constants.FILES_MANIFEST_FILENAME))
+        except KeyError:
+            manifest = {}
+    return metadata, manifest
+
+
+def get_snapshot_path(file_server_root, snapshot_id):
+    return os.path.join(
+        file_server_root,
+        constants.FILE_SERVER_SNAPSHOTS_FOLDER,
+        snapshot_id,
+        '{0}.zip'.format(snapshot_id)
+    )
+
+
+def get_restored_files_paths(config):
+    """Return the paths in the snapshot archive of the files that are
+    copied from it to the manager, once the DB is restored
+    """
+    paths = [archive_path for _, archive_path
+             in _get_manager_files(config, to_archive=False)]
+    return paths + ['stage', 'composer']
+
+
+def _is_under(name, paths):
+    return any(name == path or name.startswith(path.rstrip('/') + '/')
+               for path in paths)
+
+
+class ArchiveExtractor(object):
+    """Extract members of snapshot archives on demand, in parallel.
+
+    The members to extract are added up front, and are then extracted in
+    groups (e.g. only the ones a restore phase needs) with `extract`.
+    Every thread opens the archive on its own, since zipfile objects can't
+    be shared between threads.
+    """
+    def __init__(self, target_dir,
+                 concurrency=snapshot_constants.EXTRACT_CONCURRENCY):
+        self._target_dir = target_dir
+        self._concurrency = concurrency
+        self._pending = []
+
+    def add(self, zip_path, names=None, target_dir=None):
+        """Add members of the archive in `zip_path` to be extracted
+
+        :param names: The names of the members to add, all of them if None
+        :param target_dir: Where to extract them, if not the target dir
+        :return: The names of all the members of the archive
+        """
+        with zipfile.ZipFile(zip_path, 'r') as zipf:
+            all_names = zipf.namelist()
+        target_dir = target_dir or self._target_dir
+        self._pending.extend(
+            (zip_path, name, target_dir)
+            for name in (all_names if names is None else names))
+        return all_names
+
+    def extract(self, paths=None, exclude=()):
+        """Extract the pending members that are under one of `paths` (or
+        all of them, if it's None), and aren't under any of `exclude`.
+        """
+        selected, pending = [], []
+        for member in self._pending:
+            name = member[1]
+            if (paths is None or _is_under(name, paths)) and \
+                    not _is_under(name, exclude):
+                selected.append(member)
+            else:
+                pending.append(member)
+        self._pending = pending
+
+        # The directories are created beforehand, so that the threads don't
+        # race to create the same ones
+        groups = {}
+        for index, (zip_path, name, target_dir) in enumerate(selected):
+            directory = os.path.join(target_dir, os.path.dirname(name))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            if not name.endswith('/'):
+                groups.setdefault((zip_path, index % self._concurrency), []) \
+                    .append((name, target_dir))
+        if not groups:
+            return
+
+        def extract_group(group):
+            (zip_path, _), members = group
+            with zipfile.ZipFile(zip_path, 'r') as zipf:
+                for name, target_dir in members:
+                    zipf.extract(name, target_dir)
+
+        pool = ThreadPool(min(self._concurrency, len(groups)))
+        try:
+            pool.map(extract_group, groups.items())
+        finally:
+            pool.close()
+            pool.join()
+
+
+def make_zip64_archive(zip_filename, directory):
+    """Create zip64 archive that contains all files in a directory.
 
     :param zip_filename: Path to the zip file to be created
     :type zip_filename: str
@@ -322,27 +528,8 @@ def make_zip64_archive(zip_filename, directory):
     :type directory: str
 
     """
-    zip_context_manager = zipfile.ZipFile(
-        zip_filename,
-        'w',
-        compression=zipfile.ZIP_DEFLATED,
-        allowZip64=True,
-    )
-
-    with zip_context_manager as zip_file:
-        path = os.path.normpath(directory)
-        ctx.logger.debug('Creating zip archive of: {0}'.format(path))
-        base_dir = path
-        for dirpath, dirnames, filenames in os.walk(directory):
-            for dirname in sorted(dirnames):
-                path = os.path.normpath(os.path.join(dirpath, dirname))
-                zip_file.write(path, os.path.relpath(path, base_dir))
-            for filename in filenames:
-                path = os.path.normpath(os.path.join(dirpath, filename))
-                # Not sure why this check is needed,
-                # but it's in the original stdlib's implementation
-                if os.path.isfile(path):
-                    zip_file.write(path, os.path.relpath(path, base_dir))
+    with SnapshotArchive(zip_filename) as archive:
+        archive.add_directory(directory)
 
 
 @contextlib.contextmanager
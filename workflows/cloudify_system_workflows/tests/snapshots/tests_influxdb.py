@@ -0,0 +1,65 @@
+"""InfluxDB snapshot test cases."""
+
+import json
+import unittest
+from StringIO import StringIO
+
+from mock import patch
+
+from cloudify.exceptions import NonRecoverableError
+
+from cloudify_system_workflows.snapshots.influxdb import InfluxDB
+
+
+def _series(count):
+    return [{'name': 'serie_{0}'.format(i % 3),
+             'columns': ['time', 'value'],
+             'points': [[i, i]] * (i % 4 + 1)}
+            for i in range(count)]
+
+
+class InfluxDBTest(unittest.TestCase):
+
+    """Test reading and batching InfluxDB dumps."""
+
+    def test_read_json_objects(self):
+        """Objects are read whole, whatever the chunks they span."""
+        series = _series(50)
+        dump = '\n'.join(json.dumps(serie) for serie in series)
+        for chunk_size in (1, 10, 1000):
+            read = list(InfluxDB._read_json_objects(StringIO(dump),
+                                                    chunk_size))
+            self.assertEqual(series, read)
+
+    def test_read_object_spanning_chunks(self):
+        """An object spanning many chunks is only decoded a few times."""
+        serie = {'name': 'serie',
+                 'columns': ['time', 'value'],
+                 'points': [[i, {'value': i}] for i in range(1000)]}
+        dump = json.dumps(serie) + json.dumps(_series(1)[0])
+        raw_decode = json.JSONDecoder.raw_decode
+        with patch.object(json.JSONDecoder, 'raw_decode', autospec=True,
+                          side_effect=raw_decode) as mock_raw_decode:
+            read = list(InfluxDB._read_json_objects(StringIO(dump), 10))
+        self.assertEqual([serie, _series(1)[0]], read)
+        self.assertGreater(len(dump) / 10, 1000)
+        self.assertLess(mock_raw_decode.call_count, 30)
+
+    def test_read_truncated(self):
+        """A truncated dump is an error."""
+        dump = json.dumps(_series(1)[0]) + '{"name": '
+        with self.assertRaises(NonRecoverableError):
+            list(InfluxDB._read_json_objects(StringIO(dump), 10))
+
+    @patch.object(InfluxDB, '_RESTORE_BATCH_POINTS', 20)
+    def test_batches(self):
+        """Points are grouped in batches, by series."""
+        series = _series(30)
+        batches = list(InfluxDB._get_batches(series))
+        self.assertGreater(len(batches), 1)
+        for batch in batches:
+            names = [serie['name'] for serie in batch]
+            self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(
+            sum(len(serie['points']) for serie in series),
+            sum(len(serie['points']) for batch in batches for serie in batch))
@@ -0,0 +1,310 @@
+"""Postgres snapshot test cases."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, Mock, call, patch
+
+from cloudify.exceptions import NonRecoverableError
+
+from cloudify_system_workflows.snapshots.postgres import Postgres
+
+
+def _postgres():
+    """Return a Postgres whose connection is mocked"""
+    config = Mock(postgresql_host='localhost')
+    postgres = Postgres(config)
+    postgres._connection = MagicMock()
+    return postgres
+
+
+@patch('cloudify_system_workflows.snapshots.postgres.ctx')
+class EventsDumpTest(unittest.TestCase):
+
+    """Test dumping and restoring the events and logs tables."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='postgres_test_')
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def _write_dump(self, dump_dir, table):
+        if not os.path.isdir(dump_dir):
+            os.makedirs(dump_dir)
+        dump_path = os.path.join(dump_dir, 'pg_{0}'.format(table))
+        with open(dump_path, 'w') as f:
+            f.write('rows\n')
+        return dump_path
+
+    def test_dump_events_table(self, _):
+        """Only the rows added after the base snapshot are dumped."""
+        postgres = _postgres()
+        cursor = postgres._connection.cursor.return_value
+        cursor.fetchone.return_value = (42,)
+        cursor.mogrify.side_effect = lambda query, args: query % args
+        cursor.copy_expert.side_effect = \
+            lambda query, dump_file: dump_file.write('rows\n')
+
+        high_water_mark = postgres._dump_events_table(
+            self.tempdir, 'events', 10)
+
+        self.assertEqual(42, high_water_mark)
+        query = cursor.copy_expert.call_args[0][0]
+        self.assertIn('FROM events', query)
+        self.assertIn('_storage_id > 10 AND _storage_id <= 42', query)
+        with open(os.path.join(self.tempdir, 'pg_events')) as f:
+            self.assertEqual('rows\n', f.read())
+
+    def test_dump_snapshot(self, _):
+        """pg_dump and the events dumps share one snapshot, taken while the
+        events tables are locked against inserts.
+        """
+        postgres = _postgres()
+        cursor = postgres._connection.cursor.return_value
+        cursor.fetchone.return_value = ('snapshot-1',)
+        lock_connection = MagicMock()
+        queries = []
+        cursor.execute.side_effect = queries.append
+        lock_connection.cursor.return_value.execute.side_effect = \
+            lambda query: queries.append('lock: {0}'.format(query))
+
+        with patch.object(postgres, '_connect',
+                          return_value=lock_connection), \
+                patch.object(postgres, '_dump_to_file') as dump_to_file, \
+                patch.object(postgres, '_dump_admin_user_to_file'), \
+                patch.object(postgres, '_append_delete_current_execution'), \
+                patch.object(postgres, '_dump_events_table',
+                             return_value=42) as dump_events_table:
+            high_water_mark = postgres.dump(self.tempdir, True, True,
+                                            {'events': 10})
+
+        self.assertEqual({'events': 42, 'logs': 42}, high_water_mark)
+        self.assertEqual('snapshot-1',
+                         dump_to_file.call_args[1]['snapshot'])
+        dump_events_table.assert_any_call(self.tempdir, 'events', 10)
+        dump_events_table.assert_any_call(self.tempdir, 'logs', 0)
+        self.assertEqual([
+            'BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY',
+            'lock: BEGIN',
+            'lock: LOCK TABLE events, logs IN SHARE MODE',
+            'SELECT pg_export_snapshot()',
+            'lock: COMMIT',
+            'COMMIT',
+        ], queries)
+        self.assertTrue(lock_connection.close.called)
+
+    def test_dump_without_events(self, _):
+        """Nothing is locked if no events are dumped."""
+        postgres = _postgres()
+        cursor = postgres._connection.cursor.return_value
+        cursor.fetchone.return_value = ('snapshot-1',)
+
+        with patch.object(postgres, '_connect') as connect, \
+                patch.object(postgres, '_dump_to_file'), \
+                patch.object(postgres, '_dump_admin_user_to_file'), \
+                patch.object(postgres, '_append_delete_current_execution'):
+            self.assertEqual({}, postgres.dump(self.tempdir, False, False))
+
+        self.assertFalse(connect.called)
+        cursor.execute.assert_called_with('COMMIT')
+
+    def test_restore_events_order(self, _):
+        """The dumps are restored in order, skipping missing ones."""
+        base_dir = os.path.join(self.tempdir, 'base')
+        incremental_dir = os.path.join(self.tempdir, 'incremental')
+        base_events = self._write_dump(base_dir, 'events')
+        base_logs = self._write_dump(base_dir, 'logs')
+        incremental_events = self._write_dump(incremental_dir, 'events')
+        postgres = _postgres()
+
+        with patch.object(postgres, '_restore_events_table') as restore:
+            postgres.restore_events([base_dir, incremental_dir])
+
+        self.assertEqual([
+            call('events', base_events),
+            call('logs', base_logs),
+            call('events', incremental_events),
+        ], restore.mock_calls)
+
+    def test_restore_events_table(self, _):
+        """Rows are loaded through a staging table, which is dropped."""
+        dump_path = self._write_dump(self.tempdir, 'events')
+        postgres = _postgres()
+        cursor = postgres._connection.cursor.return_value
+
+        postgres._restore_events_table('events', dump_path)
+
+        queries = [c[0][0] for c in cursor.execute.call_args_list]
+        self.assertEqual(3, len(queries))
+        self.assertEqual('CREATE TEMP TABLE events_restore (LIKE events)',
+                         queries[0])
+        self.assertIn('INSERT INTO events SELECT * FROM events_restore',
+                      queries[1])
+        self.assertIn('_execution_fk IN', queries[1])
+        self.assertEqual('DROP TABLE events_restore', queries[2])
+
+    def test_restore_events_table_error(self, _):
+        """The staging table is dropped even if loading the rows fails."""
+        dump_path = self._write_dump(self.tempdir, 'logs')
+        postgres = _postgres()
+        cursor = postgres._connection.cursor.return_value
+        cursor.copy_expert.side_effect = RuntimeError('invalid dump')
+
+        with self.assertRaises(RuntimeError):
+            postgres._restore_events_table('logs', dump_path)
+
+        cursor.execute.assert_called_with('DROP TABLE logs_restore')
+
+
+@patch('cloudify_system_workflows.snapshots.postgres.ctx')
+class PluginYamlFilesTest(unittest.TestCase):
+
+    """Test recording the yaml file names of restored plugins."""
+
+    def setUp(self):
+        self.plugins_dir = tempfile.mkdtemp(prefix='postgres_test_')
+        self.addCleanup(shutil.rmtree, self.plugins_dir)
+
+    def _plugin_dir(self, plugin_id, *file_names):
+        plugin_dir = os.path.join(self.plugins_dir, plugin_id)
+        os.mkdir(plugin_dir)
+        for file_name in file_names:
+            open(os.path.join(plugin_dir, file_name), 'w').close()
+
+    def test_record_plugin_yaml_files(self, _):
+        """Names are only recorded for plugins whose files exist."""
+        self._plugin_dir('with_yaml', 'plugin.yaml', 'plugin.wgn')
+        self._plugin_dir('wagon_only', 'plugin.wgn')
+        postgres = _postgres()
+
+        with patch.object(postgres, 'run_query') as run_query:
+            run_query.return_value = {'all': [
+                (1, 'with_yaml'), (2, 'wagon_only'), (3, 'missing')]}
+            postgres.record_plugin_yaml_files(self.plugins_dir)
+
+        self.assertIn('yaml_file_name IS NULL',
+                      run_query.mock_calls[0][1][0])
+        self.assertEqual([(1, 'plugin.yaml'), (2, '')],
+                         run_query.mock_calls[1][2]['vars'])
+
+    def test_record_plugin_yaml_files_missing(self, _):
+        """Nothing is stored if no plugin's files were restored."""
+        postgres = _postgres()
+
+        with patch.object(postgres, 'run_query') as run_query:
+            run_query.return_value = {'all': [(1, 'missing')]}
+            postgres.record_plugin_yaml_files(self.plugins_dir)
+
+        self.assertEqual(1, run_query.call_count)
+
+
+class CustomFormatRestoreTest(unittest.TestCase):
+
+    """Test restoring custom format dumps, and recovering from failures."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='postgres_test_')
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        ctx_patcher = patch('cloudify_system_workflows.snapshots.postgres.ctx')
+        self.addCleanup(ctx_patcher.stop)
+        ctx_patcher.start()
+        self.postgres = _postgres()
+        self.queries = []
+        for name, value in [
+                ('_check_custom_format_dump', None),
+                ('_get_execution_restore_query', 'restore execution'),
+                ('_get_admin_user_update_query', 'update admin'),
+                ('_get_clear_tables_queries', ['truncate']),
+                ('_get_foreign_keys', [('a', 'a_fk', 'FOREIGN KEY (b_id)')]),
+                ('_execute', None),
+                ('_restore_dump_parallel', None)]:
+            patcher = patch.object(self.postgres, name, return_value=value)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+        self.postgres._execute.side_effect = \
+            lambda queries: self.queries.extend(queries)
+        self.save_admin_queries = \
+            self.postgres._get_save_admin_rows_queries()
+
+    def test_restore(self):
+        """The foreign keys are validated once the data is loaded."""
+        self.postgres._restore_custom_format_dump(self.tempdir, 'pg_data')
+
+        self.postgres._restore_dump_parallel.assert_called_once_with(
+            'pg_data', self.postgres._db_name)
+        self.assertEqual(self.save_admin_queries + [
+            'truncate',
+            'ALTER TABLE a DROP CONSTRAINT a_fk;',
+            'ALTER TABLE a ADD CONSTRAINT a_fk FOREIGN KEY (b_id) NOT VALID;',
+            'ALTER TABLE a VALIDATE CONSTRAINT a_fk;',
+            'restore execution',
+            'update admin',
+        ], self.queries)
+
+    def test_failed_restore(self):
+        """A failed restore puts the admin user back, re-adds the foreign
+        keys without validating them, and raises its own error.
+        """
+        self.postgres._restore_dump_parallel.side_effect = \
+            RuntimeError('pg_restore failed')
+
+        with self.assertRaisesRegexp(RuntimeError, 'pg_restore failed'):
+            self.postgres._restore_custom_format_dump(self.tempdir, 'pg_data')
+
+        self.assertEqual(self.save_admin_queries + [
+            'truncate',
+            'ALTER TABLE a DROP CONSTRAINT a_fk;',
+            'ALTER TABLE a ADD CONSTRAINT a_fk FOREIGN KEY (b_id) NOT VALID;',
+        ] + self.postgres._get_restore_admin_rows_queries() + [
+            'restore execution',
+            'update admin',
+        ], self.queries)
+        self.assertIn('INSERT INTO users SELECT * FROM users_admin_backup',
+                      self.queries[-6])
+
+    def test_failed_recovery(self):
+        """The restore's error is raised even if recovering fails."""
+        self.postgres._restore_dump_parallel.side_effect = \
+            RuntimeError('pg_restore failed')
+
+        def execute(queries):
+            queries = list(queries)
+            if 'restore execution' in queries:
+                raise RuntimeError('recovery failed')
+            self.queries.extend(queries)
+        self.postgres._execute.side_effect = execute
+
+        with self.assertRaisesRegexp(RuntimeError, 'pg_restore failed'):
+            self.postgres._restore_custom_format_dump(self.tempdir, 'pg_data')
+
+    def test_invalid_dump(self):
+        """Nothing is cleared if the dump can't be read."""
+        self.postgres._check_custom_format_dump.side_effect = \
+            NonRecoverableError('Invalid DB dump')
+
+        with self.assertRaises(NonRecoverableError):
+            self.postgres._restore_custom_format_dump(self.tempdir, 'pg_data')
+
+        self.assertEqual([], self.queries)
+        self.assertFalse(self.postgres._restore_dump_parallel.called)
+
+    @patch('cloudify_system_workflows.snapshots.postgres.run_shell')
+    def test_check_dump(self, run_shell):
+        """The dump is checked by listing its contents."""
+        postgres = _postgres()
+        postgres._check_custom_format_dump('pg_data')
+        command = run_shell.call_args[0][0]
+        self.assertEqual(['--list', 'pg_data'], command[-2:])
+
+        run_shell.side_effect = RuntimeError('not a dump')
+        with self.assertRaisesRegexp(NonRecoverableError, 'not a dump'):
+            postgres._check_custom_format_dump('pg_data')
+
+    def test_strip_not_valid(self):
+        """Constraints left by a failed restore are re-added once."""
+        self.assertEqual(
+            'FOREIGN KEY (b_id)',
+            Postgres._strip_not_valid('FOREIGN KEY (b_id) NOT VALID'))
+        self.assertEqual('FOREIGN KEY (b_id)',
+                         Postgres._strip_not_valid('FOREIGN KEY (b_id)'))
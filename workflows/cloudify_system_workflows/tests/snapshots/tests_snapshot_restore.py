@@ -0,0 +1,132 @@
+"""Snapshot restore test cases."""
+
+import os
+import json
+import shutil
+import hashlib
+import zipfile
+import tempfile
+import unittest
+
+from mock import patch
+
+from cloudify.exceptions import NonRecoverableError
+
+from cloudify_system_workflows.snapshots.snapshot_restore import \
+    SnapshotRestore
+
+
+@patch('cloudify_system_workflows.snapshots.utils.ctx')
+@patch('cloudify_system_workflows.snapshots.snapshot_restore.ctx')
+class BaseSnapshotsExtractionTest(unittest.TestCase):
+
+    """Test completing incremental snapshots from their bases."""
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp(prefix='snapshot_restore_test_')
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        self.file_server_root = os.path.join(self.base_dir, 'file_server')
+        self.tempdir = os.path.join(self.base_dir, 'restore')
+        os.mkdir(self.tempdir)
+
+    def _create_snapshot(self, snapshot_id, files, manifest,
+                         base_snapshot_id=None):
+        """Create a snapshot archive, with `files` (a dict of name: content),
+        and a manifest of the digests of the files in `manifest`
+        """
+        snapshot_dir = os.path.join(self.file_server_root, 'snapshots',
+                                    snapshot_id)
+        os.makedirs(snapshot_dir)
+        metadata = {}
+        if base_snapshot_id:
+            metadata['base_snapshot_id'] = base_snapshot_id
+        snapshot_path = os.path.join(snapshot_dir,
+                                     '{0}.zip'.format(snapshot_id))
+        with zipfile.ZipFile(snapshot_path, 'w') as zipf:
+            zipf.writestr('metadata.json', json.dumps(metadata))
+            zipf.writestr('files_manifest.json', json.dumps({
+                name: hashlib.sha256(content).hexdigest()
+                for name, content in manifest.items()}))
+            for name, content in files.items():
+                zipf.writestr(name, content)
+        return snapshot_path
+
+    def _snapshot_restore(self, snapshot_id):
+        with patch('cloudify_system_workflows.snapshots.snapshot_restore.'
+                   'get_rest_client'), \
+                patch('cloudify_system_workflows.snapshots.utils.'
+                      'get_manager_version'):
+            snapshot_restore = SnapshotRestore(
+                config={'file_server_root': self.file_server_root},
+                snapshot_id=snapshot_id,
+                recreate_deployments_envs=False,
+                force=False,
+                timeout=0,
+                premium_enabled=False,
+                user_is_bootstrap_admin=True,
+                restore_certificates=False,
+                no_reboot=True,
+                ignore_plugin_failure=False)
+        snapshot_restore._tempdir = self.tempdir
+        return snapshot_restore
+
+    def _read(self, name):
+        with open(os.path.join(self.tempdir, name)) as f:
+            return f.read()
+
+    def test_base_chain(self, *_):
+        """Files are extracted from the closest base that has them, and
+        the events of the bases are restored oldest first.
+        """
+        self._create_snapshot(
+            'base',
+            {'a': 'a', 'b': 'old b', 'pg_events': 'base events'},
+            {'a': 'a', 'b': 'old b'})
+        self._create_snapshot(
+            'middle',
+            {'b': 'b', 'pg_events': 'middle events', 'pg_logs': 'logs'},
+            {'a': 'a', 'b': 'b'},
+            base_snapshot_id='base')
+        snapshot_path = self._create_snapshot(
+            'incremental',
+            {'c': 'c'},
+            {'a': 'a', 'b': 'b', 'c': 'c'},
+            base_snapshot_id='middle')
+        snapshot_restore = self._snapshot_restore('incremental')
+
+        metadata = snapshot_restore._plan_snapshot_extraction(snapshot_path)
+        snapshot_restore._extractor.extract()
+
+        self.assertEqual('middle', metadata['base_snapshot_id'])
+        self.assertEqual('a', self._read('a'))
+        self.assertEqual('b', self._read('b'))
+        self.assertEqual('c', self._read('c'))
+        base_events_dir = os.path.join(self.tempdir, 'base_snapshots', 'base')
+        middle_events_dir = os.path.join(self.tempdir, 'base_snapshots',
+                                         'middle')
+        self.assertEqual([base_events_dir, middle_events_dir, self.tempdir],
+                         snapshot_restore._events_dump_dirs)
+        self.assertEqual(['pg_events'], os.listdir(base_events_dir))
+        self.assertEqual(['pg_events', 'pg_logs'],
+                         sorted(os.listdir(middle_events_dir)))
+
+    def test_missing_base(self, *_):
+        """An incremental snapshot can't be restored without its base."""
+        snapshot_path = self._create_snapshot(
+            'incremental', {}, {}, base_snapshot_id='base')
+        snapshot_restore = self._snapshot_restore('incremental')
+
+        with self.assertRaisesRegexp(NonRecoverableError,
+                                     'Base snapshot base'):
+            snapshot_restore._plan_snapshot_extraction(snapshot_path)
+
+    def test_changed_base(self, *_):
+        """Files are only taken from a base with the same digest."""
+        self._create_snapshot('base', {'a': 'other a'}, {'a': 'other a'})
+        snapshot_path = self._create_snapshot(
+            'incremental', {}, {'a': 'a'}, base_snapshot_id='base')
+        snapshot_restore = self._snapshot_restore('incremental')
+
+        with self.assertRaisesRegexp(NonRecoverableError,
+                                     'Files missing from the base'):
+            snapshot_restore._plan_snapshot_extraction(snapshot_path)
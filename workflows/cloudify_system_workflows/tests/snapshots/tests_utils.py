@@ -2,13 +2,19 @@
 
 import os
 import shutil
+import zipfile
 import subprocess
 import unittest
 import tempfile
 
+from mock import patch
 from pytest import mark
 
-from cloudify_system_workflows.snapshots.utils import make_zip64_archive
+from cloudify_system_workflows.snapshots.utils import (make_zip64_archive,
+                                                       file_digest,
+                                                       read_snapshot_metadata,
+                                                       ArchiveExtractor,
+                                                       SnapshotArchive)
 
 
 class MakeZip64Test(unittest.TestCase):
@@ -77,3 +83,85 @@ class MakeZip64Test(unittest.TestCase):
             os.path.getsize(zip_filename),
             2.2 * 2**30,  # 2.2GB
         )
+
+
+@patch('cloudify_system_workflows.snapshots.utils.ctx')
+class SnapshotArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp(prefix='snapshot_archive_test_')
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        self.dump_dir = os.path.join(self.base_dir, 'dump')
+        self.plugins_dir = os.path.join(self.base_dir, 'plugins', 'plugin')
+        os.mkdir(self.dump_dir)
+        os.makedirs(self.plugins_dir)
+        with open(os.path.join(self.dump_dir, 'metadata.json'), 'w') as f:
+            f.write('{}')
+        for path in [os.path.join(self.plugins_dir, 'plugin.yaml'),
+                     os.path.join(self.plugins_dir, 'plugin.wgn')]:
+            with open(path, 'w') as f:
+                f.write('data' * 100)
+        self.zip_filename = os.path.join(self.base_dir, 'snapshot.zip')
+
+    def test_add_paths(self, _):
+        with SnapshotArchive(self.zip_filename) as archive:
+            archive.add_directory(self.dump_dir)
+            archive.add_path(os.path.join(self.base_dir, 'plugins'),
+                             'plugins')
+            archive.add_path(os.path.join(self.base_dir, 'missing'),
+                             'missing')
+
+        with zipfile.ZipFile(self.zip_filename) as zip_file:
+            infos = {info.filename: info for info in zip_file.infolist()}
+        self.assertEqual({
+            'metadata.json',
+            'files_manifest.json',
+            'plugins/',
+            'plugins/plugin/',
+            'plugins/plugin/plugin.yaml',
+            'plugins/plugin/plugin.wgn',
+        }, set(infos))
+        self.assertEqual(zipfile.ZIP_DEFLATED,
+                         infos['plugins/plugin/plugin.yaml'].compress_type)
+        self.assertEqual(zipfile.ZIP_STORED,
+                         infos['plugins/plugin/plugin.wgn'].compress_type)
+
+    def test_incremental(self, _):
+        unchanged = os.path.join(self.plugins_dir, 'plugin.wgn')
+        base_manifest = {
+            'plugins/plugin/plugin.wgn': file_digest(unchanged),
+            'plugins/plugin/plugin.yaml': 'changed',
+        }
+        with SnapshotArchive(self.zip_filename,
+                             base_manifest=base_manifest) as archive:
+            archive.add_directory(self.dump_dir)
+            archive.add_path(os.path.join(self.base_dir, 'plugins'),
+                             'plugins')
+
+        with zipfile.ZipFile(self.zip_filename) as zip_file:
+            names = set(zip_file.namelist())
+        self.assertIn('plugins/plugin/plugin.yaml', names)
+        self.assertNotIn('plugins/plugin/plugin.wgn', names)
+        _, manifest = read_snapshot_metadata(self.zip_filename)
+        self.assertEqual({'plugins/plugin/plugin.wgn',
+                          'plugins/plugin/plugin.yaml'}, set(manifest))
+
+    def test_extract_in_phases(self, _):
+        with SnapshotArchive(self.zip_filename) as archive:
+            archive.add_directory(self.dump_dir)
+            archive.add_path(os.path.join(self.base_dir, 'plugins'),
+                             'plugins')
+        target_dir = os.path.join(self.base_dir, 'extracted')
+        extractor = ArchiveExtractor(target_dir)
+        extractor.add(self.zip_filename)
+
+        extractor.extract(exclude=['plugins'])
+        self.assertTrue(
+            os.path.isfile(os.path.join(target_dir, 'metadata.json')))
+        self.assertFalse(os.path.exists(os.path.join(target_dir, 'plugins',
+                                                     'plugin', 'plugin.wgn')))
+
+        extractor.extract()
+        for filename in ['plugin.yaml', 'plugin.wgn']:
+            self.assertTrue(os.path.isfile(
+                os.path.join(target_dir, 'plugins', 'plugin', filename)))